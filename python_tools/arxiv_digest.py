@@ -1,93 +1,119 @@
 import argparse
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from datetime import datetime, timedelta
-import os
+from datetime import datetime, timedelta, timezone
+import http_utils
+import mailer
 import requests
-import smtplib
+import time
+from typing import Iterable, Iterator
 import xml.etree.ElementTree as ET
 
 LANGUAGE_MODELING_SEARCH_QUERY = '(cat:cs.CL OR cat:cs.CV OR cat:cs.AI) AND (abs:"language model" OR abs:"LLM" OR abs:"MLLM" OR abs:"large language model" OR abs:"small language model")'
 DIFFUSION_MODELING_SEARCH_QUERY = '(cat:cs.CL OR cat:cs.CV OR cat:cs.AI) AND (abs:"diffusion model" OR abs:"diffusion")'
 
+ARXIV_API_URL = "http://export.arxiv.org/api/query"
+ATOM_NAMESPACE = "{http://www.w3.org/2005/Atom}"
 
-def get_yesterday_papers(search_query: str):
-    # Define the base URL for the arXiv API
-    base_url = "http://export.arxiv.org/api/query?"
+# Papers per page of results, and the seconds to wait between pages, as the
+# arXiv API terms of use ask.
+PAGE_SIZE = 100
+PAGE_DELAY = 3.0
 
-    # Define the search terms and other query parameters
-    start_date = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%dT00:00:00Z")
-
-    # Combine query with date filter
-    query = f"{base_url}search_query={search_query}&start=0&max_results=100&sortBy=submittedDate&sortOrder=descending"
-
-    # Send the request to arXiv
-    response = requests.get(query)
-    if response.status_code != 200:
-        print(f"Error fetching data from arXiv: {response.status_code}")
-        return []
-
-    # Parse the XML response
-    root = ET.fromstring(response.content)
-    papers = []
-    for entry in root.findall("{http://www.w3.org/2005/Atom}entry"):
-        title = entry.find("{http://www.w3.org/2005/Atom}title").text
-        summary = entry.find("{http://www.w3.org/2005/Atom}summary").text
-        published = entry.find("{http://www.w3.org/2005/Atom}published").text
-        link = entry.find("{http://www.w3.org/2005/Atom}id").text
-
-        # Filter to include only papers published in the last 24 hours
-        if published >= start_date:
-            papers.append(
-                {
-                    "title": title,
-                    "summary": summary,
-                    "published": published,
-                    "link": link,
-                }
-            )
-
-    return papers
 
+def iter_papers(
+    search_query: str,
+    start_date: datetime,
+    end_date: datetime,
+    session: requests.Session = None,
+    page_size: int = PAGE_SIZE,
+    page_delay: float = PAGE_DELAY,
+) -> Iterator[dict]:
+    """
+    Yields the papers matching the search query that were submitted between the
+    two dates, newest first.
+
+    The date window is part of the query, so only the matching papers are
+    returned, one page of `page_size` papers at a time. Pages are only requested
+    as the papers are consumed, `page_delay` seconds apart as the arXiv API asks,
+    and each page is parsed as it is downloaded, so that memory use does not
+    depend on the number of papers.
+    """
+    if session is None:
+        session = http_utils.create_session(pool_size=1)
 
-def send_email(papers, recipient_email: str, subject_title: str, header_title: str):
-    # Get email credentials from environment variables
-    sender_email = os.getenv("SENDER_EMAIL")
-    sender_password = os.getenv("SENDER_PASSWORD")
+    query = (
+        f"({search_query}) AND submittedDate:"
+        f"[{start_date.strftime('%Y%m%d%H%M')} TO {end_date.strftime('%Y%m%d%H%M')}]"
+    )
+    start = 0
+    while True:
+        if start:
+            time.sleep(page_delay)
+        response = session.get(
+            ARXIV_API_URL,
+            params={
+                "search_query": query,
+                "start": start,
+                "max_results": page_size,
+                "sortBy": "submittedDate",
+                "sortOrder": "descending",
+            },
+            stream=True,
+            timeout=http_utils.DEFAULT_TIMEOUT,
+        )
+        if response.status_code != 200:
+            print(f"Error fetching data from arXiv: {response.status_code}")
+            return
+
+        num_entries = 0
+        response.raw.decode_content = True
+        for _, element in ET.iterparse(response.raw, events=("end",)):
+            if element.tag != f"{ATOM_NAMESPACE}entry":
+                continue
+            num_entries += 1
+            yield {
+                "title": element.findtext(f"{ATOM_NAMESPACE}title"),
+                "summary": element.findtext(f"{ATOM_NAMESPACE}summary"),
+                "published": element.findtext(f"{ATOM_NAMESPACE}published"),
+                "link": element.findtext(f"{ATOM_NAMESPACE}id"),
+            }
+            element.clear()
+        response.close()
+
+        if num_entries < page_size:
+            return
+        start += page_size
+
+
+def get_yesterday_papers(
+    search_query: str, session: requests.Session = None, now: datetime = None
+) -> Iterator[dict]:
+    # Everything submitted yesterday, in UTC. The window ends at the start of
+    # today rather than now, so that every run of the day sends the same query
+    # and a rerun is answered by the HTTP cache. Papers submitted today are
+    # not announced before tonight, and are in tomorrow's window.
+    if now is None:
+        now = datetime.now(timezone.utc)
+    end_date = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    start_date = end_date - timedelta(days=1)
+    return iter_papers(search_query, start_date, end_date, session=session)
+
+
+def send_email(
+    papers: Iterable[dict], recipient_email: str, subject_title: str, header_title: str
+):
+    settings = mailer.SMTPSettings.from_env()
 
     # Prepare the email content
     subject = f"Daily Digest: Latest {subject_title} Papers on arXiv ({datetime.now().strftime('%Y-%m-%d')})"
-    body = f"<h2>Latest {header_title} Papers from arXiv</h2>"
-
-    body += f"<i>{len(papers)} papers found.</i>"
-    body += f"<br>"
-
-    if papers:
-        for paper in papers:
-            title = paper["title"]
-            summary = paper["summary"]
-            published = paper["published"]
-            link = paper["link"]
-
-            body += f"<p><b>{title}</b><br>Abstract: {summary}<br><a href='{link}'>Read more</a></p><hr>"
-    else:
-        body += "<p>No new papers found in the past day.</p>"
-
-    # Create the email message
-    msg = MIMEMultipart()
-    msg["From"] = sender_email
-    msg["To"] = recipient_email
-    msg["Subject"] = subject
-    msg.attach(MIMEText(body, "html"))
+    body = mailer.render_digest_html(f"Latest {header_title} Papers from arXiv", papers)
 
     # Send the email
-    try:
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465) as server:
-            server.login(sender_email, sender_password)
-            server.sendmail(sender_email, recipient_email, msg.as_string())
-        print("Email sent successfully!")
-    except Exception as e:
-        print("Error sending email:", e)
+    message = mailer.build_message(
+        settings.sender_email, recipient_email, subject, body
+    )
+    with mailer.Mailer(settings) as digest_mailer:
+        if digest_mailer.send(message):
+            print("Email sent successfully!")
 
 
 def main(override=None):
@@ -99,16 +125,22 @@ def main(override=None):
     parser.add_argument("--subject_title", type=str, required=True)
     parser.add_argument("--header_title", type=str, required=True)
     parser.add_argument("--search_query", type=str, required=True)
+    http_utils.add_cache_arguments(parser)
 
     args = parser.parse_args()
 
-    papers = get_yesterday_papers(search_query=args.search_query)
+    http_cache = http_utils.cache_from_args(args)
+    session = http_utils.create_session(pool_size=1, cache=http_cache)
+    papers = get_yesterday_papers(search_query=args.search_query, session=session)
     send_email(
         papers,
         recipient_email=args.recipient_email,
         subject_title=args.subject_title,
         header_title=args.header_title,
     )
+    if http_cache is not None:
+        print(http_cache.report())
+        http_cache.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,97 @@
+from typing import List
+
+import lxml.etree
+
+ARXIV_ABS_URL = "https://arxiv.org/abs/"
+
+_ASCII_SPACES = "\x20\x0a\x09\x0c\x0d"
+
+_CONTENT = lxml.etree.XPath("(//body//div[@id='content'])[1]")
+_FIRST_DL = lxml.etree.XPath("(.//dl)[1]")
+_DT = lxml.etree.XPath(".//dt")
+_DD = lxml.etree.XPath(".//dd")
+
+
+def _text(element) -> str:
+    """
+    The text of the element and its descendants, like BeautifulSoup's `.text`.
+
+    BeautifulSoup collapses every text node made only of ASCII whitespace into
+    a single newline, or a single space when it has no newline, so the same is
+    done here to produce identical strings.
+    """
+    chunks = []
+    for chunk in element.itertext():
+        if not chunk.strip(_ASCII_SPACES):
+            chunk = "\n" if "\n" in chunk else " "
+        chunks.append(chunk)
+    return "".join(chunks)
+
+
+def _find_fields(dd):
+    """
+    The title, authors, subjects and abstract elements of a listing entry.
+
+    Each is the first matching element in document order, matched on its class
+    the same way as BeautifulSoup's `find`: the whole class attribute for the
+    title, and a single class name for the others. Walking the entry once is
+    much cheaper than one XPath search per field.
+    """
+    title = authors = subjects = abstract = None
+    for element in dd.iter("div", "p"):
+        classes = element.get("class", "").split()
+        if element.tag == "p":
+            if abstract is None and "mathjax" in classes:
+                abstract = element
+        elif title is None and classes == ["list-title", "mathjax"]:
+            title = element
+        elif authors is None and "list-authors" in classes:
+            authors = element
+        elif subjects is None and "list-subjects" in classes:
+            subjects = element
+    return title, authors, subjects, abstract
+
+
+def _paper_number(dt_text: str) -> str:
+    paper_number_entries = dt_text.strip().split(" ")
+    for ent in paper_number_entries:
+        if ent.strip().lower().startswith("arxiv:"):
+            return ent.strip().split(":")[-1]
+    raise AssertionError(paper_number_entries)
+
+
+def parse_listing_page(page: bytes) -> List[dict]:
+    """
+    Extracts the new papers from an arXiv `/list/{field}/new` page.
+
+    Returns:
+        List[dict]: One dict per paper with the "main_page", "pdf", "title",
+            "authors", "subjects" and "abstract" fields, in listing order.
+    """
+    root = lxml.etree.fromstring(
+        page, parser=lxml.etree.HTMLParser(encoding="utf-8")
+    )
+    (content,) = _CONTENT(root)
+    (dl,) = _FIRST_DL(content)
+    dt_list = _DT(dl)
+    dd_list = _DD(dl)
+    assert len(dt_list) == len(dd_list)
+
+    new_paper_list = []
+    for dt, dd in zip(dt_list, dd_list):
+        paper_number = _paper_number(_text(dt))
+        title, authors, subjects, abstract = _find_fields(dd)
+        new_paper_list.append(
+            {
+                "main_page": ARXIV_ABS_URL + paper_number,
+                "pdf": ARXIV_ABS_URL.replace("abs", "pdf") + paper_number,
+                "title": _text(title).replace("Title: ", "").strip(),
+                "authors": _text(authors)
+                .replace("Authors:\n", "")
+                .replace("\n", "")
+                .strip(),
+                "subjects": _text(subjects).replace("Subjects: ", "").strip(),
+                "abstract": _text(abstract).replace("\n", " ").strip(),
+            }
+        )
+    return new_paper_list
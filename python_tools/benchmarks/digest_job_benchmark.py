@@ -0,0 +1,482 @@
+import argparse
+import concurrent.futures
+import contextlib
+import datetime
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fake_openai_server
+import listing_fixtures
+
+DEFAULT_EMULATOR_PORT = 8080
+DEFAULT_PROJECT = "research-buddy-benchmark"
+SUBJECT_CODE_PATTERN = re.compile(r"\(([\w-]+\.[\w-]+)\)")
+
+
+def start_listing_server(pages: Dict[str, bytes], port: int = 0):
+    """
+    Serves the listing pages at `/list/{category}/new` on a background thread,
+    as the `--arxiv_base_url` of the digest job.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            match = re.match(r"^/list/([^/]+)/new$", self.path)
+            if not match or match.group(1) not in pages:
+                self.send_error(404)
+                return
+            page = pages[match.group(1)]
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(page)))
+            self.end_headers()
+            self.wfile.write(page)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("localhost", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def synthetic_digests(
+    num_users: int, digests_per_user: int, categories: List[str], seed: int = 0
+) -> List[dict]:
+    """
+    `digests` documents for `num_users` users with `digests_per_user` digests
+    each, subscribing to random subjects of the categories with random
+    interests, in the format written by the web app.
+    """
+    rng = random.Random(seed)
+    subject_codes = {
+        category: SUBJECT_CODE_PATTERN.findall(
+            " ".join(listing_fixtures.SUBJECTS.get(category, []))
+        )
+        or [f"{category}.AI"]
+        for category in categories
+    }
+    documents = []
+    for user_index in range(num_users):
+        for digest_index in range(digests_per_user):
+            digest_categories = rng.sample(
+                categories, rng.randint(1, min(3, len(categories)))
+            )
+            topics = [
+                code
+                for category in digest_categories
+                for code in rng.sample(
+                    subject_codes[category],
+                    rng.randint(1, min(3, len(subject_codes[category]))),
+                )
+            ]
+            interests = " ".join(
+                rng.choice(listing_fixtures.WORDS) for _ in range(rng.randint(8, 40))
+            )
+            documents.append(
+                {
+                    "userId": f"user-{user_index:05d}",
+                    "name": f"Digest {digest_index}",
+                    "topics": ", ".join(topics),
+                    "description": interests,
+                    "updatedAt": datetime.datetime.now(datetime.timezone.utc),
+                }
+            )
+    return documents
+
+
+@contextlib.contextmanager
+def firestore_emulator(port: int, project: str):
+    """
+    Starts the Firestore emulator with the gcloud CLI, and points the Firestore
+    clients of this process and its children at it.
+    """
+    import requests
+
+    host = f"localhost:{port}"
+    process = subprocess.Popen(
+        [
+            "gcloud",
+            "emulators",
+            "firestore",
+            "start",
+            f"--host-port={host}",
+            f"--project={project}",
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = time.time() + 120
+        while True:
+            try:
+                if requests.get(f"http://{host}", timeout=1).ok:
+                    break
+            except requests.ConnectionError:
+                pass
+            if process.poll() is not None or time.time() > deadline:
+                raise RuntimeError("The Firestore emulator did not start.")
+            time.sleep(0.5)
+        os.environ["FIRESTORE_EMULATOR_HOST"] = host
+        os.environ["GOOGLE_CLOUD_PROJECT"] = project
+        yield host
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def reset_emulator(documents: List[dict]):
+    """Deletes every document of the emulator, then writes the digests."""
+    import requests
+
+    import firestore_utils
+
+    host = os.environ["FIRESTORE_EMULATOR_HOST"]
+    project = os.environ["GOOGLE_CLOUD_PROJECT"]
+    requests.delete(
+        f"http://{host}/emulator/v1/projects/{project}/databases/(default)/documents",
+        timeout=60,
+    ).raise_for_status()
+
+    db = firestore_utils.get_client()
+    writer = firestore_utils.BatchedWriter(client=db)
+    for document in documents:
+        writer.set(db.collection("digests").document(), document)
+    writer.close()
+    if writer.num_failed:
+        raise RuntimeError(f"Could not write {writer.num_failed} digests to the emulator.")
+
+
+def run_digest_job(main_args: List[str], env: Dict[str, str], log_path: str) -> dict:
+    """
+    Runs the digest job with the arguments, in a fresh process started by
+    `run_population`, and measures it.
+    """
+    # The OpenAI client reads its base URL when it is created.
+    os.environ.update(env)
+    with open(log_path, "w") as log, contextlib.redirect_stdout(
+        log
+    ), contextlib.redirect_stderr(log):
+        import daily_digest_for_all_users
+
+        start = time.perf_counter()
+        daily_digest_for_all_users.main(main_args)
+        elapsed = time.perf_counter() - start
+
+    # ru_maxrss is in KiB on Linux and in bytes on macOS.
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        peak_rss *= 1024
+    return {"elapsed_seconds": elapsed, "peak_rss_mb": peak_rss / 1024 / 1024}
+
+
+def run_population(
+    num_users: int,
+    digests_per_user: int,
+    categories: List[str],
+    arxiv_base_url: str,
+    openai_base_url: str,
+    work_dir: str,
+    job_args: List[str],
+    seed: int = 0,
+) -> dict:
+    """Runs the digest job once for a synthetic population, from empty caches."""
+    documents = synthetic_digests(num_users, digests_per_user, categories, seed)
+    reset_emulator(documents)
+
+    run_dir = os.path.join(work_dir, f"{num_users}x{digests_per_user}")
+    shutil.rmtree(run_dir, ignore_errors=True)
+    os.makedirs(run_dir)
+    metrics_path = os.path.join(run_dir, "metrics.json")
+    main_args = [
+        "--data_dir",
+        os.path.join(run_dir, "data"),
+        "--arxiv_base_url",
+        arxiv_base_url,
+        "--user_snapshot_path",
+        "",
+        "--score_cache_path",
+        "",
+        "--http_cache_path",
+        "",
+        "--journal_path",
+        "",
+        "--metrics_path",
+        metrics_path,
+    ] + job_args
+    env = {
+        "OPENAI_BASE_URL": openai_base_url,
+        "OPENAI_API_KEY": os.getenv("OPENAI_API_KEY", "benchmark"),
+    }
+
+    # A process per run, so that the peak memory is that of the run alone.
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=1, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        result = executor.submit(
+            run_digest_job, main_args, env, os.path.join(run_dir, "job.log")
+        ).result()
+
+    with open(metrics_path, "r") as f:
+        metrics = json.load(f)
+    stages = metrics["stages"]
+    counters = {
+        stage: stats.get("counters", {}) for stage, stats in stages.items()
+    }
+    digest_tokens = [
+        usage
+        for models in metrics["tokens"]["digests"].values()
+        for usage in models.values()
+    ]
+    num_digests = len(documents)
+    candidate_papers = counters.get("filter", {}).get("candidate_papers", 0)
+    elapsed = result["elapsed_seconds"]
+    result.update(
+        {
+            "num_users": num_users,
+            "digests_per_user": digests_per_user,
+            "num_digests": num_digests,
+            "candidate_papers": candidate_papers,
+            "scored_papers": counters.get("prompt", {}).get("papers", 0),
+            "papers_per_second": candidate_papers / elapsed if elapsed else 0.0,
+            "llm_requests": counters.get("llm", {}).get("requests", 0),
+            "llm_retries": counters.get("llm", {}).get("retries", 0),
+            "requests_per_digest": sum(usage["requests"] for usage in digest_tokens)
+            / num_digests,
+            "tokens_per_digest": sum(
+                usage["prompt_tokens"] + usage["completion_tokens"]
+                for usage in digest_tokens
+            )
+            / num_digests,
+            "documents_written": counters.get("firestore", {}).get("documents", 0),
+            "stage_busy_seconds": {
+                stage: stats.get("busy_seconds", 0.0) for stage, stats in stages.items()
+            },
+        }
+    )
+    return result
+
+
+def compare_to_baseline(results: List[dict], baseline: List[dict], max_regression: float):
+    """
+    The regressions of the results compared to a baseline run of the same
+    populations: slower throughput or higher peak memory by more than
+    `max_regression`, or more requests or tokens per digest.
+    """
+    baseline_by_population = {
+        (result["num_users"], result["digests_per_user"]): result for result in baseline
+    }
+    regressions = []
+    for result in results:
+        population = (result["num_users"], result["digests_per_user"])
+        before = baseline_by_population.get(population)
+        if before is None:
+            continue
+        name = f"{population[0]}x{population[1]}"
+        if result["papers_per_second"] < before["papers_per_second"] * (1 - max_regression):
+            regressions.append(
+                f"{name}: {result['papers_per_second']:.1f} papers/s, down from "
+                f"{before['papers_per_second']:.1f}."
+            )
+        if result["peak_rss_mb"] > before["peak_rss_mb"] * (1 + max_regression):
+            regressions.append(
+                f"{name}: {result['peak_rss_mb']:.0f} MB peak memory, up from "
+                f"{before['peak_rss_mb']:.0f}."
+            )
+        for key in ("requests_per_digest", "tokens_per_digest"):
+            if result[key] > before[key] * (1 + max_regression):
+                regressions.append(
+                    f"{name}: {result[key]:.1f} {key.replace('_', ' ')}, up from "
+                    f"{before[key]:.1f}."
+                )
+    return regressions
+
+
+def parse_sizes(value: str) -> List[int]:
+    return [int(size) for size in value.split(",") if size]
+
+
+def main(args_override=None):
+    parser = argparse.ArgumentParser(
+        description="Runs the nightly digest job offline, against recorded or "
+        "synthetic arXiv listings, the fake OpenAI server and the Firestore "
+        "emulator, for synthetic populations of users and digests."
+    )
+    parser.add_argument(
+        "--num_users",
+        type=str,
+        default="10,100",
+        help="Comma separated numbers of users to run the job for.",
+    )
+    parser.add_argument(
+        "--digests_per_user",
+        type=str,
+        default="1,3",
+        help="Comma separated numbers of digests per user. Every combination "
+        "with --num_users is run.",
+    )
+    parser.add_argument(
+        "--pages_dir",
+        type=str,
+        default="",
+        help="Directory of recorded listing pages, named {category}.html. "
+        "Synthetic pages are used when not set.",
+    )
+    parser.add_argument(
+        "--record",
+        type=str,
+        default="",
+        help="Comma separated categories to download from arXiv into "
+        "--pages_dir before running.",
+    )
+    parser.add_argument(
+        "--num_papers",
+        type=int,
+        default=500,
+        help="Number of new papers in each synthetic listing page.",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.5,
+        help="Seconds the fake OpenAI server waits before each chat completion.",
+    )
+    parser.add_argument(
+        "--rate_limit_every",
+        type=int,
+        default=0,
+        help="Answer every Nth chat completion with a 429. 0 never does.",
+    )
+    parser.add_argument(
+        "--start_emulator",
+        action="store_true",
+        help="Start the Firestore emulator with the gcloud CLI, instead of "
+        "using the one in FIRESTORE_EMULATOR_HOST.",
+    )
+    parser.add_argument("--emulator_port", type=int, default=DEFAULT_EMULATOR_PORT)
+    parser.add_argument(
+        "--work_dir",
+        type=str,
+        default="",
+        help="Directory for the data, logs and metrics of each run. A temporary "
+        "directory is used when not set.",
+    )
+    parser.add_argument(
+        "--job_args",
+        type=str,
+        default="--num_workers 16",
+        help="Arguments passed on to daily_digest_for_all_users.py, e.g. "
+        "'--num_workers 16 --profiles_per_prompt 4'.",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output_json",
+        type=str,
+        default="",
+        help="Path to write the results to, to compare later runs against.",
+    )
+    parser.add_argument(
+        "--baseline_json",
+        type=str,
+        default="",
+        help="Results of an earlier run. The benchmark fails when a population "
+        "regressed by more than --max_regression compared to it.",
+    )
+    parser.add_argument("--max_regression", type=float, default=0.1)
+    args = parser.parse_args(args_override)
+
+    if not args.start_emulator and not os.getenv("FIRESTORE_EMULATOR_HOST"):
+        parser.error(
+            "Set FIRESTORE_EMULATOR_HOST to a running Firestore emulator, or "
+            "pass --start_emulator."
+        )
+    os.environ.setdefault("GOOGLE_CLOUD_PROJECT", DEFAULT_PROJECT)
+
+    if args.record:
+        listing_fixtures.record_listing_pages(args.pages_dir, args.record.split(","))
+    if args.pages_dir:
+        pages = listing_fixtures.load_listing_pages(args.pages_dir)
+    else:
+        pages = listing_fixtures.synthetic_listing_pages(args.num_papers)
+    categories = sorted(pages)
+
+    listing_server = start_listing_server(pages)
+    openai_server = fake_openai_server.start_server(
+        latency=args.latency, rate_limit_every=args.rate_limit_every
+    )
+    arxiv_base_url = f"http://localhost:{listing_server.server_address[1]}"
+    openai_base_url = f"http://localhost:{openai_server.server_address[1]}/v1"
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="digest_job_benchmark_")
+
+    emulator = (
+        firestore_emulator(args.emulator_port, os.environ["GOOGLE_CLOUD_PROJECT"])
+        if args.start_emulator
+        else contextlib.nullcontext()
+    )
+    results = []
+    with emulator:
+        for num_users in parse_sizes(args.num_users):
+            for digests_per_user in parse_sizes(args.digests_per_user):
+                print(f"Running {num_users} users x {digests_per_user} digests...")
+                results.append(
+                    run_population(
+                        num_users,
+                        digests_per_user,
+                        categories,
+                        arxiv_base_url,
+                        openai_base_url,
+                        work_dir,
+                        args.job_args.split(),
+                        seed=args.seed,
+                    )
+                )
+    listing_server.shutdown()
+    openai_server.shutdown()
+
+    print(
+        f"{'population':<12} {'papers':>8} {'scored':>8} {'papers/s':>9} "
+        f"{'requests':>9} {'req/dgst':>9} {'tok/dgst':>9} {'retries':>8} "
+        f"{'peak MB':>8} {'seconds':>8}"
+    )
+    for result in results:
+        population = f"{result['num_users']}x{result['digests_per_user']}"
+        print(
+            f"{population:<12} {result['candidate_papers']:>8} "
+            f"{result['scored_papers']:>8} {result['papers_per_second']:>9.1f} "
+            f"{result['llm_requests']:>9} {result['requests_per_digest']:>9.1f} "
+            f"{result['tokens_per_digest']:>9.0f} {result['llm_retries']:>8} "
+            f"{result['peak_rss_mb']:>8.0f} {result['elapsed_seconds']:>8.1f}"
+        )
+    print(f"Logs, data and metrics of each run are in '{work_dir}'.")
+
+    if args.output_json:
+        with open(args.output_json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline_json:
+        with open(args.baseline_json, "r") as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args.max_regression)
+        if regressions:
+            for regression in regressions:
+                print(f"REGRESSION {regression}")
+            sys.exit(1)
+        print(f"No regressions compared to '{args.baseline_json}'.")
+
+
+if __name__ == "__main__":
+    main()
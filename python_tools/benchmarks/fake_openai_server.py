@@ -0,0 +1,393 @@
+import argparse
+import email.parser
+import email.policy
+import itertools
+import json
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# The title field of a paper runs up to its authors line: titles parsed from
+# the listing pages start on the line after "N. Title:".
+TITLE_PATTERN = re.compile(
+    r"^(\d+)\. Title:(.*?)^\1\. Authors:", re.MULTILINE | re.DOTALL
+)
+PROFILE_PATTERN = re.compile(r"^Profile \d+: (.*)$", re.MULTILINE)
+
+
+def _score(title: str, interest: str) -> int:
+    """
+    A score that only depends on the paper and the interest, not on which
+    other papers share the prompt.
+    """
+    return 1 + zlib.crc32(f"{title}\n{interest}".encode("utf-8")) % 10
+
+
+def relevancy_response(prompt: str) -> str:
+    """
+    A deterministic answer to a relevance scoring prompt of the digest job, in
+    the format the prompt asks for: one JSON line per paper, with an entry per
+    profile for multi-profile prompts.
+    """
+    titles = [" ".join(title.split()) for _, title in TITLE_PATTERN.findall(prompt)]
+    profiles = PROFILE_PATTERN.findall(prompt)
+    interests = prompt.split("The papers are:")[0]
+    lines = []
+    for index, title in enumerate(titles):
+        if profiles:
+            entry = {
+                str(profile + 1): {
+                    "Relevancy score": _score(title, interest),
+                    "Reasons for match": f"Paper {index + 1} for profile {profile + 1}.",
+                }
+                for profile, interest in enumerate(profiles)
+            }
+        else:
+            entry = {
+                "Relevancy score": _score(title, interests),
+                "Reasons for match": f"Paper {index + 1} matches the interests.",
+            }
+        lines.append(f"{index + 1}. {json.dumps(entry)}")
+    # The prompt ends with "1.", which the model continues from.
+    return "\n".join(lines)[len("1. ") :] if lines else ""
+
+
+def chat_completion(body: dict, completion_id: str) -> dict:
+    prompt = body["messages"][-1]["content"]
+    content = relevancy_response(prompt)
+    prompt_tokens = sum(len(m["content"]) for m in body["messages"]) // 4
+    completion_tokens = len(content) // 4
+    return {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", ""),
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+                "logprobs": None,
+            }
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+def chat_completion_chunks(body: dict, completion_id: str, chunk_chars: int = 16):
+    """
+    The chunks of a streamed chat completion, with the content split into
+    pieces of `chunk_chars` characters. The content is cut at `max_tokens`
+    when it would exceed it, ending the stream with a "length" finish reason.
+    With `stream_options.include_usage`, a last chunk without choices carries
+    the token usage.
+    """
+    content = relevancy_response(body["messages"][-1]["content"])
+    finish_reason = "stop"
+    max_tokens = body.get("max_tokens")
+    if max_tokens and len(content) // 4 > max_tokens:
+        content = content[: max_tokens * 4]
+        finish_reason = "length"
+
+    def chunk(delta, finish_reason=None):
+        return {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": body.get("model", ""),
+            "choices": [
+                {
+                    "index": 0,
+                    "delta": delta,
+                    "finish_reason": finish_reason,
+                    "logprobs": None,
+                }
+            ],
+        }
+
+    yield chunk({"role": "assistant", "content": ""})
+    for start in range(0, len(content), chunk_chars):
+        yield chunk({"content": content[start : start + chunk_chars]})
+    yield chunk({}, finish_reason)
+    if (body.get("stream_options") or {}).get("include_usage"):
+        prompt_tokens = sum(len(m["content"]) for m in body["messages"]) // 4
+        completion_tokens = len(content) // 4
+        usage_chunk = chunk({})
+        usage_chunk["choices"] = []
+        usage_chunk["usage"] = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+        yield usage_chunk
+
+
+class FakeOpenAIState:
+    """The uploaded files, batches and request counters of the fake server."""
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        batch_delay: float = 0.0,
+        rate_limit_every: int = 0,
+    ):
+        self.latency = latency
+        self.batch_delay = batch_delay
+        self.rate_limit_every = rate_limit_every
+        self.num_rate_limited = 0
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        self.files = {}
+        self.batches = {}
+        self.num_chat_completions = 0
+
+    def next_id(self, prefix: str) -> str:
+        return f"{prefix}-{next(self.ids)}"
+
+    def add_file(self, content: bytes, filename: str, purpose: str) -> dict:
+        with self.lock:
+            file_id = self.next_id("file")
+            self.files[file_id] = {
+                "content": content,
+                "object": {
+                    "id": file_id,
+                    "object": "file",
+                    "bytes": len(content),
+                    "created_at": int(time.time()),
+                    "filename": filename,
+                    "purpose": purpose,
+                    "status": "processed",
+                },
+            }
+        return self.files[file_id]["object"]
+
+    def create_batch(self, body: dict) -> dict:
+        input_lines = self.files[body["input_file_id"]]["content"].decode("utf-8")
+        output_lines = []
+        for line in input_lines.splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            output_lines.append(
+                json.dumps(
+                    {
+                        "id": self.next_id("batch_req"),
+                        "custom_id": request["custom_id"],
+                        "response": {
+                            "status_code": 200,
+                            "request_id": self.next_id("req"),
+                            "body": chat_completion(
+                                request["body"], self.next_id("chatcmpl")
+                            ),
+                        },
+                        "error": None,
+                    }
+                )
+            )
+        output_file = self.add_file(
+            "\n".join(output_lines).encode("utf-8") + b"\n", "output.jsonl", "batch_output"
+        )
+        with self.lock:
+            batch_id = self.next_id("batch")
+            self.batches[batch_id] = {
+                "ready_at": time.time() + self.batch_delay,
+                "object": {
+                    "id": batch_id,
+                    "object": "batch",
+                    "endpoint": body["endpoint"],
+                    "input_file_id": body["input_file_id"],
+                    "completion_window": body["completion_window"],
+                    "status": "in_progress",
+                    "output_file_id": None,
+                    "error_file_id": None,
+                    "created_at": int(time.time()),
+                    "request_counts": {
+                        "total": len(output_lines),
+                        "completed": 0,
+                        "failed": 0,
+                    },
+                },
+                "output_file_id": output_file["id"],
+            }
+        return self.batch(batch_id)
+
+    def batch(self, batch_id: str) -> dict:
+        with self.lock:
+            batch = self.batches[batch_id]
+            if time.time() >= batch["ready_at"]:
+                batch["object"]["status"] = "completed"
+                batch["object"]["output_file_id"] = batch["output_file_id"]
+                counts = batch["object"]["request_counts"]
+                counts["completed"] = counts["total"]
+            return dict(batch["object"])
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    state: FakeOpenAIState = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, payload: dict, status: int = 200):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_stream(self, chunks):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for chunk in chunks:
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_POST(self):
+        if self.path == "/v1/chat/completions":
+            if self.state.latency:
+                time.sleep(self.state.latency)
+            body = json.loads(self._read_body())
+            with self.state.lock:
+                self.state.num_chat_completions += 1
+                rate_limited = (
+                    self.state.rate_limit_every
+                    and self.state.num_chat_completions % self.state.rate_limit_every == 0
+                )
+                if rate_limited:
+                    self.state.num_rate_limited += 1
+            if rate_limited:
+                data = json.dumps(
+                    {"error": {"message": "Rate limit reached.", "type": "requests"}}
+                ).encode("utf-8")
+                self.send_response(429)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.send_header("Retry-After", "1")
+                self.end_headers()
+                self.wfile.write(data)
+                return
+            if body.get("stream"):
+                self._send_stream(
+                    chat_completion_chunks(body, self.state.next_id("chatcmpl"))
+                )
+                return
+            self._send_json(chat_completion(body, self.state.next_id("chatcmpl")))
+        elif self.path == "/v1/files":
+            message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                b"Content-Type: "
+                + self.headers["Content-Type"].encode("utf-8")
+                + b"\r\n\r\n"
+                + self._read_body()
+            )
+            fields = {}
+            for part in message.iter_parts():
+                fields[part.get_param("name", header="content-disposition")] = part
+            file_part = fields["file"]
+            self._send_json(
+                self.state.add_file(
+                    file_part.get_payload(decode=True),
+                    file_part.get_filename() or "upload.jsonl",
+                    fields["purpose"].get_content().strip(),
+                )
+            )
+        elif self.path == "/v1/batches":
+            self._send_json(self.state.create_batch(json.loads(self._read_body())))
+        else:
+            self._send_json({"error": {"message": f"Unknown path {self.path}"}}, 404)
+
+    def do_GET(self):
+        match = re.match(r"^/v1/files/([^/]+)/content$", self.path)
+        if match and match.group(1) in self.state.files:
+            data = self.state.files[match.group(1)]["content"]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        match = re.match(r"^/v1/batches/([^/]+)$", self.path)
+        if match and match.group(1) in self.state.batches:
+            self._send_json(self.state.batch(match.group(1)))
+            return
+        self._send_json({"error": {"message": f"Unknown path {self.path}"}}, 404)
+
+
+def start_server(
+    port: int = 0,
+    latency: float = 0.0,
+    batch_delay: float = 0.0,
+    rate_limit_every: int = 0,
+):
+    """
+    Starts the fake server on a background thread. Point the OpenAI client at
+    it with `OPENAI_BASE_URL=http://localhost:{port}/v1`.
+
+    Returns:
+        The server, whose `server_port` is the port it listens on, and whose
+        `state` holds the request counters.
+    """
+    state = FakeOpenAIState(
+        latency=latency, batch_delay=batch_delay, rate_limit_every=rate_limit_every
+    )
+    handler = type("Handler", (FakeOpenAIHandler,), {"state": state})
+    server = ThreadingHTTPServer(("localhost", port), handler)
+    server.daemon_threads = True
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(args_override=None):
+    parser = argparse.ArgumentParser(
+        description="A local stand-in for the OpenAI chat completions, files and "
+        "batches endpoints, answering the digest relevance prompts."
+    )
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="Seconds to wait before answering each chat completion.",
+    )
+    parser.add_argument(
+        "--batch_delay",
+        type=float,
+        default=5.0,
+        help="Seconds before a submitted batch completes.",
+    )
+    parser.add_argument(
+        "--rate_limit_every",
+        type=int,
+        default=0,
+        help="Answer every Nth chat completion with a 429 and a Retry-After "
+        "header, to exercise the client backoff. 0 never does.",
+    )
+    args = parser.parse_args(args_override)
+
+    server = start_server(
+        args.port, args.latency, args.batch_delay, args.rate_limit_every
+    )
+    print(f"Serving the fake OpenAI API on http://localhost:{server.server_port}/v1")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import argparse
+import os
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+TOOLS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_MODULES = (
+    "daily_digest_for_all_users",
+    "arxiv_digest",
+    "hf_digest",
+    "openai_utils",
+    "openai_batch",
+    "firestore_utils",
+)
+
+# Heavy dependencies the tools only load on first use. Importing one of them
+# at module import time makes every invocation pay for it.
+DEFERRED_MODULES = (
+    "openai",
+    "google.cloud.firestore",
+    "firebase_admin",
+    "tiktoken",
+    "numpy",
+    "scipy",
+    "bs4",
+    "tqdm",
+    "pytz",
+    "asyncio",
+    "lxml",
+)
+
+
+def parse_importtime(stderr: str) -> List[Tuple[str, int, int]]:
+    """
+    The (name, depth, cumulative microseconds) of every import in the
+    `-X importtime` output, in the order the imports finished.
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line.split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        raw_name = fields[2][1:]
+        name = raw_name.lstrip()
+        depth = (len(raw_name) - len(name)) // 2
+        imports.append((name, depth, int(fields[1])))
+    return imports
+
+
+def measure_import(module: str) -> Tuple[float, List[Tuple[str, int, int]]]:
+    """
+    Imports `module` in a fresh interpreter, without an OpenAI API key, and
+    returns its cumulative import time in ms with the imports it triggered.
+    """
+    env = dict(os.environ)
+    env.pop("OPENAI_API_KEY", None)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=TOOLS_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        error = "\n".join(
+            line
+            for line in result.stderr.splitlines()
+            if not line.startswith("import time:")
+        )
+        raise RuntimeError(f"Importing '{module}' failed:\n{error}")
+
+    imports = parse_importtime(result.stderr)
+    # The interpreter's own startup imports come before the module's.
+    for index, (name, depth, cumulative_us) in enumerate(imports):
+        if name == module and depth == 0:
+            start = index
+            while start > 0 and imports[start - 1][1] > 0:
+                start -= 1
+            return cumulative_us / 1000, imports[start : index + 1]
+    raise RuntimeError(f"No import time of '{module}' in the output.")
+
+
+def deferred_imports(imports: List[Tuple[str, int, int]]) -> List[str]:
+    names = {name for name, _, _ in imports}
+    return [
+        module
+        for module in DEFERRED_MODULES
+        if module in names or any(name.startswith(module + ".") for name in names)
+    ]
+
+
+def main(args_override=None):
+    parser = argparse.ArgumentParser(
+        description="Checks the import time of the tools against a startup "
+        "budget, and that heavy dependencies are only imported on first use."
+    )
+    parser.add_argument(
+        "--modules",
+        type=str,
+        default=",".join(DEFAULT_MODULES),
+        help="Comma separated modules of python_tools to import.",
+    )
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument(
+        "--budget_ms",
+        type=float,
+        default=250.0,
+        help="Largest allowed import time of any module, the best of --repeats.",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=5,
+        help="Number of the slowest direct imports to print for each module.",
+    )
+    args = parser.parse_args(args_override)
+
+    failures = []
+    results: Dict[str, float] = {}
+    for module in args.modules.split(","):
+        try:
+            best_ms = float("inf")
+            for _ in range(args.repeats):
+                elapsed_ms, imports = measure_import(module)
+                if elapsed_ms < best_ms:
+                    best_ms, best_imports = elapsed_ms, imports
+        except RuntimeError as e:
+            print(e)
+            failures.append(f"{module} does not import")
+            continue
+        results[module] = best_ms
+
+        print(f"{module}: {best_ms:.1f} ms")
+        direct = [(name, us) for name, depth, us in best_imports if depth == 1]
+        for name, cumulative_us in sorted(direct, key=lambda x: -x[1])[: args.top]:
+            print(f"  {name:<32} {cumulative_us / 1000:>8.1f} ms")
+
+        eager = deferred_imports(best_imports)
+        if eager:
+            failures.append(f"{module} imports {', '.join(eager)} at import time")
+        if best_ms > args.budget_ms:
+            failures.append(
+                f"{module} takes {best_ms:.1f} ms to import, over the "
+                f"{args.budget_ms:.0f} ms budget"
+            )
+
+    if failures:
+        for failure in failures:
+            print(f"FAIL: {failure}.")
+        sys.exit(1)
+    print(
+        f"All {len(results)} modules import in under {args.budget_ms:.0f} ms "
+        f"without their heavy dependencies."
+    )
+
+
+if __name__ == "__main__":
+    main()
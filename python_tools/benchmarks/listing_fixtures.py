@@ -0,0 +1,174 @@
+import html
+import os
+import random
+from typing import Dict
+
+ARXIV_LIST_URL = "https://arxiv.org/list/{}/new"
+
+SUBJECTS = {
+    "cs": [
+        "Computer Vision and Pattern Recognition (cs.CV)",
+        "Artificial Intelligence (cs.AI)",
+        "Computation and Language (cs.CL)",
+        "Machine Learning (cs.LG)",
+        "Robotics (cs.RO)",
+        "Sound (cs.SD)",
+    ],
+    "stat": [
+        "Machine Learning (stat.ML)",
+        "Methodology (stat.ME)",
+        "Applications (stat.AP)",
+    ],
+    "eess": [
+        "Image and Video Processing (eess.IV)",
+        "Audio and Speech Processing (eess.AS)",
+        "Signal Processing (eess.SP)",
+    ],
+}
+
+WORDS = (
+    "diffusion model video image language transformer graph robot learning audio "
+    "speech reinforcement vision token scaling attention latent generative "
+    "benchmark alignment retrieval reasoning multimodal agent policy dataset "
+    "segmentation detection inference efficient sparse kernel quantization "
+    "Schrödinger naïve résumé α-divergence"
+).split()
+
+
+def synthetic_listing_page(
+    category: str = "cs", num_papers: int = 500, seed: int = 0, first_id: int = 0
+) -> bytes:
+    """
+    A `/list/{category}/new` page with random papers, in the arXiv markup.
+
+    The page has the same structure as the real listing, including the cross
+    lists section after the new submissions, comments, inline math, escaped
+    markup and non-ASCII text, so that it exercises the same parsing paths.
+    The arXiv ids of the papers are numbered from `first_id`.
+    """
+    rng = random.Random(seed)
+    subjects = SUBJECTS.get(category, SUBJECTS["cs"]) + [
+        subject for other in SUBJECTS.values() for subject in other
+    ]
+
+    def words(count):
+        return " ".join(rng.choice(WORDS) for _ in range(count))
+
+    def entry(index, arxiv_id):
+        paper_subjects = [rng.choice(SUBJECTS.get(category, SUBJECTS["cs"]))]
+        paper_subjects += rng.sample(subjects, rng.randint(0, 3))
+        authors = ", \n".join(
+            f'<a href="https://arxiv.org/a/author_{rng.randint(1, 9999)}">'
+            f"{html.escape(words(2).title())}</a>"
+            for _ in range(rng.randint(1, 12))
+        )
+        comments = (
+            f"<div class='list-comments mathjax'><span class='descriptor'>Comments:</span>\n"
+            f"          {rng.randint(4, 40)} pages, {rng.randint(1, 12)} figures\n"
+            f"        </div>\n"
+            if rng.random() < 0.6
+            else ""
+        )
+        abstract = (
+            f"{words(rng.randint(20, 80))} $\\mathcal{{O}}(n^{rng.randint(2, 3)})$ "
+            f"{html.escape('<b> & </b>')} {words(rng.randint(40, 160))}."
+        )
+        return f"""<dt>
+        <a name='item{index}'>[{index}]</a>
+        <a href ="/abs/{arxiv_id}" title="Abstract" id="{arxiv_id}">
+          arXiv:{arxiv_id}
+        </a>
+          (<a href="/pdf/{arxiv_id}" title="Download PDF" id="pdf-{arxiv_id}">pdf</a>, <a href="/format/{arxiv_id}" title="Other formats" id="oth-{arxiv_id}">other</a>)
+      </dt>
+      <dd>
+        <div class='meta'>
+          <div class='list-title mathjax'><span class='descriptor'>Title:</span>
+            {html.escape(words(rng.randint(4, 14)).title())}
+          </div>
+          <div class='list-authors'><span class='descriptor'>Authors:</span>
+{authors}
+          </div>
+        {comments}<div class='list-subjects'><span class='descriptor'>Subjects:</span>
+            <span class="primary-subject">{paper_subjects[0]}</span>{"".join("; " + s for s in paper_subjects[1:])}
+          </div>
+          <p class='mathjax'>
+            {abstract}
+          </p>
+        </div>
+      </dd>"""
+
+    num_cross_lists = num_papers // 4
+    new_entries = "\n".join(
+        entry(i + 1, f"2405.{first_id + i:05d}") for i in range(num_papers)
+    )
+    cross_entries = "\n".join(
+        entry(num_papers + i + 1, f"2405.{90000 + first_id + i:05d}")
+        for i in range(num_cross_lists)
+    )
+    page = f"""<!DOCTYPE html>
+<html lang="en">
+<head>
+  <title>{category} new submissions</title>
+  <meta name="viewport" content="width=device-width, initial-scale=1">
+  <meta charset="utf-8">
+</head>
+<body class="with-cu-identity">
+  <div id="header"><h1><a href="/">arXiv.org</a></h1></div>
+  <main>
+  <div id="content">
+  <div id='content-inner'>
+  <div id='dlpage'>
+    <h1>{category} new submissions</h1>
+    <h3>New submissions for Fri, 10 May 24</h3>
+    <dl id='articles'>
+      {new_entries}
+    </dl>
+    <h3>Cross-lists for Fri, 10 May 24</h3>
+    <dl id='articles'>
+      {cross_entries}
+    </dl>
+  </div>
+  </div>
+  </div>
+  </main>
+</body>
+</html>
+"""
+    return page.encode("utf-8")
+
+
+def load_listing_pages(pages_dir: str) -> Dict[str, bytes]:
+    """The recorded listing pages in the directory, by category."""
+    pages = {}
+    for name in sorted(os.listdir(pages_dir)):
+        if name.endswith(".html"):
+            with open(os.path.join(pages_dir, name), "rb") as f:
+                pages[name[: -len(".html")]] = f.read()
+    return pages
+
+
+def record_listing_pages(pages_dir: str, categories):
+    """Downloads the current listing pages of the categories into the directory."""
+    import requests
+
+    os.makedirs(pages_dir, exist_ok=True)
+    for category in categories:
+        response = requests.get(ARXIV_LIST_URL.format(category), timeout=60)
+        response.raise_for_status()
+        with open(os.path.join(pages_dir, f"{category}.html"), "wb") as f:
+            f.write(response.content)
+        print(f"Recorded {len(response.content)} bytes for '{category}'.")
+
+
+def synthetic_listing_pages(num_papers: int = 500) -> Dict[str, bytes]:
+    """
+    A synthetic page for each category, with distinct arXiv ids, so that the
+    papers of one page are not overwritten by those of another in the paper
+    store.
+    """
+    return {
+        category: synthetic_listing_page(
+            category, num_papers, seed, first_id=seed * num_papers
+        )
+        for seed, category in enumerate(SUBJECTS)
+    }
@@ -0,0 +1,143 @@
+import argparse
+import os
+import sys
+import time
+
+from bs4 import BeautifulSoup as bs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import arxiv_listing
+import listing_fixtures
+
+
+def parse_listing_page_bs4(page: bytes):
+    """
+    The BeautifulSoup parsing that `_download_new_papers` used before
+    `arxiv_listing.parse_listing_page`, kept as the reference for parity.
+    """
+    soup = bs(page, features="lxml")
+    content = soup.body.find("div", {"id": "content"})
+
+    dt_list = content.dl.find_all("dt")
+    dd_list = content.dl.find_all("dd")
+    arxiv_base = "https://arxiv.org/abs/"
+
+    assert len(dt_list) == len(dd_list)
+    new_paper_list = []
+    for i in range(len(dt_list)):
+        paper = {}
+
+        paper_number_entries = dt_list[i].text.strip().split(" ")
+        paper_number = None
+        for ent in paper_number_entries:
+            if ent.strip().lower().startswith("arxiv:"):
+                paper_number = ent.strip().split(":")[-1]
+                break
+        assert paper_number, paper_number_entries
+
+        paper["main_page"] = arxiv_base + paper_number
+        paper["pdf"] = arxiv_base.replace("abs", "pdf") + paper_number
+
+        paper["title"] = (
+            dd_list[i]
+            .find("div", {"class": "list-title mathjax"})
+            .text.replace("Title: ", "")
+            .strip()
+        )
+        paper["authors"] = (
+            dd_list[i]
+            .find("div", {"class": "list-authors"})
+            .text.replace("Authors:\n", "")
+            .replace("\n", "")
+            .strip()
+        )
+        paper["subjects"] = (
+            dd_list[i]
+            .find("div", {"class": "list-subjects"})
+            .text.replace("Subjects: ", "")
+            .strip()
+        )
+        paper["abstract"] = (
+            dd_list[i].find("p", {"class": "mathjax"}).text.replace("\n", " ").strip()
+        )
+        new_paper_list.append(paper)
+    return new_paper_list
+
+
+def best_time(parse, page, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        parse(page)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(args_override=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--pages_dir",
+        type=str,
+        default="",
+        help="Directory of recorded listing pages, named {category}.html. "
+        "Synthetic pages are used when not set.",
+    )
+    parser.add_argument(
+        "--record",
+        type=str,
+        default="",
+        help="Comma separated categories to download from arXiv into "
+        "--pages_dir before running.",
+    )
+    parser.add_argument("--num_papers", type=int, default=800)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args(args_override)
+
+    if args.record:
+        listing_fixtures.record_listing_pages(args.pages_dir, args.record.split(","))
+    if args.pages_dir:
+        pages = listing_fixtures.load_listing_pages(args.pages_dir)
+    else:
+        pages = listing_fixtures.synthetic_listing_pages(args.num_papers)
+
+    # Parity first: the new parser must produce exactly the same papers.
+    mismatches = 0
+    for name, page in pages.items():
+        expected = parse_listing_page_bs4(page)
+        actual = arxiv_listing.parse_listing_page(page)
+        if actual != expected:
+            mismatches += 1
+            print(f"MISMATCH on '{name}': {len(actual)} vs {len(expected)} papers.")
+            for got, want in zip(actual, expected):
+                if got != want:
+                    for key in want:
+                        if got.get(key) != want[key]:
+                            print(f"  {key}: {got.get(key)!r} != {want[key]!r}")
+                    break
+
+    print(
+        f"{'page':<12} {'KiB':>8} {'papers':>7} {'bs4 ms':>9} {'lxml ms':>9} {'speedup':>8}"
+    )
+    total_bs4 = total_lxml = 0.0
+    for name, page in pages.items():
+        num_papers = len(arxiv_listing.parse_listing_page(page))
+        bs4_time = best_time(parse_listing_page_bs4, page, args.repeats)
+        lxml_time = best_time(arxiv_listing.parse_listing_page, page, args.repeats)
+        total_bs4 += bs4_time
+        total_lxml += lxml_time
+        print(
+            f"{name:<12} {len(page) / 1024:>8.0f} {num_papers:>7} "
+            f"{bs4_time * 1000:>9.1f} {lxml_time * 1000:>9.1f} "
+            f"{bs4_time / lxml_time:>7.1f}x"
+        )
+    print(f"{'total':<12} {'':>8} {'':>7} {total_bs4 * 1000:>9.1f} {total_lxml * 1000:>9.1f} {total_bs4 / total_lxml:>7.1f}x")
+
+    if mismatches:
+        print(f"{mismatches} of {len(pages)} pages did not match.")
+        sys.exit(1)
+    print(f"All {len(pages)} pages match.")
+
+
+if __name__ == "__main__":
+    main()
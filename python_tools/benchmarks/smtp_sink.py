@@ -0,0 +1,157 @@
+import argparse
+import email
+import email.policy
+import os
+import socketserver
+import threading
+
+
+class SMTPSinkState:
+    """The messages received by the sink, and its failure injection settings."""
+
+    def __init__(self, output_dir: str = "", fail_every: int = 0):
+        self.output_dir = output_dir
+        self.fail_every = fail_every
+        self.lock = threading.Lock()
+        self.messages = []
+        self.num_connections = 0
+        self.num_logins = 0
+        self.num_transactions = 0
+        self.num_failed = 0
+
+    def deliver(self, sender: str, recipients: list, data: bytes):
+        message = email.message_from_bytes(data, policy=email.policy.default)
+        with self.lock:
+            self.messages.append(
+                {"from": sender, "to": list(recipients), "message": message}
+            )
+            index = len(self.messages)
+        if self.output_dir:
+            os.makedirs(self.output_dir, exist_ok=True)
+            with open(os.path.join(self.output_dir, f"{index:06d}.eml"), "wb") as f:
+                f.write(data)
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """
+    Speaks just enough SMTP for `smtplib`: EHLO, AUTH, MAIL, RCPT, DATA, RSET,
+    NOOP and QUIT. Any login is accepted.
+    """
+
+    state: SMTPSinkState = None
+
+    def reply(self, line: str):
+        self.wfile.write(line.encode("utf-8") + b"\r\n")
+
+    def handle(self):
+        with self.state.lock:
+            self.state.num_connections += 1
+        self.reply("220 localhost SMTP sink ready")
+        sender, recipients = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode("utf-8", "replace").strip()
+            verb = command.split(" ", 1)[0].upper()
+            if verb == "EHLO":
+                self.wfile.write(
+                    b"250-localhost\r\n250-AUTH PLAIN\r\n250 8BITMIME\r\n"
+                )
+            elif verb == "HELO":
+                self.reply("250 localhost")
+            elif verb == "AUTH":
+                with self.state.lock:
+                    self.state.num_logins += 1
+                self.reply("235 2.7.0 Authentication successful")
+            elif verb == "MAIL":
+                sender, recipients = command.split(":", 1)[1].strip(), []
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                recipients.append(command.split(":", 1)[1].strip())
+                self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                lines = []
+                while True:
+                    data_line = self.rfile.readline()
+                    if not data_line or data_line in (b".\r\n", b".\n"):
+                        break
+                    if data_line.startswith(b".."):
+                        data_line = data_line[1:]
+                    lines.append(data_line)
+                with self.state.lock:
+                    self.state.num_transactions += 1
+                    failed = (
+                        self.state.fail_every
+                        and self.state.num_transactions % self.state.fail_every == 0
+                    )
+                    if failed:
+                        self.state.num_failed += 1
+                if failed:
+                    self.reply("451 4.3.0 Temporary failure, try again later")
+                else:
+                    self.state.deliver(sender, recipients, b"".join(lines))
+                    self.reply("250 OK queued")
+                sender, recipients = None, []
+            elif verb in ("RSET", "NOOP"):
+                sender, recipients = None, []
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+
+def start_sink(port: int = 0, output_dir: str = "", fail_every: int = 0):
+    """
+    Starts the sink on a background thread. Send to it with
+    `SMTP_HOST=localhost SMTP_PORT={port} SMTP_SECURITY=none`.
+
+    Returns:
+        The server, whose `server_port` is the port it listens on, and whose
+        `state` holds the received messages and counters.
+    """
+    state = SMTPSinkState(output_dir=output_dir, fail_every=fail_every)
+    handler = type("Handler", (SMTPSinkHandler,), {"state": state})
+    server = socketserver.ThreadingTCPServer(("localhost", port), handler)
+    server.daemon_threads = True
+    server.server_port = server.server_address[1]
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(args_override=None):
+    parser = argparse.ArgumentParser(
+        description="A local SMTP server that accepts every email, to test the "
+        "digest emails without sending them."
+    )
+    parser.add_argument("--port", type=int, default=1025)
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        default="",
+        help="Directory to save each received email to as an .eml file.",
+    )
+    parser.add_argument(
+        "--fail_every",
+        type=int,
+        default=0,
+        help="Answer every Nth message with a temporary 451 failure, to exercise "
+        "the mailer retries. 0 never does.",
+    )
+    args = parser.parse_args(args_override)
+
+    server = start_sink(args.port, args.output_dir, args.fail_every)
+    print(f"Accepting emails on localhost:{server.server_port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+        print(f"Received {len(server.state.messages)} emails.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,35 @@
-from bs4 import BeautifulSoup as bs
+import argparse
+import concurrent.futures
+import dataclasses
 from dataclasses import dataclass
 import datetime
-from google.cloud import firestore
+from day_corpus import DayCorpus
+from digest_snapshot import DigestSnapshot
+import firestore_utils
+import functools
+import hashlib
+import html
+import http_utils
 import json
+import mailer
+import math
+from openai_batch import AsyncCompletionJob, OpenAIBatchJob
 import openai_utils
 import os
-import pytz
+from paper_store import PaperStore
+from pipeline_metrics import PipelineMetrics
+from progress_journal import ProgressJournal
+import prompt_packing
 import re
+import requests
+from score_cache import ScoreCache
+import sharding
 import time
-import tqdm
-from typing import List
-import urllib.request
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple, Union
 
-from google.cloud import firestore
-from dataclasses import dataclass
-from typing import List
+# The pre-filter needs numpy and scipy, which are only loaded when it is used.
+if TYPE_CHECKING:
+    from prefilter import LexicalPrefilter
 
 
 RELEVANCY_PROMPT = """
@@ -28,6 +43,36 @@ In the JSON response, make sure to escape any '"' characters inside of the "Reas
 My research interests are:
 """
 
+MULTI_PROFILE_RELEVANCY_PROMPT = """
+You have been asked to read a list of a few arxiv papers, each with title, authors and abstract, and to rate each paper against several numbered research interest profiles.
+For each paper and each profile, give a relevancy score out of 10, based on the research interests of that profile, with a higher score indicating greater relevance. A relevance score more than 7 will need person's attention for details.
+Additionally, for each paper and each profile, please generate 1-2 sentence summary explaining why the paper is relevant to the research interests of that profile.
+Please keep the paper order the same as in the input list, with one json format per paper per line, holding the entry for every profile under the profile number. Example with two profiles is:
+1. {"1": {"Relevancy score": "an integer score out of 10", "Reasons for match": "1-2 sentence short reasonings"}, "2": {"Relevancy score": "an integer score out of 10", "Reasons for match": "1-2 sentence short reasonings"}}
+In the JSON response, make sure to escape any '"' characters inside of the "Reasons for match" text '\\\"'.
+
+The research interest profiles are:
+"""
+
+# Bump this whenever RELEVANCY_PROMPT, MULTI_PROFILE_RELEVANCY_PROMPT or the way
+# papers are encoded into them changes, so that scores cached for the old
+# prompt are not reused.
+RELEVANCY_PROMPT_VERSION = 1
+
+ARXIV_BASE_URL = "https://arxiv.org"
+
+PAPER_STORE_PATH = "./data/papers.sqlite3"
+
+# Where the files of a run are kept under --data_dir, unless given a path.
+DATA_DIR_FILES = {
+    "paper_store_path": "papers.sqlite3",
+    "score_cache_path": "score_cache.sqlite3",
+    "http_cache_path": "http_cache.sqlite3",
+    "journal_path": "progress_journal.sqlite3",
+    "user_snapshot_path": "digest_snapshot.json",
+    "batch_dir": "batch",
+}
+
 
 @dataclass
 class Topic:
@@ -55,6 +100,56 @@ class DigestResult:
     arxiv_id: str
 
 
+@dataclass
+class ScoringContext:
+    """Settings and shared state for every relevance scoring request in a run."""
+
+    model_name: str = "gpt-3.5-turbo-16k"
+    threshold_score: int = 8
+    num_paper_in_prompt: int = 8
+    temperature: float = 0.4
+    top_p: float = 1.0
+    score_cache: Optional[ScoreCache] = None
+    corpus: Optional[DayCorpus] = None
+    prefilter: Optional["LexicalPrefilter"] = None
+    # Packs each request up to the budget instead of `num_paper_in_prompt`
+    # papers, when set.
+    token_budget: Optional[prompt_packing.TokenBudget] = None
+
+    # Work avoided by deduplicating cross-listed papers within each digest.
+    duplicate_papers: int = 0
+    saved_requests: int = 0
+    saved_tokens: int = 0
+
+    # Requests made, compared to packing `num_paper_in_prompt` papers in each.
+    packed_requests: int = 0
+    fixed_requests: int = 0
+    packing_saved_tokens: int = 0
+
+    # Digests sharing their candidate papers are scored together in requests
+    # with up to this many interest profiles.
+    profiles_per_prompt: int = 1
+    multi_profile_saved_requests: int = 0
+    multi_profile_saved_tokens: int = 0
+
+    # Digests submitted for scoring, and how many of them were left once the
+    # copies of the same digest were coalesced.
+    coalesced_digests: int = 0
+    distinct_digests: int = 0
+
+    # Queues the scoring requests to send them all at once, through the OpenAI
+    # Batch API or the async client, instead of one at a time, when set.
+    batch_job: Optional[Union[OpenAIBatchJob, AsyncCompletionJob]] = None
+    # Records the output of every scoring request, and answers the requests
+    # already answered by the run being resumed.
+    journal: Optional[ProgressJournal] = None
+    # Streams the responses of the scoring requests sent one at a time, parsing
+    # each line as soon as it is generated.
+    stream_responses: bool = False
+    # Latencies, counters and token usage of each stage of the run.
+    metrics: PipelineMetrics = dataclasses.field(default_factory=PipelineMetrics)
+
+
 def parse_topics(all_topics: str) -> List[Topic]:
     topics = []
 
@@ -93,25 +188,30 @@ def merge_topics(topics: List[Topic]) -> List[Topic]:
     return list(merged_topics.values())
 
 
-def fetch_all_users() -> List[User]:
-    db = firestore.Client()
-    digests_ref = db.collection("digests")
-    digests = digests_ref.stream()
+def parse_digest_document(digest_data: dict) -> Optional[Tuple[str, Digest]]:
+    """
+    Parses a document of the `digests` collection.
 
-    # First, group digests by user_id
-    user_digests: dict[str, List[Digest]] = {}
-    for digest_doc in digests:
-        digest_data = digest_doc.to_dict()
-        user_id = digest_data.get("userId")
-        if not user_id:
-            continue
+    Returns:
+        Tuple of the owning user id and the digest, or None for documents
+        without a user.
+    """
+    user_id = digest_data.get("userId")
+    if not user_id:
+        return None
+
+    digest = Digest(
+        name=digest_data.get("name", ""),
+        topics=parse_topics(digest_data.get("topics", "")),
+        interests=digest_data.get("description", ""),
+    )
+    return user_id, digest
 
-        digest = Digest(
-            name=digest_data.get("name", ""),
-            topics=parse_topics(digest_data.get("topics", "")),
-            interests=digest_data.get("description", ""),
-        )
 
+def group_digests_by_user(user_digest_pairs) -> List[User]:
+    # First, group digests by user_id
+    user_digests: dict[str, List[Digest]] = {}
+    for user_id, digest in user_digest_pairs:
         if user_id not in user_digests:
             user_digests[user_id] = []
         user_digests[user_id].append(digest)
@@ -124,6 +224,55 @@ def fetch_all_users() -> List[User]:
     return users
 
 
+def fetch_all_users() -> List[User]:
+    db = firestore_utils.get_client()
+    digests_ref = db.collection("digests")
+    digests = digests_ref.stream()
+
+    user_digest_pairs = []
+    for digest_doc in digests:
+        parsed = parse_digest_document(digest_doc.to_dict())
+        if parsed is not None:
+            user_digest_pairs.append(parsed)
+    return group_digests_by_user(user_digest_pairs)
+
+
+def _digest_snapshot_record(digest_data: dict) -> Optional[dict]:
+    parsed = parse_digest_document(digest_data)
+    if parsed is None:
+        return None
+    user_id, digest = parsed
+    return {"userId": user_id, "digest": dataclasses.asdict(digest)}
+
+
+def fetch_all_users_from_snapshot(
+    snapshot_path: str, full_sync: bool = False
+) -> List[User]:
+    """
+    Same as `fetch_all_users`, but only reads the digests changed since the
+    previous run from Firestore, and keeps the parsed digests in a local
+    snapshot file between runs.
+    """
+    snapshot = DigestSnapshot(snapshot_path, parse_document=_digest_snapshot_record)
+    snapshot.sync(firestore_utils.get_client(), full=full_sync)
+
+    # Order the digests by document id, the same order as a collection scan.
+    user_digest_pairs = []
+    for _, record in sorted(snapshot.records.items()):
+        digest = record["digest"]
+        user_digest_pairs.append(
+            (
+                record["userId"],
+                Digest(
+                    name=digest["name"],
+                    topics=[Topic(**topic) for topic in digest["topics"]],
+                    interests=digest["interests"],
+                ),
+            )
+        )
+    return group_digests_by_user(user_digest_pairs)
+
+
 def extract_categories_from_users(users: List[User]) -> List[str]:
     categories = set()
 
@@ -134,86 +283,98 @@ def extract_categories_from_users(users: List[User]) -> List[str]:
     return categories
 
 
-def _download_new_papers(field_abbr):
-    NEW_SUB_URL = (
-        f"https://arxiv.org/list/{field_abbr}/new"  # https://arxiv.org/list/cs/new
-    )
-    page = urllib.request.urlopen(NEW_SUB_URL)
-    soup = bs(page, features="lxml")
-    content = soup.body.find("div", {"id": "content"})
-
-    # find the first h3 element in content
-    h3 = content.find("h3").text  # e.g: New submissions for Wed, 10 May 23
-    date = h3.replace("New submissions for", "").strip()
-
-    dt_list = content.dl.find_all("dt")
-    dd_list = content.dl.find_all("dd")
-    arxiv_base = "https://arxiv.org/abs/"
-
-    assert len(dt_list) == len(dd_list)
-    new_paper_list = []
-    for i in tqdm.tqdm(range(len(dt_list)), leave=False):
-        paper = {}
-
-        paper_number_entries = dt_list[i].text.strip().split(" ")
-        paper_number = None
-        for ent in paper_number_entries:
-            if ent.strip().lower().startswith("arxiv:"):
-                paper_number = ent.strip().split(":")[-1]
-                break
-        assert paper_number, paper_number_entries
-
-        paper["main_page"] = arxiv_base + paper_number
-        paper["pdf"] = arxiv_base.replace("abs", "pdf") + paper_number
-
-        paper["title"] = (
-            dd_list[i]
-            .find("div", {"class": "list-title mathjax"})
-            .text.replace("Title: ", "")
-            .strip()
-        )
-        paper["authors"] = (
-            dd_list[i]
-            .find("div", {"class": "list-authors"})
-            .text.replace("Authors:\n", "")
-            .replace("\n", "")
-            .strip()
-        )
-        paper["subjects"] = (
-            dd_list[i]
-            .find("div", {"class": "list-subjects"})
-            .text.replace("Subjects: ", "")
-            .strip()
-        )
-        paper["abstract"] = (
-            dd_list[i].find("p", {"class": "mathjax"}).text.replace("\n", " ").strip()
-        )
-        new_paper_list.append(paper)
-
-    #  check if ./data exist, if not, create it
-    if not os.path.exists("./data"):
-        os.makedirs("./data")
-
-    # save new_paper_list to a jsonl file, with each line as the element of a dictionary
-    date = datetime.date.fromtimestamp(
+def listing_date() -> datetime.date:
+    """Today's date in New York, the date of the arXiv listings announced today."""
+    import pytz
+
+    return datetime.date.fromtimestamp(
         datetime.datetime.now(tz=pytz.timezone("America/New_York")).timestamp()
     )
-    date = date.strftime("%a, %d %b %y")
-    with open(f"./data/{field_abbr}_{date}.jsonl", "w") as f:
-        for paper in new_paper_list:
-            f.write(json.dumps(paper) + "\n")
-
-
-def get_papers(field_abbr, date, limit=None):
-    date = date.strftime("%a, %d %b %y")
-    if not os.path.exists(f"./data/{field_abbr}_{date}.jsonl"):
-        _download_new_papers(field_abbr)
-    results = []
-    with open(f"./data/{field_abbr}_{date}.jsonl", "r") as f:
-        for i, line in enumerate(f.readlines()):
-            if limit and i == limit:
-                return results
-            results.append(json.loads(line))
+
+
+def _download_new_papers(
+    field_abbr,
+    session: requests.Session = None,
+    validators: http_utils.ValidatorStore = None,
+    base_url: str = ARXIV_BASE_URL,
+    store: PaperStore = None,
+    metrics: PipelineMetrics = None,
+):
+    NEW_SUB_URL = f"{base_url}/list/{field_abbr}/new"  # https://arxiv.org/list/cs/new
+    if session is None:
+        session = http_utils.create_session(pool_size=1)
+    if store is None:
+        store = PaperStore(PAPER_STORE_PATH)
+    if metrics is None:
+        metrics = PipelineMetrics()
+
+    date = listing_date()
+
+    # When the listing has not changed since it was last downloaded (e.g. over
+    # the weekend), reuse the papers parsed from it last time. The validators
+    # record the date of the listing each page was stored under.
+    headers = {}
+    previous_date = None
+    if validators is not None:
+        try:
+            previous_date = datetime.date.fromisoformat(
+                validators.output_path(NEW_SUB_URL) or ""
+            )
+        except ValueError:
+            previous_date = None
+        if previous_date and store.has_listing(field_abbr, previous_date):
+            headers = validators.request_headers(NEW_SUB_URL)
+
+    with metrics.timer("download"):
+        response = session.get(
+            NEW_SUB_URL, headers=headers, timeout=http_utils.DEFAULT_TIMEOUT
+        )
+    if response.status_code == 304:
+        print(f"Listing for '{field_abbr}' not modified, reusing {previous_date}")
+        metrics.count("download", "not_modified")
+        if previous_date != date:
+            store.copy_listing(field_abbr, previous_date, date)
+        return
+    response.raise_for_status()
+    metrics.count("download", "listings")
+    metrics.count("download", "bytes", len(response.content))
+
+    # lxml is only loaded by the runs that download a listing.
+    import arxiv_listing
+
+    with metrics.timer("parse"):
+        new_paper_list = arxiv_listing.parse_listing_page(response.content)
+    metrics.count("parse", "papers", len(new_paper_list))
+
+    store.upsert_listing(field_abbr, date, new_paper_list)
+    if validators is not None:
+        validators.update(NEW_SUB_URL, response, date.isoformat())
+
+
+def get_papers(
+    field_abbr,
+    date,
+    limit=None,
+    session: requests.Session = None,
+    validators: http_utils.ValidatorStore = None,
+    base_url: str = ARXIV_BASE_URL,
+    store: PaperStore = None,
+    metrics: PipelineMetrics = None,
+):
+    if store is None:
+        store = PaperStore(PAPER_STORE_PATH)
+    if not store.has_listing(field_abbr, date):
+        _download_new_papers(
+            field_abbr,
+            session=session,
+            validators=validators,
+            base_url=base_url,
+            store=store,
+            metrics=metrics,
+        )
+    elif metrics is not None:
+        metrics.count("download", "stored_listings")
+    results = store.listing(field_abbr, date, limit=limit)
     print(f"Retrieved {len(results)} papers for category '{field_abbr}'")
     return results
 
@@ -233,77 +394,136 @@ def has_subject_fields(query, subjects):
 
 def encode_prompt(query, prompt_papers):
     """Encode multiple prompt instructions into a single string."""
+    prompt = build_prompt(query, prompt_papers)
+    print(prompt)
+    return prompt
+
+
+def build_prompt(query, prompt_papers):
     prompt = RELEVANCY_PROMPT + "\n"
     prompt += query["interest"]
     prompt += "\nThe papers are: \n"
 
     for idx, task_dict in enumerate(prompt_papers):
-        (title, authors, abstract) = (
-            task_dict["title"],
-            task_dict["authors"],
-            task_dict["abstract"],
-        )
-        if not title:
-            raise
-        prompt += f"###\n"
-        prompt += f"{idx + 1}. Title: {title}\n"
-        prompt += f"{idx + 1}. Authors: {authors}\n"
-        prompt += f"{idx + 1}. Abstract: {abstract}\n"
+        prompt += encode_paper(idx, task_dict)
     prompt += f"\n Generate response:\n1."
-    print(prompt)
     return prompt
 
 
-def post_process_chat_gpt_response(paper_data, response, threshold_score=8):
-    selected_data = []
-    if response is None:
-        return []
-    json_items = response.message.content.replace("\n\n", "\n").split("\n")
-    pattern = r"^\d+\. |\\"
-    import pprint
+def build_multi_profile_prompt(queries, prompt_papers):
+    """Encode the papers to score against every query into a single string."""
+    prompt = MULTI_PROFILE_RELEVANCY_PROMPT
+    for idx, query in enumerate(queries):
+        prompt += f"Profile {idx + 1}: {query['interest']}\n"
+    prompt += "\nThe papers are: \n"
 
+    for idx, task_dict in enumerate(prompt_papers):
+        prompt += encode_paper(idx, task_dict)
+    prompt += f"\n Generate response:\n1."
+    return prompt
+
+
+def encode_paper(idx, task_dict):
+    """Encode a single paper of the prompt, numbered from 1."""
+    (title, authors, abstract) = (
+        task_dict["title"],
+        task_dict["authors"],
+        task_dict["abstract"],
+    )
+    if not title:
+        raise
+    prompt = f"###\n"
+    prompt += f"{idx + 1}. Title: {title}\n"
+    prompt += f"{idx + 1}. Authors: {authors}\n"
+    prompt += f"{idx + 1}. Abstract: {abstract}\n"
+    return prompt
+
+
+SCORE_LINE_PATTERN = r"^\d+\. |\\"
+SCORE_LINE_NUMBER_PATTERN = re.compile(r"^\s*(\d+)\.")
+
+
+def parse_score_line(line):
+    """
+    Parses the score item out of a single response line, e.g.
+    '2. {"Relevancy score": 8, "Reasons for match": "..."}'.
+
+    Returns:
+        Tuple of the score item, and whether it was actually parsed from the
+        line, as opposed to a zero score placeholder for a line that failed to
+        parse.
+    """
     # Go line by line, so that an error processing any entry does not take
     # out the whole job.
-    score_items = []
+    try:
+        if "relevancy score" in line.lower():
+            return json.loads(re.sub(SCORE_LINE_PATTERN, "", line)), True
+        return (
+            {
+                "Relevancy score": 0,
+                "Reasons for match": f"No relevancy score in response line '{line}'.",
+            },
+            False,
+        )
 
+    except json.decoder.JSONDecodeError as decode_error:
+        import pprint
+
+        pprint.pprint(re.sub(SCORE_LINE_PATTERN, "", line))
+        print(f"JSON Decode Exception, ignoring entry '{line}': {decode_error}")
+        return (
+            {
+                "Relevancy score": 0,
+                "Reasons for match": "Error processing response.",
+            },
+            False,
+        )
+
+    except Exception as e:
+        print(f"Unknown exception, ignoring entry '{line}': {e}")
+        return (
+            {
+                "Relevancy score": 0,
+                "Reasons for match": "Error processing response.",
+            },
+            False,
+        )
+
+
+def parse_score_items(response):
+    """
+    Parses the per-paper score items out of a chat completion choice.
+
+    Returns:
+        Tuple of the score items, one per response line, and a list of flags
+        marking which of the items were actually parsed from the response, as
+        opposed to the zero score placeholders for lines that failed to parse.
+    """
+    json_items = response.message.content.replace("\n\n", "\n").split("\n")
+    score_items = []
+    parsed = []
     for line in json_items:
-        try:
-            if "relevancy score" in line.lower():
-                score_items.append(json.loads(re.sub(pattern, "", line)))
-            else:
-                score_items.append(
-                    {
-                        "Relevancy score": 0,
-                        "Reasons for match": f"No relevancy score in response line '{line}'.",
-                    }
-                )
+        item, ok = parse_score_line(line)
+        score_items.append(item)
+        parsed.append(ok)
+    return score_items, parsed
 
-        except json.decoder.JSONDecodeError as decode_error:
-            pprint.pprint(re.sub(pattern, "", line))
-            print(f"JSON Decode Exception, ignoring entry '{line}': {decode_error}")
-            score_items.append(
-                {
-                    "Relevancy score": 0,
-                    "Reasons for match": "Error processing response.",
-                }
-            )
 
-        except Exception as e:
-            print(f"Unknown exception, ignoring entry '{line}': {e}")
-            score_items.append(
-                {
-                    "Relevancy score": 0,
-                    "Reasons for match": "Error processing response.",
-                }
-            )
+def relevancy_score_value(score_item) -> int:
+    """The integer relevancy score of a score item, e.g. for "8" or "8/10"."""
+    temp = score_item["Relevancy score"]
+    if isinstance(temp, str) and "/" in temp:
+        return int(temp.split("/")[0])
+    return int(temp)
 
-    scores = []
-    for item in score_items:
-        temp = item["Relevancy score"]
-        if isinstance(temp, str) and "/" in temp:
-            scores.append(int(temp.split("/")[0]))
-        else:
-            scores.append(int(temp))
+
+def select_scored_papers(paper_data, score_items, threshold_score=8):
+    """
+    Attaches the score items to their papers, and keeps the papers scoring at
+    least `threshold_score`.
+    """
+    selected_data = []
+    scores = [relevancy_score_value(item) for item in score_items]
     if len(score_items) != len(paper_data):
         score_items = score_items[: len(paper_data)]
         hallucination = True
@@ -314,65 +534,621 @@ def post_process_chat_gpt_response(paper_data, response, threshold_score=8):
         # if the decoding stops due to length, the last example is likely truncated so we discard it
         if scores[idx] < threshold_score:
             continue
-        output_str = "Title: " + paper_data[idx]["title"] + "\n"
-        output_str += "Authors: " + paper_data[idx]["authors"] + "\n"
-        output_str += "Link: " + paper_data[idx]["main_page"] + "\n"
+        # The papers can be shared with other digests scoring the same day, so
+        # the scores are attached to a copy.
+        paper = dict(paper_data[idx])
+        output_str = "Title: " + paper["title"] + "\n"
+        output_str += "Authors: " + paper["authors"] + "\n"
+        output_str += "Link: " + paper["main_page"] + "\n"
         for key, value in inst.items():
-            paper_data[idx][key] = value
+            paper[key] = value
             output_str += str(key) + ": " + str(value) + "\n"
-        paper_data[idx]["summarized_text"] = output_str
-        selected_data.append(paper_data[idx])
+        paper["summarized_text"] = output_str
+        selected_data.append(paper)
     return selected_data, hallucination
 
 
-def generate_relevance_score(
-    all_papers,
+def parse_score_matrix_line(line, num_profiles):
+    """
+    Parses the score item of every profile out of a single response line of a
+    `build_multi_profile_prompt` prompt.
+
+    Returns:
+        Tuple of the score items, one per profile, and the matching flags
+        marking which of them were actually parsed from the line.
+    """
+    row = {}
+    try:
+        if "relevancy score" in line.lower():
+            row = json.loads(re.sub(SCORE_LINE_PATTERN, "", line))
+        else:
+            print(f"No relevancy score in response line '{line}'.")
+    except json.decoder.JSONDecodeError as decode_error:
+        print(f"JSON Decode Exception, ignoring entry '{line}': {decode_error}")
+    if not isinstance(row, dict):
+        row = {}
+
+    items = []
+    parsed = []
+    for profile in range(num_profiles):
+        item = row.get(str(profile + 1))
+        try:
+            relevancy_score_value(item)
+            ok = True
+        except Exception:
+            item = {
+                "Relevancy score": 0,
+                "Reasons for match": "Error processing response.",
+            }
+            ok = False
+        items.append(item)
+        parsed.append(ok)
+    return items, parsed
+
+
+def parse_score_matrix(response, num_profiles):
+    """
+    Parses the per-paper, per-profile score items out of a chat completion
+    choice for a `build_multi_profile_prompt` prompt.
+
+    Returns:
+        Tuple of the score items for each profile, each with one item per
+        response line, and the matching flags marking which of the items were
+        actually parsed from the response.
+    """
+    json_items = response.message.content.replace("\n\n", "\n").split("\n")
+
+    profile_items = [[] for _ in range(num_profiles)]
+    profile_parsed = [[] for _ in range(num_profiles)]
+    for line in json_items:
+        items, parsed = parse_score_matrix_line(line, num_profiles)
+        for profile in range(num_profiles):
+            profile_items[profile].append(items[profile])
+            profile_parsed[profile].append(parsed[profile])
+    return profile_items, profile_parsed
+
+
+class StreamingScoreParser:
+    """
+    Parses the lines of a streamed response as they arrive.
+
+    Each complete line is parsed with `parse_line` (`parse_score_line`, or
+    `parse_score_matrix_line` bound to the number of profiles), and handed to
+    `on_row` with its index as soon as it is parsed, when it is numbered as
+    the paper at that index. Blank lines are skipped. A final line truncated
+    by `max_tokens` is kept if it still parses, and otherwise dropped, leaving
+    the rows of every line before it.
+
+    Passed as the `stream_callback` of `openai_utils.openai_completion`.
+    """
+
+    def __init__(self, parse_line: Callable, on_row: Optional[Callable] = None):
+        self.parse_line = parse_line
+        self.on_row = on_row
+        self.rows = []
+        self.parsed = []
+        self.truncated = False
+
+    def __call__(self, line: Optional[str], truncated: bool):
+        if line is None:
+            # The request is being retried.
+            self.rows = []
+            self.parsed = []
+            self.truncated = False
+            return
+        if not line.strip():
+            return
+
+        row, parsed = self.parse_line(line)
+        if truncated and not any(parsed if isinstance(parsed, list) else [parsed]):
+            print(f"Dropping response line truncated by max_tokens: '{line}'")
+            self.truncated = True
+            return
+
+        index = len(self.rows)
+        self.rows.append(row)
+        self.parsed.append(parsed)
+        # The first line continues the "1." at the end of the prompt, so it is
+        # not numbered.
+        match = SCORE_LINE_NUMBER_PATTERN.match(line)
+        number = int(match.group(1)) if match else 1
+        if self.on_row is not None and number == index + 1:
+            self.on_row(index, row, parsed)
+
+
+def post_process_chat_gpt_response(
+    paper_data, response, threshold_score=8, num_profiles=None
+):
+    """
+    With `num_profiles`, the response is parsed as a score per paper and
+    profile, and the selected papers are returned for each profile.
+    """
+    if response is None:
+        return []
+    if num_profiles is not None:
+        profile_items, _ = parse_score_matrix(response, num_profiles)
+        return [
+            select_scored_papers(paper_data, score_items, threshold_score)
+            for score_items in profile_items
+        ]
+    score_items, _ = parse_score_items(response)
+    return select_scored_papers(paper_data, score_items, threshold_score)
+
+
+def arxiv_id_for_paper(paper) -> str:
+    return paper["main_page"].strip().split("/")[-1]
+
+
+def split_cached_papers(
+    papers,
     query,
     model_name="gpt-3.5-turbo-16k",
     threshold_score=8,
+    score_cache: ScoreCache = None,
+):
+    """
+    Separates the papers that already have a cached score for the query.
+
+    Returns:
+        Tuple of the scoring output for the cached papers, in the same format
+        as `score_paper_batch`, and the papers that still need to be scored.
+    """
+    if score_cache is None or not papers:
+        return ([], False), papers
+
+    cached_items = score_cache.get_many(
+        [arxiv_id_for_paper(paper) for paper in papers],
+        query["interest"],
+        model_name,
+        RELEVANCY_PROMPT_VERSION,
+    )
+    cached_papers = []
+    uncached_papers = []
+    for paper in papers:
+        if arxiv_id_for_paper(paper) in cached_items:
+            cached_papers.append(paper)
+        else:
+            uncached_papers.append(paper)
+
+    cached_output = select_scored_papers(
+        cached_papers,
+        [cached_items[arxiv_id_for_paper(paper)] for paper in cached_papers],
+        threshold_score=threshold_score,
+    )
+    return cached_output, uncached_papers
+
+
+def pack_prompt_batches(
+    papers,
+    empty_prompt,
+    model_name="gpt-3.5-turbo-16k",
     num_paper_in_prompt=4,
+    token_budget: prompt_packing.TokenBudget = None,
+) -> List[List[dict]]:
+    """
+    Splits the papers into the prompt batches to score, in order.
+
+    Without a token budget every batch has `num_paper_in_prompt` papers.
+    With one, each batch is filled up to the budget using the estimated
+    token count of every paper, so that many short abstracts share a request
+    and long ones do not overflow it. `empty_prompt` is the prompt without
+    any papers, which every batch pays for.
+    """
+    if token_budget is None:
+        return [
+            papers[start : start + num_paper_in_prompt]
+            for start in range(0, len(papers), num_paper_in_prompt)
+        ]
+
+    overhead_tokens = openai_utils.estimate_num_tokens(empty_prompt, model_name)
+    paper_tokens = [
+        # Papers are numbered up to two digits in a packed prompt.
+        openai_utils.estimate_num_tokens(encode_paper(10, paper), model_name)
+        for paper in papers
+    ]
+    return [
+        papers[start:end]
+        for start, end in prompt_packing.pack_batches(
+            paper_tokens, overhead_tokens, token_budget
+        )
+    ]
+
+
+@dataclass
+class ScoringRequest:
+    """A single relevance scoring prompt, and how to turn its response into scores."""
+
+    prompt: str
+    model_name: str
+    decoding_args: openai_utils.OpenAIDecodingArguments
+    # Called with the first choice of the response, or None if the request
+    # failed, and returns the scoring output.
+    process_response: Callable
+    decoding_kwargs: dict = dataclasses.field(
+        # prevent the <|endoftext|> from being generated
+        default_factory=lambda: {"logit_bias": {"100257": -100}}
+    )
+    # Parses the response line by line while it is streamed, when set.
+    stream_parser: Optional[StreamingScoreParser] = None
+    # Fingerprint of everything that determines the output, under which the
+    # output is recorded in the progress journal.
+    journal_key: str = ""
+    # The digests the request scores, which its tokens are accounted to.
+    digest_keys: List[str] = dataclasses.field(default_factory=list)
+
+
+def scoring_request_key(model_name: str, prompt: str, *output_args) -> str:
+    """
+    The journal key of a scoring request, from its prompt and the arguments
+    its output is processed with.
+    """
+    return hashlib.sha256(
+        json.dumps(
+            [RELEVANCY_PROMPT_VERSION, model_name, prompt, *output_args],
+            sort_keys=True,
+        ).encode("utf-8")
+    ).hexdigest()
+
+
+def run_scoring_request(request: ScoringRequest, metrics: PipelineMetrics = None):
+    """
+    Sends the scoring request and processes its response.
+
+    This is the unit of work that gets scheduled on the executor when running
+    with multiple workers, so it must not touch any shared state other than
+    the thread-safe metrics.
+    """
+    if metrics is None:
+        metrics = PipelineMetrics()
+    request_start = time.time()
+    with metrics.timer("llm"):
+        response = openai_utils.openai_completion(
+            prompts=request.prompt,
+            model_name=request.model_name,
+            batch_size=1,
+            decoding_args=request.decoding_args,
+            stream_callback=request.stream_parser,
+            on_retry=lambda error: metrics.count("llm", "retries"),
+            **request.decoding_kwargs,
+        )
+    print(f"Request took {time.time() - request_start:.2f}s")
+    return request.process_response(response)
+
+
+def submit_scoring_request(
+    request: ScoringRequest,
+    executor: concurrent.futures.Executor,
+    context: ScoringContext,
+) -> concurrent.futures.Future:
+    """
+    Schedules the request on the executor, or queues it in the batch job. A
+    request already answered in the run being resumed is not sent again.
+    """
+    journal = context.journal
+    if journal is not None and request.journal_key:
+        output = journal.request_output(
+            request.journal_key,
+            openai_utils.estimate_num_tokens(request.prompt, request.model_name),
+        )
+        if output is not None:
+            context.metrics.count("llm", "journal_reused_requests")
+            return _resolved_future(output)
+    request = _metered_request(request, context.metrics)
+    if journal is not None and request.journal_key:
+        request = _journaled_request(request, journal)
+
+    if context.batch_job is not None:
+        return context.batch_job.add(request)
+    return executor.submit(run_scoring_request, request, context.metrics)
+
+
+def _metered_request(request: ScoringRequest, metrics: PipelineMetrics):
+    """
+    The request, recording the time spent processing its response, its token
+    usage and the responses that did not line up with the prompt.
+    """
+
+    def process_response(response):
+        with metrics.timer("post_process"):
+            output = request.process_response(response)
+        if response is None:
+            metrics.count("llm", "failed_requests")
+            return output
+
+        metrics.count("llm", "requests")
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            prompt_tokens = usage.prompt_tokens
+            completion_tokens = usage.completion_tokens
+        else:
+            # Not every endpoint reports the usage of streamed responses.
+            metrics.count("llm", "estimated_usage")
+            prompt_tokens = openai_utils.estimate_num_tokens(
+                request.prompt, request.model_name
+            )
+            completion_tokens = openai_utils.estimate_num_tokens(
+                response.message.content or "", request.model_name
+            )
+        metrics.record_tokens(
+            request.model_name, prompt_tokens, completion_tokens, request.digest_keys
+        )
+
+        # Multi-profile requests have an output per profile.
+        outputs = output if isinstance(output, list) else [output]
+        metrics.count(
+            "post_process",
+            "hallucinations",
+            sum(1 for _, hallucination in outputs if hallucination),
+        )
+        return output
+
+    return dataclasses.replace(request, process_response=process_response)
+
+
+def _journaled_request(request: ScoringRequest, journal: ProgressJournal):
+    """The request, recording its output in the journal once it is answered."""
+
+    def process_response(response):
+        output = request.process_response(response)
+        # Failed requests are not recorded, so that a resumed run retries them.
+        if response is not None:
+            journal.record_request(request.journal_key, output)
+        return output
+
+    return dataclasses.replace(request, process_response=process_response)
+
+
+def paper_batch_request(
+    prompt_papers,
+    query,
+    model_name="gpt-3.5-turbo-16k",
+    threshold_score=8,
+    output_tokens_per_paper=128,
     temperature=0.4,
     top_p=1.0,
-    sorting=True,
-):
-    ans_data = []
-    request_idx = 1
-    hallucination = False
-    for id in tqdm.tqdm(range(0, len(all_papers), num_paper_in_prompt)):
-        prompt_papers = all_papers[id : id + num_paper_in_prompt]
-        # only sampling from the seed tasks
-        prompt = encode_prompt(query, prompt_papers)
-
-        decoding_args = openai_utils.OpenAIDecodingArguments(
+    score_cache: ScoreCache = None,
+    stream=False,
+) -> ScoringRequest:
+    """
+    The request scoring a single prompt worth of papers against the query.
+
+    Its output is a tuple of the papers above the threshold score, and whether
+    the model returned a different number of entries than papers in the prompt.
+    With `stream`, the response is streamed, and the score of each paper is
+    parsed and cached as soon as its line has been generated.
+    """
+    stream_parser = None
+    if stream:
+
+        def on_row(index, item, ok):
+            if ok and score_cache is not None and index < len(prompt_papers):
+                score_cache.put_many(
+                    {arxiv_id_for_paper(prompt_papers[index]): item},
+                    query["interest"],
+                    model_name,
+                    RELEVANCY_PROMPT_VERSION,
+                )
+
+        stream_parser = StreamingScoreParser(parse_score_line, on_row)
+
+    def process_response(response):
+        if response is None:
+            return [], False
+        if stream_parser is not None:
+            return select_scored_papers(
+                prompt_papers, stream_parser.rows, threshold_score=threshold_score
+            )
+        score_items, parsed = parse_score_items(response)
+        if score_cache is not None and len(score_items) == len(prompt_papers):
+            # Only cache the scores when the response lines up with the prompt,
+            # otherwise the scores may belong to a different paper.
+            score_cache.put_many(
+                {
+                    arxiv_id_for_paper(paper): item
+                    for paper, item, ok in zip(prompt_papers, score_items, parsed)
+                    if ok
+                },
+                query["interest"],
+                model_name,
+                RELEVANCY_PROMPT_VERSION,
+            )
+        return select_scored_papers(
+            prompt_papers, score_items, threshold_score=threshold_score
+        )
+
+    prompt = encode_prompt(query, prompt_papers)
+    return ScoringRequest(
+        prompt=prompt,
+        model_name=model_name,
+        decoding_args=openai_utils.OpenAIDecodingArguments(
             temperature=temperature,
             n=1,
-            max_tokens=128
-            * num_paper_in_prompt,  # The response for each paper should be less than 128 tokens.
+            max_tokens=output_tokens_per_paper
+            * len(prompt_papers),  # The response for each paper should be less than 128 tokens.
             top_p=top_p,
+            stream=stream,
+        ),
+        process_response=process_response,
+        stream_parser=stream_parser,
+        journal_key=scoring_request_key(model_name, prompt, threshold_score),
+    )
+
+
+def score_paper_batch(
+    prompt_papers,
+    query,
+    model_name="gpt-3.5-turbo-16k",
+    threshold_score=8,
+    output_tokens_per_paper=128,
+    temperature=0.4,
+    top_p=1.0,
+    score_cache: ScoreCache = None,
+):
+    """
+    Scores a single prompt worth of papers against the query.
+
+    Returns:
+        Tuple of the papers above the threshold score, and whether the model
+        returned a different number of entries than papers in the prompt.
+    """
+    return run_scoring_request(
+        paper_batch_request(
+            prompt_papers,
+            query,
+            model_name,
+            threshold_score,
+            output_tokens_per_paper,
+            temperature,
+            top_p,
+            score_cache,
         )
-        request_start = time.time()
-        response = openai_utils.openai_completion(
-            prompts=prompt,
-            model_name=model_name,
-            batch_size=1,
-            decoding_args=decoding_args,
-            logit_bias={
-                "100257": -100
-            },  # prevent the <|endoftext|> from being generated
+    )
+
+
+def multi_profile_batch_request(
+    prompt_papers,
+    queries,
+    profile_paper_ids,
+    model_name="gpt-3.5-turbo-16k",
+    threshold_score=8,
+    output_tokens_per_paper=128,
+    temperature=0.4,
+    top_p=1.0,
+    score_cache: ScoreCache = None,
+    stream=False,
+) -> ScoringRequest:
+    """
+    The request scoring a single prompt worth of papers against several
+    queries at once.
+
+    `profile_paper_ids` holds, for each query, the arXiv ids of the papers in
+    the prompt that the query needs scores for. Scores of the other papers are
+    dropped, so that each digest only gets results for its own papers. Its
+    output is a list with the output of `paper_batch_request` for each query.
+    """
+    stream_parser = None
+    if stream:
+
+        def on_row(index, items, parsed):
+            if score_cache is None or index >= len(prompt_papers):
+                return
+            arxiv_id = arxiv_id_for_paper(prompt_papers[index])
+            for query, paper_ids, item, ok in zip(
+                queries, profile_paper_ids, items, parsed
+            ):
+                if ok and arxiv_id in paper_ids:
+                    score_cache.put_many(
+                        {arxiv_id: item},
+                        query["interest"],
+                        model_name,
+                        RELEVANCY_PROMPT_VERSION,
+                    )
+
+        stream_parser = StreamingScoreParser(
+            functools.partial(parse_score_matrix_line, num_profiles=len(queries)),
+            on_row,
         )
 
-        request_duration = time.time() - request_start
+    def process_response(response):
+        if response is None:
+            return [([], False) for _ in queries]
+        if stream_parser is not None:
+            profile_items = [
+                [items[profile] for items in stream_parser.rows]
+                for profile in range(len(queries))
+            ]
+            profile_parsed = [
+                [parsed[profile] for parsed in stream_parser.parsed]
+                for profile in range(len(queries))
+            ]
+        else:
+            profile_items, profile_parsed = parse_score_matrix(response, len(queries))
+
+        outputs = []
+        for query, paper_ids, score_items, parsed in zip(
+            queries, profile_paper_ids, profile_items, profile_parsed
+        ):
+            aligned = len(score_items) == len(prompt_papers)
+            if score_cache is not None and aligned and stream_parser is None:
+                score_cache.put_many(
+                    {
+                        arxiv_id_for_paper(paper): item
+                        for paper, item, ok in zip(prompt_papers, score_items, parsed)
+                        if ok and arxiv_id_for_paper(paper) in paper_ids
+                    },
+                    query["interest"],
+                    model_name,
+                    RELEVANCY_PROMPT_VERSION,
+                )
+            profile_papers = []
+            profile_score_items = []
+            for paper, item in zip(prompt_papers, score_items):
+                if arxiv_id_for_paper(paper) in paper_ids:
+                    profile_papers.append(paper)
+                    profile_score_items.append(item)
+            batch_data, _ = select_scored_papers(
+                profile_papers, profile_score_items, threshold_score=threshold_score
+            )
+            outputs.append((batch_data, not aligned))
+        return outputs
 
-        process_start = time.time()
-        batch_data, hallu = post_process_chat_gpt_response(
-            prompt_papers, response, threshold_score=threshold_score
+    prompt = build_multi_profile_prompt(queries, prompt_papers)
+    print(prompt)
+    return ScoringRequest(
+        prompt=prompt,
+        model_name=model_name,
+        decoding_args=openai_utils.OpenAIDecodingArguments(
+            temperature=temperature,
+            n=1,
+            max_tokens=output_tokens_per_paper * len(prompt_papers) * len(queries),
+            top_p=top_p,
+            stream=stream,
+        ),
+        process_response=process_response,
+        stream_parser=stream_parser,
+        journal_key=scoring_request_key(
+            model_name,
+            prompt,
+            threshold_score,
+            [sorted(paper_ids) for paper_ids in profile_paper_ids],
+        ),
+    )
+
+
+def generate_relevance_score(
+    all_papers,
+    query,
+    model_name="gpt-3.5-turbo-16k",
+    threshold_score=8,
+    num_paper_in_prompt=4,
+    temperature=0.4,
+    top_p=1.0,
+    sorting=True,
+    score_cache: ScoreCache = None,
+    token_budget: prompt_packing.TokenBudget = None,
+):
+    (ans_data, hallucination), all_papers = split_cached_papers(
+        all_papers, query, model_name, threshold_score, score_cache
+    )
+    import tqdm
+
+    prompt_batches = pack_prompt_batches(
+        all_papers, build_prompt(query, []), model_name, num_paper_in_prompt, token_budget
+    )
+    for prompt_papers in tqdm.tqdm(prompt_batches):
+        batch_data, hallu = score_paper_batch(
+            prompt_papers,
+            query,
+            model_name,
+            threshold_score,
+            token_budget.output_tokens_per_paper if token_budget else 128,
+            temperature,
+            top_p,
+            score_cache,
         )
         hallucination = hallucination or hallu
         ans_data.extend(batch_data)
 
-        print(f"Request {request_idx+1} took {request_duration:.2f}s")
-        print(f"Post-processing took {time.time() - process_start:.2f}s")
-
     if sorting:
         ans_data = sorted(
             ans_data, key=lambda x: int(x["Relevancy score"]), reverse=True
@@ -381,33 +1157,38 @@ def generate_relevance_score(
     return ans_data, hallucination
 
 
+def filter_papers_for_category(
+    query, date: datetime.date = None, store: PaperStore = None
+):
+    """
+    Loads the papers listed on the given date in the query subjects from the
+    paper store, across all of the downloaded categories.
+    """
+    if date is None:
+        date = listing_date()
+    if store is None:
+        store = PaperStore(PAPER_STORE_PATH)
+    print("the date for the arxiv data is: ", date)
+
+    all_papers_in_subjects = store.papers_for_subjects(date, query["subjects"])
+    print(f"We found {len(all_papers_in_subjects)} papers in the query subjects.")
+    return all_papers_in_subjects
+
+
 def query_papers_for_category(
     query={
         "interest": "1. Diffusion models for content creation, including image, video and audio diffusion models for generating images, audio including speech and music, and long and short form videos 2. Highlight other, non-diffusion papers related to media audio, image, or video generation 3. Prioritize papers that come out of large research labs like Google and OpenAI 4. Prioritize papers that are open weight models, or open source with a github repository 5. Not interested in papers that focus on specific languages, e.g. Arabic, Chinese, etc.",
         "subjects": ["cs.AI", "cs.CV"],
     },
-    date: str = None,
-    data_dir="data",
+    date: datetime.date = None,
+    store: PaperStore = None,
     model_name="gpt-3.5-turbo-16k",
     threshold_score=8,
     num_paper_in_prompt=8,
     temperature=0.4,
     top_p=1.0,
 ):
-    if date is None:
-        date = datetime.datetime.today().strftime("%a, %d %b %y")
-        # string format such as Wed, 10 May 23
-    print("the date for the arxiv data is: ", date)
-
-    all_papers = [json.loads(l) for l in open(f"{data_dir}/{date}.jsonl", "r")]
-    print(f"We found {len(all_papers)}.")
-
-    all_papers_in_subjects = [
-        t for t in all_papers if has_subject_fields(query["subjects"], t["subjects"])
-    ]
-    print(
-        f"After filtering subjects, we have {len(all_papers_in_subjects)} papers left."
-    )
+    all_papers_in_subjects = filter_papers_for_category(query, date=date, store=store)
     ans_data, hallucination = generate_relevance_score(
         all_papers_in_subjects,
         query,
@@ -425,6 +1206,8 @@ def write_daily_digest_results(
     digest_results: List[DigestResult],
     result_date: datetime.datetime,
     digest_name: str,
+    writer: firestore_utils.BatchedWriter = None,
+    on_committed: Callable[[], None] = None,
 ):
     """
     Writes a list of DigestResult instances to the Firestore collection "daily_digest_results" for a given user ID and date.
@@ -434,9 +1217,11 @@ def write_daily_digest_results(
         digest_results (List[DigestResult]): List of DigestResult instances to write.
         result_date (date): The date associated with the digest results.
         digest_name (str): The name of the digest for grouping results.
+        writer (BatchedWriter): Writer to queue the results on. If not set, the
+            results are committed before returning.
+        on_committed (Callable): Called once all of the results are committed.
     """
-    # Initialize Firestore client
-    db = firestore.Client()
+    db = firestore_utils.get_client()
 
     # Format the date as "YYYY-MM-DD"
     formatted_date = result_date.strftime("%Y-%m-%d")
@@ -450,45 +1235,545 @@ def write_daily_digest_results(
         .collection("results")
     )
 
-    try:
-        # Write each DigestResult to Firestore
-        for digest_result in digest_results:
-            user_digest_collection.add(
+    owns_writer = writer is None
+    if owns_writer:
+        writer = firestore_utils.BatchedWriter(client=db)
+
+    # Each result is named after its paper, so that writing the results of a
+    # resumed digest again replaces them rather than adding duplicates.
+    writer.set_many(
+        [
+            (
+                user_digest_collection.document(
+                    digest_result.arxiv_id.replace("/", "_")
+                ),
                 {
                     "relevancy_score": digest_result.relevancy_score,
                     "reason": digest_result.reason,
                     "arxiv_id": digest_result.arxiv_id,
-                }
+                },
             )
-        print(
-            f"Successfully wrote {len(digest_results)} digest results for user {user_id} on {formatted_date} under digest name '{digest_name}'."
-        )
+            for digest_result in digest_results
+        ],
+        on_committed=on_committed,
+    )
+    print(
+        f"Queued {len(digest_results)} digest results for user {user_id} on {formatted_date} under digest name '{digest_name}'."
+    )
 
-    except Exception as e:
-        print(f"An error occurred while writing digest results: {e}")
+    if owns_writer:
+        writer.close()
 
 
-def generate_digests_for_user(user: User, date: datetime.datetime):
-    for digest in user.digests:
-        generate_digest_for_user_and_topic(userId=user.id, digest=digest, date=date)
+def generate_digests_for_user(
+    user: User,
+    date: datetime.datetime,
+    executor: concurrent.futures.Executor = None,
+    context: ScoringContext = None,
+):
+    if context is None:
+        context = ScoringContext()
+
+    if executor is None:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            generate_digests_for_user(user, date, executor, context)
+        return
+
+    # Copies of the same digest are only scored once.
+    digest_futures = submit_digests_scoring(
+        user.digests,
+        date,
+        executor,
+        context,
+        digest_keys=[f"{user.id}/{digest.name}" for digest in user.digests],
+    )
+    for digest, futures in zip(user.digests, digest_futures):
+        write_digest_scores(user.id, digest, futures, date)
 
 
-def generate_digest_for_user_and_topic(
-    userId: str, digest: Digest, date: datetime.datetime
-):
-    # For each category, generate the relevancy scores
-    all_relevancy_scores = []
-    date_str = date.strftime("%a, %d %b %y")
+def collect_digest_papers(
+    digest: Digest, corpus: DayCorpus, context: ScoringContext
+) -> List[dict]:
+    """
+    The candidate papers of the digest across all of its topics.
 
+    A paper cross-listed in several of the subscribed categories is only kept
+    once, at its first position, so it is scored (and written) once per digest.
+    The work this saves compared to scoring each topic separately is added to
+    the context counters.
+    """
+    papers = []
+    seen_ids = set()
+    topic_requests = 0
+    num_duplicates = 0
+    duplicate_tokens = 0
     for topic in digest.topics:
         subjects = []
         for subtopic in topic.subtopics:
             subjects.append(f"{topic.id}.{subtopic}")
-        relevancy_scores = query_papers_for_category(
-            query={"interest": digest.interests, "subjects": subjects},
-            date=f"{topic.id}_{date_str}",
+        topic_papers = corpus.papers_for_subjects(topic.id, subjects)
+        print(
+            f"Found {len(topic_papers)} papers in subjects {subjects} for digest '{digest.name}'."
+        )
+        topic_requests += math.ceil(len(topic_papers) / context.num_paper_in_prompt)
+
+        for paper in topic_papers:
+            arxiv_id = arxiv_id_for_paper(paper)
+            if arxiv_id in seen_ids:
+                num_duplicates += 1
+                duplicate_tokens += openai_utils.estimate_num_tokens(
+                    encode_paper(0, paper)
+                )
+                continue
+            seen_ids.add(arxiv_id)
+            papers.append(paper)
+
+    saved_requests = topic_requests - math.ceil(
+        len(papers) / context.num_paper_in_prompt
+    )
+    saved_tokens = duplicate_tokens + saved_requests * openai_utils.estimate_num_tokens(
+        RELEVANCY_PROMPT + digest.interests
+    )
+    if num_duplicates:
+        print(
+            f"Skipped {num_duplicates} cross-listed duplicates for digest '{digest.name}', "
+            f"saving {saved_requests} requests and ~{saved_tokens} prompt tokens."
         )
-        all_relevancy_scores.extend(relevancy_scores)
+    context.duplicate_papers += num_duplicates
+    context.saved_requests += saved_requests
+    context.saved_tokens += saved_tokens
+    return papers
+
+
+def prepare_digest_scoring(
+    digest: Digest, date: datetime.datetime, context: ScoringContext
+):
+    """
+    Selects the papers of the digest that need to be scored.
+
+    Returns:
+        Tuple of the query for the digest, the scoring output for the papers
+        answered from the cache, and the papers left to score.
+    """
+    if context.corpus is None:
+        context.corpus = DayCorpus(date, store=PaperStore(PAPER_STORE_PATH))
+    corpus = context.corpus
+
+    metrics = context.metrics
+    with metrics.timer("filter"):
+        papers = collect_digest_papers(digest, corpus, context)
+        num_candidates = len(papers)
+        if context.prefilter is not None:
+            papers = context.prefilter.filter(digest.interests, papers)
+            print(
+                f"Lexical pre-filter kept {len(papers)} of {num_candidates} papers for digest '{digest.name}'."
+            )
+        num_filtered = len(papers)
+        query = {
+            "interest": digest.interests,
+            "subjects": [
+                f"{topic.id}.{subtopic}"
+                for topic in digest.topics
+                for subtopic in topic.subtopics
+            ],
+        }
+
+        cached_output, papers = split_cached_papers(
+            papers,
+            query,
+            context.model_name,
+            context.threshold_score,
+            context.score_cache,
+        )
+    metrics.count("filter", "digests")
+    metrics.count("filter", "candidate_papers", num_candidates)
+    metrics.count("filter", "prefiltered_papers", num_candidates - num_filtered)
+    metrics.count("filter", "cached_papers", num_filtered - len(papers))
+    return query, cached_output, papers
+
+
+def _resolved_future(result) -> concurrent.futures.Future:
+    future = concurrent.futures.Future()
+    future.set_result(result)
+    return future
+
+
+def _profile_future(
+    batch_future: concurrent.futures.Future, profile_index: int
+) -> concurrent.futures.Future:
+    """A future for the output of one profile of a multi-profile batch."""
+    profile_future = concurrent.futures.Future()
+
+    def on_done(future):
+        if future.exception() is not None:
+            profile_future.set_exception(future.exception())
+        else:
+            profile_future.set_result(future.result()[profile_index])
+
+    batch_future.add_done_callback(on_done)
+    return profile_future
+
+
+def _stream_responses(context: ScoringContext) -> bool:
+    # The Batch API and the async client take whole responses.
+    return context.stream_responses and context.batch_job is None
+
+
+def _output_tokens_per_paper(context: ScoringContext) -> int:
+    if context.token_budget is not None:
+        return context.token_budget.output_tokens_per_paper
+    return 128
+
+
+def _record_packing(
+    context: ScoringContext, name: str, num_papers: int, num_batches: int, empty_prompt: str
+):
+    fixed_requests = math.ceil(num_papers / context.num_paper_in_prompt)
+    saved_requests = fixed_requests - num_batches
+    if context.token_budget is not None:
+        print(
+            f"Packed {num_papers} papers into {num_batches} requests for "
+            f"{name}, instead of {fixed_requests}."
+        )
+    context.packed_requests += num_batches
+    context.fixed_requests += fixed_requests
+    context.packing_saved_tokens += saved_requests * openai_utils.estimate_num_tokens(
+        empty_prompt, context.model_name
+    )
+
+
+def submit_digest_scoring(
+    digest: Digest,
+    date: datetime.datetime,
+    executor: concurrent.futures.Executor,
+    context: ScoringContext,
+    digest_keys: List[str] = None,
+) -> List[concurrent.futures.Future]:
+    """
+    Schedules every prompt batch of the digest on the executor. The tokens of
+    its requests are split evenly between `digest_keys`, the keys of every
+    owner of the digest, or accounted to the digest name by default.
+
+    Returns:
+        List[Future]: The scores answered from the cache, followed by one future
+            per prompt batch in paper order. Each future resolves to the output
+            of `score_paper_batch`.
+    """
+    query, cached_output, papers = prepare_digest_scoring(digest, date, context)
+    futures = [_resolved_future(cached_output)]
+    futures.extend(
+        submit_prompt_batches(papers, query, digest, executor, context, digest_keys)
+    )
+    return futures
+
+
+def submit_prompt_batches(
+    papers,
+    query,
+    digest: Digest,
+    executor: concurrent.futures.Executor,
+    context: ScoringContext,
+    digest_keys: List[str] = None,
+) -> List[concurrent.futures.Future]:
+    with context.metrics.timer("prompt"):
+        empty_prompt = build_prompt(query, [])
+        prompt_batches = pack_prompt_batches(
+            papers,
+            empty_prompt,
+            context.model_name,
+            context.num_paper_in_prompt,
+            context.token_budget,
+        )
+        _record_packing(
+            context, f"digest '{digest.name}'", len(papers), len(prompt_batches), empty_prompt
+        )
+        requests = [
+            paper_batch_request(
+                prompt_papers,
+                query,
+                context.model_name,
+                context.threshold_score,
+                _output_tokens_per_paper(context),
+                context.temperature,
+                context.top_p,
+                context.score_cache,
+                stream=_stream_responses(context),
+            )
+            for prompt_papers in prompt_batches
+        ]
+    context.metrics.count("prompt", "requests", len(requests))
+    context.metrics.count("prompt", "papers", len(papers))
+    for request in requests:
+        request.digest_keys = list(digest_keys or [digest.name])
+    return [submit_scoring_request(request, executor, context) for request in requests]
+
+
+def canonical_digest_key(digest: Digest, model_name: str) -> Tuple:
+    """
+    What the scores of a digest depend on: its interests, ignoring case and
+    whitespace, its subjects, in any order, and the model scoring it. Digests
+    with the same key get the same scores, whatever their name or owner.
+    """
+    return (
+        " ".join(digest.interests.split()).casefold(),
+        tuple(
+            sorted(
+                {
+                    f"{topic.id}.{subtopic}"
+                    for topic in merge_topics(digest.topics)
+                    for subtopic in topic.subtopics
+                }
+            )
+        ),
+        model_name,
+    )
+
+
+def coalesce_digests(digests: List[Digest], model_name: str) -> List[List[int]]:
+    """
+    Groups the digests with the same canonical key, e.g. a popular interest
+    description copied between users, so that each group is only scored once.
+
+    Returns:
+        List[List[int]]: The indices of the digests in each group, in the order
+            of their first digest.
+    """
+    digests_by_key = {}
+    for index, digest in enumerate(digests):
+        digests_by_key.setdefault(
+            canonical_digest_key(digest, model_name), []
+        ).append(index)
+    return list(digests_by_key.values())
+
+
+def group_digests_for_scoring(
+    digests: List[Digest], profiles_per_prompt: int
+) -> List[List[int]]:
+    """
+    Groups the digests that subscribe to the same subjects, and so share their
+    candidate papers, into groups of at most `profiles_per_prompt` digests.
+
+    Returns:
+        List[List[int]]: The indices of the digests in each group.
+    """
+    digests_by_subjects = {}
+    for index, digest in enumerate(digests):
+        subjects = tuple(
+            sorted(
+                f"{topic.id}.{subtopic}"
+                for topic in digest.topics
+                for subtopic in topic.subtopics
+            )
+        )
+        digests_by_subjects.setdefault(subjects, []).append(index)
+
+    groups = []
+    for indices in digests_by_subjects.values():
+        for start in range(0, len(indices), profiles_per_prompt):
+            groups.append(indices[start : start + profiles_per_prompt])
+    return groups
+
+
+def submit_digests_scoring(
+    digests: List[Digest],
+    date: datetime.datetime,
+    executor: concurrent.futures.Executor,
+    context: ScoringContext,
+    digest_keys: List[str] = None,
+) -> List[List[concurrent.futures.Future]]:
+    """
+    Schedules the prompt batches of all of the digests on the executor.
+
+    Copies of the same digest, by `canonical_digest_key`, are scored once,
+    and share the futures of the first copy. With `context.profiles_per_prompt`
+    above 1, digests sharing their candidate papers are scored together,
+    sending each batch of abstracts once with the interests of every digest in
+    the group. The tokens of the requests are accounted to `digest_keys`, the
+    digest names by default, split evenly between the copies of a digest.
+
+    Returns:
+        List[List[Future]]: For each digest, the futures in the same format as
+            `submit_digest_scoring`.
+    """
+    if digest_keys is None:
+        digest_keys = [digest.name for digest in digests]
+
+    groups = coalesce_digests(digests, context.model_name)
+    context.coalesced_digests += len(digests)
+    context.distinct_digests += len(groups)
+    context.metrics.count("filter", "coalesced_digests", len(digests) - len(groups))
+    distinct_futures = _submit_distinct_digests_scoring(
+        [digests[group[0]] for group in groups],
+        date,
+        executor,
+        context,
+        [[digest_keys[index] for index in group] for group in groups],
+    )
+
+    digest_futures = [None] * len(digests)
+    for group, futures in zip(groups, distinct_futures):
+        for index in group:
+            digest_futures[index] = futures
+    return digest_futures
+
+
+def _submit_distinct_digests_scoring(
+    digests: List[Digest],
+    date: datetime.datetime,
+    executor: concurrent.futures.Executor,
+    context: ScoringContext,
+    digest_keys: List[List[str]],
+) -> List[List[concurrent.futures.Future]]:
+    profiles_per_prompt = context.profiles_per_prompt
+    token_budget = context.token_budget
+    if token_budget is not None:
+        # The answer for a paper holds a score per profile, and the answer for
+        # at least one paper has to fit in the response budget that the input
+        # budget was computed from.
+        max_profiles = max(
+            1, token_budget.max_output_tokens // token_budget.output_tokens_per_paper
+        )
+        if profiles_per_prompt > max_profiles:
+            print(
+                f"Scoring at most {max_profiles} profiles per prompt, as many as "
+                f"fit in {token_budget.max_output_tokens} output tokens for a paper."
+            )
+            profiles_per_prompt = max_profiles
+    if profiles_per_prompt <= 1:
+        return [
+            submit_digest_scoring(digest, date, executor, context, owner_keys)
+            for digest, owner_keys in zip(digests, digest_keys)
+        ]
+
+    prepared = [prepare_digest_scoring(digest, date, context) for digest in digests]
+    digest_futures = [
+        [_resolved_future(cached_output)] for _, cached_output, _ in prepared
+    ]
+    for group in group_digests_for_scoring(digests, profiles_per_prompt):
+        if len(group) == 1:
+            (index,) = group
+            query, _, papers = prepared[index]
+            digest_futures[index].extend(
+                submit_prompt_batches(
+                    papers, query, digests[index], executor, context, digest_keys[index]
+                )
+            )
+            continue
+
+        queries = [prepared[index][0] for index in group]
+        papers_by_id = {}
+        profile_paper_ids = []
+        for index in group:
+            _, _, papers = prepared[index]
+            for paper in papers:
+                papers_by_id.setdefault(arxiv_id_for_paper(paper), paper)
+            profile_paper_ids.append({arxiv_id_for_paper(paper) for paper in papers})
+        papers = list(papers_by_id.values())
+        if not papers:
+            continue
+
+        prompt_start = time.perf_counter()
+        empty_prompt = build_multi_profile_prompt(queries, [])
+        token_budget = context.token_budget
+        if token_budget is not None:
+            token_budget = dataclasses.replace(
+                token_budget,
+                output_tokens_per_paper=token_budget.output_tokens_per_paper
+                * len(queries),
+            )
+        prompt_batches = pack_prompt_batches(
+            papers,
+            empty_prompt,
+            context.model_name,
+            context.num_paper_in_prompt,
+            token_budget,
+        )
+        names = ", ".join(f"'{digests[index].name}'" for index in group)
+        _record_packing(
+            context, f"digests {names}", len(papers), len(prompt_batches), empty_prompt
+        )
+
+        # What scoring each digest of the group on its own would have cost.
+        separate_requests = 0
+        separate_tokens = 0
+        for query, (_, _, member_papers) in zip(queries, (prepared[i] for i in group)):
+            member_empty_prompt = build_prompt(query, [])
+            member_batches = pack_prompt_batches(
+                member_papers,
+                member_empty_prompt,
+                context.model_name,
+                context.num_paper_in_prompt,
+                context.token_budget,
+            )
+            separate_requests += len(member_batches)
+            separate_tokens += sum(
+                openai_utils.estimate_num_tokens(
+                    build_prompt(query, batch), context.model_name
+                )
+                for batch in member_batches
+            )
+        grouped_tokens = sum(
+            openai_utils.estimate_num_tokens(
+                build_multi_profile_prompt(queries, batch), context.model_name
+            )
+            for batch in prompt_batches
+        )
+        print(
+            f"Scoring digests {names} together in {len(prompt_batches)} requests "
+            f"instead of {separate_requests}."
+        )
+        context.multi_profile_saved_requests += separate_requests - len(
+            prompt_batches
+        )
+        context.multi_profile_saved_tokens += separate_tokens - grouped_tokens
+        context.metrics.observe("prompt", time.perf_counter() - prompt_start)
+        context.metrics.count("prompt", "requests", len(prompt_batches))
+        context.metrics.count("prompt", "papers", len(papers))
+
+        for prompt_papers in prompt_batches:
+            request = multi_profile_batch_request(
+                prompt_papers,
+                queries,
+                profile_paper_ids,
+                context.model_name,
+                context.threshold_score,
+                _output_tokens_per_paper(context),
+                context.temperature,
+                context.top_p,
+                context.score_cache,
+                stream=_stream_responses(context),
+            )
+            request.digest_keys = [
+                digest_key for index in group for digest_key in digest_keys[index]
+            ]
+            batch_future = submit_scoring_request(request, executor, context)
+            for profile_index, index in enumerate(group):
+                digest_futures[index].append(
+                    _profile_future(batch_future, profile_index)
+                )
+    return digest_futures
+
+
+def write_digest_scores(
+    userId: str,
+    digest: Digest,
+    batch_futures: List[concurrent.futures.Future],
+    date: datetime.datetime,
+    writer: firestore_utils.BatchedWriter = None,
+    on_committed: Callable[[List[dict]], None] = None,
+) -> List[dict]:
+    """
+    Waits for all of the scoring batches of a digest, and writes the sorted
+    results to Firestore. `on_committed` is called with the results once they
+    are all committed.
+
+    Returns:
+        List[dict]: The papers above the threshold score, most relevant first.
+    """
+    all_relevancy_scores = []
+    for future in batch_futures:
+        batch_data, _ = future.result()
+        all_relevancy_scores.extend(batch_data)
 
     # Sort by relevance across all topics
     all_relevancy_scores = sorted(
@@ -511,7 +1796,7 @@ def generate_digest_for_user_and_topic(
             DigestResult(
                 relevancy_score=score["Relevancy score"],
                 reason=score["Reasons for match"],
-                arxiv_id=score["main_page"].strip().split("/")[-1],
+                arxiv_id=arxiv_id_for_paper(score),
             )
         )
     write_daily_digest_results(
@@ -519,29 +1804,631 @@ def generate_digest_for_user_and_topic(
         digest_results=digest_results,
         result_date=date,
         digest_name=digest.name,
+        writer=writer,
+        on_committed=(
+            functools.partial(on_committed, all_relevancy_scores)
+            if on_committed is not None
+            else None
+        ),
     )
+    return all_relevancy_scores
+
+
+def fetch_user_emails(user_ids: List[str]) -> Dict[str, str]:
+    """
+    The email address of each user with one, looked up in Firebase
+    Authentication 100 users at a time.
+    """
+    import firebase_admin
+    from firebase_admin import auth
+
+    if not firebase_admin._apps:
+        firebase_admin.initialize_app()
+
+    emails = {}
+    for start in range(0, len(user_ids), 100):
+        result = auth.get_users(
+            [auth.UidIdentifier(user_id) for user_id in user_ids[start : start + 100]]
+        )
+        for user in result.users:
+            if user.email:
+                emails[user.uid] = user.email
+    return emails
+
+
+def render_user_digests_email(
+    digest_scores: List[Tuple[Digest, List[dict]]], date: datetime.date
+) -> str:
+    """The HTML body of the email with the results of all of a user's digests."""
+    parts = [f"<h2>Your arXiv digests for {date.strftime('%Y-%m-%d')}</h2>"]
+    for digest, scores in digest_scores:
+        papers_html, num_papers = mailer.render_papers_html(
+            (
+                {
+                    "title": " ".join(score["title"].split()),
+                    "summary": f"{score['Relevancy score']}/10. "
+                    f"{score['Reasons for match']}",
+                    "link": score["main_page"],
+                }
+                for score in scores
+            ),
+            summary_label="Relevancy",
+        )
+        parts.append(f"<h3>{html.escape(digest.name)}</h3>")
+        parts.append(f"<i>{num_papers} papers found.</i><br>")
+        parts.append(papers_html if num_papers else f"<p>{mailer.NO_PAPERS_TEXT}</p>")
+    return "".join(parts)
+
+
+def email_digest_results(
+    user_scores: Dict[str, List[Tuple[Digest, List[dict]]]],
+    date: datetime.date,
+    num_connections: int = 2,
+):
+    """Emails every user the results of their digests, one email per user."""
+    settings = mailer.SMTPSettings.from_env()
+    emails = fetch_user_emails(list(user_scores))
+    messages = [
+        mailer.build_message(
+            settings.sender_email,
+            emails[user_id],
+            f"Daily Digest: Your arXiv papers for {date.strftime('%Y-%m-%d')}",
+            render_user_digests_email(digest_scores, date),
+        )
+        for user_id, digest_scores in user_scores.items()
+        if user_id in emails
+    ]
+    print(
+        f"Emailing {len(messages)} users, {len(user_scores) - len(messages)} "
+        f"have no email address."
+    )
+    mailer.send_messages(settings, messages, num_connections=num_connections)
+
+
+def generate_digest_for_user_and_topic(
+    userId: str,
+    digest: Digest,
+    date: datetime.datetime,
+    executor: concurrent.futures.Executor = None,
+    context: ScoringContext = None,
+):
+    if context is None:
+        context = ScoringContext()
+
+    if executor is None:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            futures = submit_digest_scoring(digest, date, executor, context)
+            write_digest_scores(userId, digest, futures, date)
+    else:
+        futures = submit_digest_scoring(digest, date, executor, context)
+        write_digest_scores(userId, digest, futures, date)
 
 
 def main(args_override=None):
-    # First fetch all of the users that have a digest defined
-    all_users = fetch_all_users()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=1,
+        help="Number of relevance scoring requests to keep in flight at once, "
+        "across all users and digests.",
+    )
+    parser.add_argument(
+        "--download_workers",
+        type=int,
+        default=4,
+        help="Number of arXiv category listings to download at once.",
+    )
+    parser.add_argument(
+        "--arxiv_base_url",
+        type=str,
+        default=ARXIV_BASE_URL,
+        help="Base URL to download the /list/{category}/new pages from, e.g. a "
+        "local server with recorded pages.",
+    )
+    parser.add_argument(
+        "--data_dir",
+        type=str,
+        default="./data",
+        help="Directory of the paper store, caches, journal and snapshots that "
+        "are not given a path of their own. Shards of a run share it.",
+    )
+    parser.add_argument(
+        "--score_cache_path",
+        type=str,
+        default=None,
+        help="Path of the on-disk relevance score cache, score_cache.sqlite3 "
+        "under data_dir by default. Pass an empty string to disable the cache.",
+    )
+    parser.add_argument("--score_cache_max_entries", type=int, default=500000)
+    parser.add_argument("--score_cache_max_age_days", type=float, default=30)
+    http_utils.add_cache_arguments(parser)
+    parser.set_defaults(http_cache_path=None)
+    parser.add_argument(
+        "--journal_path",
+        type=str,
+        default=None,
+        help="Path of the journal recording the progress of the run, "
+        "progress_journal.sqlite3 under data_dir by default. Pass an empty "
+        "string to disable it.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume the run of the same day from the journal, instead of "
+        "starting over: digests already written are skipped, and scoring "
+        "requests already answered are not sent again.",
+    )
+    parser.add_argument(
+        "--email_digests",
+        action="store_true",
+        help="Email every user the results of their digests, from the account "
+        "in SENDER_EMAIL and SENDER_PASSWORD.",
+    )
+    parser.add_argument(
+        "--smtp_connections",
+        type=int,
+        default=2,
+        help="Number of SMTP connections to send the digest emails over.",
+    )
+    parser.add_argument(
+        "--firestore_batch_size",
+        type=int,
+        default=firestore_utils.MAX_BATCH_SIZE,
+        help="Number of digest results to commit to Firestore in a single batch.",
+    )
+    parser.add_argument(
+        "--firestore_flush_interval",
+        type=float,
+        default=5.0,
+        help="Seconds after which queued digest results are committed to "
+        "Firestore, even if the batch is not full.",
+    )
+    parser.add_argument(
+        "--prefilter_top_k",
+        type=int,
+        default=0,
+        help="Only send the top K papers of each digest, ranked locally by "
+        "TF-IDF similarity to the digest interests, to the LLM. 0 disables it.",
+    )
+    parser.add_argument(
+        "--prefilter_min_similarity",
+        type=float,
+        default=0.0,
+        help="Only send papers with at least this TF-IDF cosine similarity to "
+        "the digest interests to the LLM.",
+    )
+    parser.add_argument(
+        "--user_snapshot_path",
+        type=str,
+        default=None,
+        help="Path of the local snapshot of the parsed digests, which is "
+        "refreshed with only the digests changed since the last run. Pass an "
+        "empty string to read the whole digests collection instead.",
+    )
+    parser.add_argument(
+        "--full_user_sync",
+        action="store_true",
+        help="Re-read the whole digests collection into the snapshot.",
+    )
+    parser.add_argument(
+        "--paper_store_path",
+        type=str,
+        default=None,
+        help="Path of the SQLite store the downloaded papers are saved in.",
+    )
+    parser.add_argument(
+        "--prompt_packing",
+        type=str,
+        choices=["adaptive", "fixed"],
+        default="adaptive",
+        help="Fill each scoring request up to the token budget (adaptive), or "
+        "send a fixed number of papers per request (fixed).",
+    )
+    parser.add_argument(
+        "--max_prompt_tokens",
+        type=int,
+        default=0,
+        help="Token budget of the prompt of each adaptively packed request. 0 "
+        "uses whatever the response budget leaves of the model's context.",
+    )
+    parser.add_argument(
+        "--max_output_tokens",
+        type=int,
+        default=2048,
+        help="Token budget of the response to each adaptively packed request, "
+        "at 128 tokens per paper.",
+    )
+    parser.add_argument(
+        "--profiles_per_prompt",
+        type=int,
+        default=1,
+        help="Score digests that subscribe to the same subjects together, "
+        "sending each batch of papers once with the interests of up to this "
+        "many digests. 1 scores each digest on its own.",
+    )
+    parser.add_argument(
+        "--openai_batch",
+        action="store_true",
+        help="Send all of the scoring requests as OpenAI Batch API jobs and "
+        "wait for them, instead of making one chat completion call each.",
+    )
+    parser.add_argument(
+        "--batch_dir",
+        type=str,
+        default=None,
+        help="Directory the Batch API request files are written to.",
+    )
+    parser.add_argument(
+        "--batch_poll_interval",
+        type=float,
+        default=60.0,
+        help="Seconds between checks of whether the batch jobs have finished.",
+    )
+    parser.add_argument(
+        "--openai_async",
+        action="store_true",
+        help="Send all of the scoring requests concurrently with the async "
+        "OpenAI client, with up to --async_concurrency in flight, within the "
+        "requests and tokens per minute budgets.",
+    )
+    parser.add_argument(
+        "--async_concurrency",
+        type=int,
+        default=16,
+        help="Number of scoring requests --openai_async keeps in flight at once.",
+    )
+    parser.add_argument("--requests_per_minute", type=float, default=3500)
+    parser.add_argument("--tokens_per_minute", type=float, default=90000)
+    parser.add_argument(
+        "--stream_responses",
+        action="store_true",
+        help="Stream the scoring responses, parsing and caching the score of "
+        "each paper as soon as it has been generated.",
+    )
+    parser.add_argument(
+        "--metrics_path",
+        type=str,
+        default=None,
+        help="Path of the JSON summary of the stage latencies, counters and "
+        "token usage of the run, metrics/{date}.json under data_dir by default. "
+        "Pass an empty string to not write it.",
+    )
+    parser.add_argument(
+        "--metrics_port",
+        type=int,
+        default=0,
+        help="Serve the metrics of the run in the Prometheus text format on "
+        "this port at /metrics while it runs. 0 does not serve them.",
+    )
+    parser.add_argument(
+        "--stage",
+        choices=["all", "download", "score", "report"],
+        default="all",
+        help="Part of the run to do: 'download' only downloads the listings "
+        "into the paper store, 'score' scores the digests of --shard, and "
+        "'report' prints the progress of every shard of the day's run.",
+    )
+    parser.add_argument(
+        "--shard",
+        type=int,
+        default=0,
+        help="Index of the shard of users to score, from 0 to num_shards - 1.",
+    )
+    parser.add_argument(
+        "--num_shards",
+        "--num-shards",
+        type=int,
+        default=1,
+        help="Number of shards the users are split into, e.g. one per machine.",
+    )
+    args = parser.parse_args(args_override)
+    if not 0 <= args.shard < args.num_shards:
+        parser.error(f"--shard must be in [0, {args.num_shards}).")
+    if args.resume and args.journal_path == "":
+        parser.error("--resume needs the journal, which --journal_path '' disables.")
+    sharded = args.num_shards > 1
+    if sharded and args.stage == "all":
+        # The shards would all download into the shared paper store and
+        # listing validators at the same time.
+        parser.error(
+            "--num_shards above 1 needs --stage download once, then --stage "
+            "score for each shard."
+        )
+    for name, file_name in DATA_DIR_FILES.items():
+        if getattr(args, name) is None:
+            setattr(args, name, os.path.join(args.data_dir, file_name))
+    if sharded and args.user_snapshot_path:
+        # Each shard keeps its own snapshot, as shards sync at the same time.
+        args.user_snapshot_path += f".shard{args.shard}of{args.num_shards}"
+    if sharded and args.stage != "download":
+        # Shards on different machines must not write the same files, so each
+        # shard keeps its own score cache, journal and Batch API request files.
+        for name in ("score_cache_path", "journal_path", "batch_dir"):
+            if getattr(args, name):
+                setattr(
+                    args, name, f"{getattr(args, name)}.shard{args.shard}of{args.num_shards}"
+                )
+    if args.stage == "score" and not os.path.exists(args.paper_store_path):
+        parser.error(
+            f"--stage score reads the listings of the download stage from "
+            f"'{args.paper_store_path}', which does not exist."
+        )
 
-    # Extract all of the topic categories that we need to download for today
+    date = listing_date()
+    progress_dir = os.path.join(args.data_dir, "shards", date.isoformat())
+    if args.stage == "report":
+        print(sharding.report_shard_progress(progress_dir, args.num_shards))
+        return
+
+    if args.metrics_path is None:
+        metrics_name = date.isoformat()
+        if sharded and args.stage != "download":
+            metrics_name += f".shard{args.shard}of{args.num_shards}"
+        if args.stage != "all":
+            metrics_name += f".{args.stage}"
+        args.metrics_path = os.path.join(
+            args.data_dir, "metrics", f"{metrics_name}.json"
+        )
+    metrics = PipelineMetrics()
+    metrics_server = None
+    if args.metrics_port:
+        metrics_server = metrics.serve(args.metrics_port)
+        print(f"Serving metrics on port {args.metrics_port} at /metrics.")
+
+    # First fetch all of the users that have a digest defined
+    if args.user_snapshot_path:
+        all_users = fetch_all_users_from_snapshot(
+            args.user_snapshot_path, full_sync=args.full_user_sync
+        )
+    else:
+        all_users = fetch_all_users()
+    if sharded and args.stage != "download":
+        all_users = [
+            user
+            for user in all_users
+            if sharding.shard_for_user(user.id, args.num_shards) == args.shard
+        ]
+        print(f"Shard {args.shard}/{args.num_shards} has {len(all_users)} users.")
+
+    # Extract all of the topic categories that we need to download for today.
+    # Listings already in the paper store, e.g. downloaded by the download
+    # stage into the shared data directory, are not downloaded again.
     categories = extract_categories_from_users(all_users)
+
+    # The score stage only reads the paper store, which the shards on other
+    # machines read at the same time, and leaves the downloads to the download
+    # stage.
+    store = PaperStore(args.paper_store_path, read_only=args.stage == "score")
+    if args.stage == "score":
+        missing = sorted(
+            category for category in categories if not store.has_listing(category, date)
+        )
+        if missing:
+            print(
+                f"Skipping categories {missing}, which the download stage did not "
+                f"download for {date}."
+            )
+            metrics.count("download", "missing_listings", len(missing))
+            categories = [category for category in categories if category not in missing]
     print(f"Downloading data for categories: {categories}...")
 
-    # Grab all of the papers for the given categories. This will just download
-    # the metadata to disk.
-    date = datetime.date.fromtimestamp(
-        datetime.datetime.now(tz=pytz.timezone("America/New_York")).timestamp()
+    # The categories are downloaded in parallel over a shared connection pool.
+    # Each category is parsed once, and shared by all of the digests.
+    corpus = DayCorpus(date, store=store)
+    # The score stage does not download anything, so it has no HTTP cache.
+    http_cache = None
+    if args.stage != "score":
+        http_cache = http_utils.cache_from_args(args)
+    session = http_utils.create_session(
+        pool_size=args.download_workers, cache=http_cache
+    )
+    validators = http_utils.ValidatorStore(
+        os.path.join(args.data_dir, "listing_validators.json")
+    )
+    import tqdm
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=args.download_workers
+    ) as download_executor:
+        download_futures = {
+            download_executor.submit(
+                get_papers,
+                field_abbr=category,
+                date=date,
+                session=session,
+                validators=validators,
+                base_url=args.arxiv_base_url,
+                store=store,
+                metrics=metrics,
+            ): category
+            for category in categories
+        }
+        for future in tqdm.tqdm(
+            concurrent.futures.as_completed(download_futures),
+            total=len(download_futures),
+            desc="Downloading papers",
+        ):
+            corpus.add_category(download_futures[future], future.result())
+    if args.stage == "download":
+        print(f"Downloaded {len(categories)} categories into '{args.paper_store_path}'.")
+        if http_cache is not None:
+            print(http_cache.report())
+            http_cache.close()
+        store.close()
+        finish_metrics(metrics, args.metrics_path, metrics_server)
+        return
+
+    # For each user, generate a relevancy score for each of the papers. All of
+    # the prompt batches are queued up front so that the workers stay busy
+    # across digest boundaries, and the results for each digest are written
+    # as soon as its batches complete, in the same order as the users.
+    context = ScoringContext(
+        corpus=corpus,
+        profiles_per_prompt=args.profiles_per_prompt,
+        stream_responses=args.stream_responses,
+        metrics=metrics,
+    )
+    if args.openai_batch:
+        context.batch_job = OpenAIBatchJob(
+            work_dir=args.batch_dir, poll_interval=args.batch_poll_interval
+        )
+    elif args.openai_async:
+        context.batch_job = AsyncCompletionJob(
+            requests_per_minute=args.requests_per_minute,
+            tokens_per_minute=args.tokens_per_minute,
+            max_concurrency=args.async_concurrency,
+            on_retry=lambda error: metrics.count("llm", "retries"),
+        )
+    if args.prompt_packing == "adaptive":
+        context.token_budget = prompt_packing.budget_for_model(
+            context.model_name,
+            max_input_tokens=args.max_prompt_tokens,
+            max_output_tokens=args.max_output_tokens,
+        )
+    if args.prefilter_top_k or args.prefilter_min_similarity > 0:
+        from prefilter import LexicalPrefilter
+
+        context.prefilter = LexicalPrefilter(
+            corpus.all_papers(),
+            top_k=args.prefilter_top_k,
+            min_similarity=args.prefilter_min_similarity,
+        )
+    if args.score_cache_path:
+        context.score_cache = ScoreCache(
+            args.score_cache_path,
+            max_entries=args.score_cache_max_entries,
+            max_age_days=args.score_cache_max_age_days,
+        )
+    written_digests = {}
+    if args.journal_path:
+        run_id = date.isoformat()
+        if sharded:
+            run_id += f"/shard-{args.shard}-of-{args.num_shards}"
+        context.journal = ProgressJournal(
+            args.journal_path, run_id, resume=args.resume
+        )
+        written_digests = context.journal.written_digests()
+
+    writer = firestore_utils.BatchedWriter(
+        max_batch_size=args.firestore_batch_size,
+        flush_interval=args.firestore_flush_interval,
+        metrics=metrics,
+    )
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=args.num_workers
+    ) as executor:
+        # When resuming, the digests already written by the previous attempt
+        # are neither scored nor written again.
+        all_user_digests = [
+            (user, digest) for user in all_users for digest in user.digests
+        ]
+        user_digests = [
+            (user, digest)
+            for user, digest in all_user_digests
+            if (user.id, digest.name) not in written_digests
+        ]
+        if context.journal is not None:
+            context.journal.skipped_digests = len(all_user_digests) - len(user_digests)
+        progress = sharding.ShardProgress(progress_dir, args.shard, args.num_shards)
+        progress.start(len(all_users), len(all_user_digests))
+        digest_futures = iter(
+            submit_digests_scoring(
+                [digest for _, digest in user_digests],
+                date,
+                executor,
+                context,
+                digest_keys=[f"{user.id}/{digest.name}" for user, digest in user_digests],
+            )
+        )
+        if context.batch_job is not None:
+            # The requests are sent and answered together, so the job is timed
+            # as a whole.
+            with metrics.timer("llm_batch"):
+                context.batch_job.run()
+
+        user_scores: Dict[str, List[Tuple[Digest, List[dict]]]] = {}
+        for user, digest in all_user_digests:
+            if (user.id, digest.name) in written_digests:
+                scores = written_digests[(user.id, digest.name)]
+            else:
+                # Each digest is journaled as soon as all of its results are
+                # committed, so that a crash later in the run does not lose it.
+                on_committed = None
+                if context.journal is not None:
+                    on_committed = functools.partial(
+                        journal_digest, context.journal, user.id, digest.name
+                    )
+                scores = write_digest_scores(
+                    user.id, digest, next(digest_futures), date, writer, on_committed
+                )
+                metrics.count("firestore", "digests")
+            progress.digest_done()
+            if args.email_digests:
+                user_scores.setdefault(user.id, []).append((digest, scores))
+
+    writer.close()
+    print(writer.report())
+    if args.email_digests:
+        email_digest_results(user_scores, date, num_connections=args.smtp_connections)
+    print(
+        f"Deduplicated {context.duplicate_papers} cross-listed papers, saving "
+        f"{context.saved_requests} requests and ~{context.saved_tokens} prompt tokens."
     )
+    if context.token_budget is not None:
+        print(
+            f"Adaptive packing made {context.packed_requests} scoring requests instead "
+            f"of {context.fixed_requests} with {context.num_paper_in_prompt} papers per "
+            f"request, saving {context.fixed_requests - context.packed_requests} requests "
+            f"and ~{context.packing_saved_tokens} prompt tokens."
+        )
+    if context.distinct_digests:
+        print(
+            f"Coalesced {context.coalesced_digests} digests into "
+            f"{context.distinct_digests} distinct digests, a coalescing ratio of "
+            f"{context.coalesced_digests / context.distinct_digests:.2f} digests "
+            f"per scored digest."
+        )
+    if context.profiles_per_prompt > 1:
+        print(
+            f"Multi-profile scoring saved {context.multi_profile_saved_requests} "
+            f"requests and ~{context.multi_profile_saved_tokens} prompt tokens "
+            f"compared to scoring each digest on its own."
+        )
+    if context.score_cache is not None:
+        print(context.score_cache.report())
+        context.score_cache.close()
+    if http_cache is not None:
+        print(http_cache.report())
+        http_cache.close()
+    if context.journal is not None:
+        print(context.journal.report())
+        context.journal.close()
+    store.close()
+    progress.finish()
+    if sharded:
+        print(sharding.report_shard_progress(progress_dir, args.num_shards))
+    finish_metrics(metrics, args.metrics_path, metrics_server)
+
+
+def journal_digest(
+    journal: ProgressJournal, user_id: str, digest_name: str, scores: List[dict]
+):
+    journal.record_digests([(user_id, digest_name, scores)])
 
-    for category in tqdm.tqdm(categories, desc="Downloading papers"):
-        get_papers(field_abbr=category, date=date)
 
-    # For each user, generate a relevancy score for each of the papers.
-    for user in all_users:
-        generate_digests_for_user(user=user, date=date)
+def finish_metrics(
+    metrics: PipelineMetrics,
+    metrics_path: str,
+    metrics_server=None,
+):
+    """Reports the metrics of the run, writes their summary and stops serving them."""
+    print(metrics.report())
+    if metrics_path:
+        metrics.write_json(metrics_path)
+        print(f"Wrote the run metrics to '{metrics_path}'.")
+    if metrics_server is not None:
+        metrics_server.shutdown()
 
 
 if __name__ == "__main__":
@@ -1,5 +1,7 @@
 #!/bin/bash
 
+shard_args=()
+
 # Loop through the arguments
 while [[ $# -gt 0 ]]; do
   key="$1"
@@ -25,6 +27,27 @@ while [[ $# -gt 0 ]]; do
       shift
       shift
       ;;
+    --num_workers)
+      num_workers="$2"
+      shift
+      shift
+      ;;
+    --shard|--num_shards|--stage|--data_dir)
+      # Forwarded as is, to run one shard of a multi-machine run.
+      shard_args+=("$1" "$2")
+      shift
+      shift
+      ;;
+    --sender_email)
+      sender_email="$2"
+      shift
+      shift
+      ;;
+    --sender_password)
+      sender_password="$2"
+      shift
+      shift
+      ;;
     *)
       echo "Unknown option $1"
       exit 1
@@ -51,14 +74,23 @@ check_empty "python_script_path" "$python_script_path"
 export OPENAI_API_KEY="$openai_key"
 export GOOGLE_APPLICATION_CREDENTIALS="$firebase_service_account"
 
+# The digests are only emailed when a sender account is given.
+email_args=()
+if [ -n "$sender_email" ]; then
+  check_empty "sender_password" "$sender_password"
+  export SENDER_EMAIL="$sender_email"
+  export SENDER_PASSWORD="$sender_password"
+  email_args=(--email_digests)
+fi
+
 temp_dir=$(mktemp -d)
 echo "Installing in '$temp_dir'"
 python3 -m venv $temp_dir
 source $temp_dir/bin/activate
 python3 -m pip install --upgrade pip
-python3 -m pip install requests lxml openai beautifulsoup4 google-cloud-firestore pytz
+python3 -m pip install requests lxml openai google-cloud-firestore pytz numpy scipy tiktoken firebase-admin
 pushd $python_script_path
-python3 $python_script
+python3 $python_script --num_workers "${num_workers:-1}" "${email_args[@]}" "${shard_args[@]}"
 popd
 deactivate
 rm -rf $temp_dir
\ No newline at end of file
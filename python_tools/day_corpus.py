@@ -0,0 +1,89 @@
+import datetime
+import re
+import threading
+from typing import Dict, List, Tuple
+
+SUBJECT_CODE_PATTERN = re.compile(r"\(([^()]+)\)")
+
+
+def subject_codes(subjects: str) -> List[str]:
+    """
+    Extracts the subject codes from an arXiv subjects line.
+
+    For example "Computer Vision and Pattern Recognition (cs.CV); Artificial
+    Intelligence (cs.AI)" returns ["cs.CV", "cs.AI"].
+    """
+    return [code.strip() for code in SUBJECT_CODE_PATTERN.findall(subjects)]
+
+
+class DayCorpus:
+    """
+    The downloaded arXiv papers for a single day, across all categories.
+
+    The listings added to the corpus are indexed by subject code, so that
+    selecting the papers for a digest is a lookup rather than a scan over the
+    whole listing. The papers of the other listings are queried from the paper
+    store, which only reads the rows under the subjects of the digest, once per
+    set of subjects.
+    """
+
+    def __init__(self, date: datetime.date, store):
+        self.date = date
+        self.store = store
+        self._papers: Dict[str, List[dict]] = {}
+        self._subject_index: Dict[str, Dict[str, List[int]]] = {}
+        self._subject_papers: Dict[Tuple[str, Tuple[str, ...]], List[dict]] = {}
+        self._lock = threading.Lock()
+
+    def add_category(self, category: str, papers: List[dict]):
+        """Adds the already loaded papers of a category to the corpus."""
+        subject_index: Dict[str, List[int]] = {}
+        for position, paper in enumerate(papers):
+            for code in subject_codes(paper["subjects"]):
+                subject_index.setdefault(code, []).append(position)
+
+        with self._lock:
+            self._papers[category] = papers
+            self._subject_index[category] = subject_index
+
+    def papers(self, category: str) -> List[dict]:
+        """All of the papers listed for the category, loading them if needed."""
+        with self._lock:
+            if category in self._papers:
+                return self._papers[category]
+
+        papers = self.store.listing(category, self.date)
+        self.add_category(category, papers)
+        return papers
+
+    def all_papers(self) -> List[dict]:
+        """The papers of every category loaded so far, in category order."""
+        with self._lock:
+            return [paper for papers in self._papers.values() for paper in papers]
+
+    def papers_for_subjects(self, category: str, subjects: List[str]) -> List[dict]:
+        """
+        The papers of the category listed under any of the subjects.
+
+        Papers are returned once each, in listing order. The returned dicts are
+        shared by every caller, so they must not be modified.
+        """
+        key = (category, tuple(sorted(set(subjects))))
+        with self._lock:
+            loaded = category in self._papers
+            if not loaded and key in self._subject_papers:
+                return self._subject_papers[key]
+        if not loaded:
+            papers = self.store.papers_for_subjects(
+                self.date, list(key[1]), category=category
+            )
+            with self._lock:
+                return self._subject_papers.setdefault(key, papers)
+
+        all_papers = self.papers(category)
+        subject_index = self._subject_index[category]
+
+        positions = set()
+        for subject in subjects:
+            positions.update(subject_index.get(subject, []))
+        return [all_papers[position] for position in sorted(positions)]
@@ -0,0 +1,121 @@
+import json
+import os
+import time
+from typing import TYPE_CHECKING, Callable, Dict, Optional
+
+if TYPE_CHECKING:
+    from google.cloud import firestore
+
+# Changes are re-read from a little before the last sync, so that clock skew
+# between the web app, which stamps the documents, and this job cannot make a
+# sync miss a change. Re-reading a change is harmless.
+SYNC_OVERLAP_MS = 10 * 60 * 1000
+
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+class DigestSnapshot:
+    """
+    Locally persisted copy of the parsed `digests` collection.
+
+    The web app stamps every created or updated digest with `updatedAt`, and
+    records every deleted digest in the `digestDeletions` collection, both in
+    milliseconds since the epoch. A sync only reads the documents changed since
+    the previous one, so its cost scales with the number of changed digests
+    rather than the size of the collection. The first sync, and any sync once
+    the last full one is older than `max_full_sync_age_days`, streams the whole
+    collection to pick up documents written without `updatedAt`.
+
+    Each document is stored as the JSON record returned by the `parse_document`
+    callback, or dropped when the callback returns None.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        parse_document: Callable[[dict], Optional[dict]],
+        max_full_sync_age_days: float = 7,
+    ):
+        self.path = path
+        self.parse_document = parse_document
+        self.max_full_sync_age_days = max_full_sync_age_days
+        self.records: Dict[str, dict] = {}
+        self.synced_at: Optional[int] = None
+        self.full_synced_at: Optional[int] = None
+
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                snapshot = json.load(f)
+            self.records = snapshot["records"]
+            self.synced_at = snapshot["synced_at"]
+            self.full_synced_at = snapshot["full_synced_at"]
+
+    def sync(self, client: "firestore.Client", full: bool = False):
+        """Brings the snapshot up to date with Firestore, and saves it."""
+        from google.cloud.firestore_v1.base_query import FieldFilter
+
+        started_at = _now_ms()
+        max_full_sync_age_ms = self.max_full_sync_age_days * 24 * 60 * 60 * 1000
+        if (
+            full
+            or self.synced_at is None
+            or self.full_synced_at is None
+            or started_at - self.full_synced_at > max_full_sync_age_ms
+        ):
+            self.records = {}
+            for digest_doc in client.collection("digests").stream():
+                self._update(digest_doc.id, digest_doc.to_dict())
+            self.full_synced_at = started_at
+            print(f"Digest snapshot: full sync of {len(self.records)} digests.")
+        else:
+            since = self.synced_at - SYNC_OVERLAP_MS
+            num_changed = 0
+            changed = client.collection("digests").where(
+                filter=FieldFilter("updatedAt", ">", since)
+            )
+            for digest_doc in changed.stream():
+                self._update(digest_doc.id, digest_doc.to_dict())
+                num_changed += 1
+
+            num_deleted = 0
+            deleted = client.collection("digestDeletions").where(
+                filter=FieldFilter("deletedAt", ">", since)
+            )
+            for deletion_doc in deleted.stream():
+                if self.records.pop(deletion_doc.id, None) is not None:
+                    num_deleted += 1
+            print(
+                f"Digest snapshot: {num_changed} changed and {num_deleted} deleted "
+                f"digests, {len(self.records)} in total."
+            )
+
+        self.synced_at = started_at
+        self.save()
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        # Write to a temporary file first, so that a crash cannot leave a
+        # truncated snapshot behind.
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(
+                {
+                    "records": self.records,
+                    "synced_at": self.synced_at,
+                    "full_synced_at": self.full_synced_at,
+                },
+                f,
+            )
+        os.replace(temp_path, self.path)
+
+    def _update(self, document_id: str, document: dict):
+        record = self.parse_document(document)
+        if record is None:
+            self.records.pop(document_id, None)
+        else:
+            self.records[document_id] = record
@@ -0,0 +1,166 @@
+import dataclasses
+import threading
+from typing import TYPE_CHECKING, Callable, List, Optional, Tuple
+
+from pipeline_metrics import PipelineMetrics
+
+if TYPE_CHECKING:
+    from google.cloud import firestore
+
+# Firestore rejects write batches with more than 500 operations.
+MAX_BATCH_SIZE = 500
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> "firestore.Client":
+    """
+    The Firestore client shared by the whole process. The Firestore library is
+    only loaded once the client is first needed.
+
+    Like any Firestore client, this connects to the emulator instead of the
+    real project when FIRESTORE_EMULATOR_HOST is set.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            from google.cloud import firestore
+
+            _client = firestore.Client()
+        return _client
+
+
+@dataclasses.dataclass
+class _WriteGroup:
+    remaining: int
+    on_committed: Callable[[], None]
+    failed: bool = False
+
+
+class BatchedWriter:
+    """
+    Buffers document writes and commits them as write batches.
+
+    The pending writes are committed once `max_batch_size` of them are
+    buffered, and otherwise every `flush_interval` seconds by a background
+    thread, so that a slow trickle of results is not held back until the end of
+    the run. A failed commit is reported and counted, and does not stop later
+    writes. Call `close` to commit the remaining writes.
+
+    Writes queued together with `set_many` can be followed by a callback once
+    all of them are committed, e.g. to record that a whole digest was written.
+
+    The latency of every commit, and the documents written and failed, are
+    recorded under the "firestore" stage of `metrics`.
+    """
+
+    def __init__(
+        self,
+        client: "firestore.Client" = None,
+        max_batch_size: int = MAX_BATCH_SIZE,
+        flush_interval: float = 5.0,
+        metrics: PipelineMetrics = None,
+    ):
+        self._client = client if client is not None else get_client()
+        self.metrics = metrics if metrics is not None else PipelineMetrics()
+        self.max_batch_size = min(max_batch_size, MAX_BATCH_SIZE)
+        self.flush_interval = flush_interval
+        self.num_written = 0
+        self.num_failed = 0
+        self.num_commits = 0
+
+        self._lock = threading.Lock()
+        self._pending: List[
+            Tuple["firestore.DocumentReference", dict, Optional[_WriteGroup]]
+        ] = []
+        self._stopped = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+        self._flusher.start()
+
+    def set(self, document_ref: "firestore.DocumentReference", data: dict):
+        """Queues a write of `data` to the document."""
+        self._queue([(document_ref, data, None)])
+
+    def set_many(
+        self,
+        writes: List[Tuple["firestore.DocumentReference", dict]],
+        on_committed: Callable[[], None] = None,
+    ):
+        """
+        Queues the writes of `data` to each document. `on_committed` is called,
+        on the thread committing the last of them, once all of the writes are
+        committed, and never if any of them failed.
+        """
+        if not writes:
+            if on_committed is not None:
+                on_committed()
+            return
+        group = None
+        if on_committed is not None:
+            group = _WriteGroup(len(writes), on_committed)
+        self._queue([(document_ref, data, group) for document_ref, data in writes])
+
+    def _queue(self, writes):
+        for write in writes:
+            commit = None
+            with self._lock:
+                self._pending.append(write)
+                if len(self._pending) >= self.max_batch_size:
+                    commit = self._pending
+                    self._pending = []
+            if commit:
+                self._commit(commit)
+
+    def flush(self):
+        """Commits all of the pending writes."""
+        with self._lock:
+            writes = self._pending
+            self._pending = []
+        for start in range(0, len(writes), self.max_batch_size):
+            self._commit(writes[start : start + self.max_batch_size])
+
+    def close(self):
+        self._stopped.set()
+        self._flusher.join()
+        self.flush()
+
+    def report(self) -> str:
+        return (
+            f"Firestore: {self.num_written} documents written in {self.num_commits} "
+            f"commits, {self.num_failed} failed."
+        )
+
+    def _commit(self, writes):
+        batch = self._client.batch()
+        for document_ref, data, _ in writes:
+            batch.set(document_ref, data)
+        try:
+            with self.metrics.timer("firestore"):
+                batch.commit()
+        except Exception as e:
+            print(f"An error occurred while committing {len(writes)} writes: {e}")
+            self.metrics.count("firestore", "failed_documents", len(writes))
+            with self._lock:
+                self.num_failed += len(writes)
+                for _, _, group in writes:
+                    if group is not None:
+                        group.failed = True
+            return
+        self.metrics.count("firestore", "documents", len(writes))
+        committed_groups = []
+        with self._lock:
+            self.num_written += len(writes)
+            self.num_commits += 1
+            for _, _, group in writes:
+                if group is None:
+                    continue
+                group.remaining -= 1
+                if group.remaining == 0 and not group.failed:
+                    committed_groups.append(group)
+        for group in committed_groups:
+            group.on_committed()
+
+    def _flush_periodically(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
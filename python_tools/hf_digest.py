@@ -1,54 +1,104 @@
 import argparse
-from bs4 import BeautifulSoup
+import concurrent.futures
 from datetime import datetime, timedelta
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+import http_utils
+import mailer
 import requests
-import os
-import smtplib
+import re
+from typing import Dict, List
+import xml.etree.ElementTree as ET
 
 
-def get_arxiv_link(hf_url):
-    response = requests.get(hf_url)
+HF_BASE_URL = "https://huggingface.co"
+ARXIV_API_URL = "http://export.arxiv.org/api/query"
+ATOM_NAMESPACE = "{http://www.w3.org/2005/Atom}"
+
+# Number of ids to look up in a single arXiv API query.
+ARXIV_ID_LIST_SIZE = 100
+
+ARXIV_ID_PATTERN = re.compile(
+    r"(\d{4}\.\d{4,5}|[a-z\-]+(?:\.[A-Z]{2})?/\d{7})(?:v\d+)?"
+)
+HF_PAPER_PATH_PATTERN = re.compile(r"^/papers/" + ARXIV_ID_PATTERN.pattern + "$")
+ARXIV_LINK_PATTERN = re.compile(
+    r"arxiv\.org/(?:abs|pdf)/" + ARXIV_ID_PATTERN.pattern
+)
+
+
+def get_arxiv_id(hf_link: str, session: requests.Session) -> str:
+    """
+    The arXiv id of a Hugging Face paper. Paper pages are named after the arXiv
+    id, so the page is only fetched for links that are not.
+    """
+    match = HF_PAPER_PATH_PATTERN.match(hf_link)
+    if match:
+        return match.group(1)
+
+    hf_url = HF_BASE_URL + hf_link
+    response = session.get(hf_url, timeout=http_utils.DEFAULT_TIMEOUT)
     if response.status_code != 200:
         raise Exception(
             f"Failed to fetch the Hugging Face page: {response.status_code}"
         )
 
-    # Parse the Hugging Face page
-    soup = BeautifulSoup(response.text, "html.parser")
-    for link in soup.find_all("a", href=True):
-        if "arxiv.org" in link["href"]:
-            return link["href"]
+    # The first arXiv link on the page, without building a tree of the page.
+    match = ARXIV_LINK_PATTERN.search(response.text)
+    if match:
+        return match.group(1)
     raise Exception(f"No arXiv link found on the page: {hf_url}.")
 
 
-# Function to retrieve the abstract from an arXiv paper
-def get_arxiv_abstract(arxiv_url):
-    response = requests.get(arxiv_url)
-    if response.status_code != 200:
-        raise Exception(f"Failed to fetch the arXiv page: {response.status_code}")
-
-    # Parse the arXiv abstract page
-    soup = BeautifulSoup(response.text, "html.parser")
-    abstract_tag = soup.find("blockquote", class_="abstract")
-
-    if abstract_tag:
-        return abstract_tag.get_text(strip=True).replace("Abstract:", "").strip()
-    else:
-        raise Exception("Abstract not found on the arXiv page.")
-
-
-def get_yesterday_papers():
+def get_arxiv_abstracts(
+    arxiv_ids: List[str], session: requests.Session
+) -> Dict[str, str]:
+    """
+    The abstract of each paper, by arXiv id, looked up with `id_list` queries of
+    the arXiv API. Papers the API does not know are left out.
+    """
+    abstracts = {}
+    for start in range(0, len(arxiv_ids), ARXIV_ID_LIST_SIZE):
+        id_list = arxiv_ids[start : start + ARXIV_ID_LIST_SIZE]
+        try:
+            response = session.get(
+                ARXIV_API_URL,
+                params={
+                    "id_list": ",".join(id_list),
+                    "start": 0,
+                    "max_results": len(id_list),
+                },
+                timeout=http_utils.DEFAULT_TIMEOUT,
+            )
+            if response.status_code != 200:
+                raise Exception(
+                    f"Failed to query the arXiv API: {response.status_code}"
+                )
+            root = ET.fromstring(response.content)
+        except Exception as e:
+            print(f"Skipping the abstracts of {len(id_list)} papers: {e}")
+            continue
+
+        for entry in root.findall(f"{ATOM_NAMESPACE}entry"):
+            entry_id = entry.findtext(f"{ATOM_NAMESPACE}id") or ""
+            summary = entry.findtext(f"{ATOM_NAMESPACE}summary")
+            match = ARXIV_LINK_PATTERN.search(entry_id)
+            if match and summary:
+                abstracts[match.group(1)] = " ".join(summary.split())
+    return abstracts
+
+
+def get_yesterday_papers(num_workers: int = 8, cache: http_utils.HTTPCache = None):
     start_date = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
-    hf_url = f"https://huggingface.co/papers?date={start_date}"
+    hf_url = f"{HF_BASE_URL}/papers?date={start_date}"
+    session = http_utils.create_session(pool_size=num_workers, cache=cache)
 
     # Fetch the webpage content
-    response = requests.get(hf_url)
+    response = session.get(hf_url, timeout=http_utils.DEFAULT_TIMEOUT)
     if response.status_code != 200:
         raise Exception(f"Failed to fetch the webpage: {response.status_code}")
 
     # Parse the webpage content
+    from bs4 import BeautifulSoup
+
     soup = BeautifulSoup(response.text, "html.parser")
 
     # Find all paper entries
@@ -65,13 +115,36 @@ def get_yesterday_papers():
             link = link_tag["href"]
             paper_data.append((title, link))
 
+    # Resolve the arXiv id of every paper at once, skipping the papers whose
+    # page could not be fetched.
+    arxiv_ids = [None] * len(paper_data)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = {
+            executor.submit(get_arxiv_id, link, session): index
+            for index, (_, link) in enumerate(paper_data)
+        }
+        for future in concurrent.futures.as_completed(futures):
+            index = futures[future]
+            try:
+                arxiv_ids[index] = future.result()
+            except Exception as e:
+                print(f"Skipping '{paper_data[index][0]}': {e}")
+
+    abstracts = get_arxiv_abstracts(
+        list(dict.fromkeys(arxiv_id for arxiv_id in arxiv_ids if arxiv_id)), session
+    )
+
     # Grab all of the extracted papers
     extracted_papers = []
     print("Extracted Paper Titles and Links:")
-    for idx, (title, link) in enumerate(paper_data, 1):
-        hf_paper_url = "https://huggingface.co" + link
-        arxiv_link = get_arxiv_link(hf_paper_url)
-        abstract = get_arxiv_abstract(arxiv_link)
+    for idx, ((title, link), arxiv_id) in enumerate(zip(paper_data, arxiv_ids), 1):
+        if arxiv_id is None:
+            continue
+        if arxiv_id not in abstracts:
+            print(f"Skipping '{title}': abstract not found for {arxiv_id}.")
+            continue
+        arxiv_link = f"https://arxiv.org/abs/{arxiv_id}"
+        abstract = abstracts[arxiv_id]
         print(f"\nAbstract:\n{abstract}")
         print(f"{idx}. Title: {title}\n   Link: {link} Arxiv Link: {arxiv_link}")
         extracted_papers.append(
@@ -81,47 +154,25 @@ def get_yesterday_papers():
                 "link": arxiv_link,
             }
         )
+    print(f"Extracted {len(extracted_papers)} of {len(paper_data)} papers.")
 
     return extracted_papers
 
 
 def send_email(papers, recipient_email: str, subject_title: str, header_title: str):
-    # Get email credentials from environment variables
-    sender_email = os.getenv("SENDER_EMAIL")
-    sender_password = os.getenv("SENDER_PASSWORD")
+    settings = mailer.SMTPSettings.from_env()
 
     # Prepare the email content
     subject = f"Daily Digest: Latest {subject_title} Papers from ({(datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')})"
-    body = f"<h2>Latest {header_title} Papers</h2>"
-
-    body += f"<i>{len(papers)} papers found.</i>"
-    body += f"<br>"
-
-    if papers:
-        for paper in papers:
-            title = paper["title"]
-            summary = paper["summary"]
-            link = paper["link"]
-
-            body += f"<p><b>{title}</b><br>Abstract: {summary}<br><a href='{link}'>Read more</a></p><hr>"
-    else:
-        body += "<p>No new papers found in the past day.</p>"
-
-    # Create the email message
-    msg = MIMEMultipart()
-    msg["From"] = sender_email
-    msg["To"] = recipient_email
-    msg["Subject"] = subject
-    msg.attach(MIMEText(body, "html"))
+    body = mailer.render_digest_html(f"Latest {header_title} Papers", papers)
 
     # Send the email
-    try:
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465) as server:
-            server.login(sender_email, sender_password)
-            server.sendmail(sender_email, recipient_email, msg.as_string())
-        print("Email sent successfully!")
-    except Exception as e:
-        print("Error sending email:", e)
+    message = mailer.build_message(
+        settings.sender_email, recipient_email, subject, body
+    )
+    with mailer.Mailer(settings) as digest_mailer:
+        if digest_mailer.send(message):
+            print("Email sent successfully!")
 
 
 def main(override=None):
@@ -132,10 +183,21 @@ def main(override=None):
     parser.add_argument("--recipient_email", type=str, required=True)
     parser.add_argument("--subject_title", type=str, required=True)
     parser.add_argument("--header_title", type=str, required=True)
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=8,
+        help="Number of Hugging Face paper pages to fetch at once.",
+    )
+    http_utils.add_cache_arguments(parser)
 
     args = parser.parse_args()
 
-    papers = get_yesterday_papers()
+    http_cache = http_utils.cache_from_args(args)
+    papers = get_yesterday_papers(num_workers=args.num_workers, cache=http_cache)
+    if http_cache is not None:
+        print(http_cache.report())
+        http_cache.close()
     send_email(
         papers,
         recipient_email=args.recipient_email,
@@ -0,0 +1,429 @@
+import argparse
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+import urllib.parse
+from typing import Dict, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.response import HTTPResponse
+from urllib3.util.retry import Retry
+
+# (connect, read) timeouts in seconds for every request.
+DEFAULT_TIMEOUT = (10, 60)
+
+DEFAULT_CACHE_PATH = "./data/http_cache.sqlite3"
+
+# Seconds a cached response is served without asking the server again, by
+# host. arXiv listings and Hugging Face daily pages change once a day, while
+# arXiv API answers for a given query barely change within a few hours.
+DEFAULT_HOST_TTLS = {
+    "arxiv.org": 60 * 60,
+    "export.arxiv.org": 6 * 60 * 60,
+    "huggingface.co": 60 * 60,
+}
+DEFAULT_TTL = 60 * 60
+
+# Response headers that describe the encoded body on the wire, rather than the
+# decoded body the cache stores.
+_WIRE_HEADERS = ("content-encoding", "content-length", "transfer-encoding")
+
+
+def create_session(
+    pool_size: int = 10, cache: "HTTPCache" = None
+) -> requests.Session:
+    """
+    A session with a keep-alive connection pool of `pool_size` connections per
+    host, which retries connection errors and transient server errors with
+    exponential backoff. With a cache, GET requests are answered from it when
+    possible.
+    """
+    retry = Retry(
+        total=3,
+        backoff_factor=1.0,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET", "HEAD"],
+        respect_retry_after_header=True,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+    session = CachingSession(cache) if cache is not None else requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class ValidatorStore:
+    """
+    Remembers the ETag and Last-Modified validators of fetched pages, and where
+    the result of processing each page was saved.
+
+    This lets a conditional request skip both downloading and re-processing a
+    page that has not changed since it was last fetched.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries: Dict[str, dict] = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self._entries = json.load(f)
+
+    def request_headers(self, url: str) -> Dict[str, str]:
+        """The conditional request headers for the url, if it was fetched before."""
+        with self._lock:
+            entry = self._entries.get(url)
+        if entry is None:
+            return {}
+
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def output_path(self, url: str) -> Optional[str]:
+        """Where the result of processing the last fetch of the url was saved."""
+        with self._lock:
+            entry = self._entries.get(url)
+        return entry["output_path"] if entry else None
+
+    def update(self, url: str, response: requests.Response, output_path: str):
+        with self._lock:
+            self._entries[url] = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "output_path": output_path,
+            }
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w") as f:
+                json.dump(self._entries, f)
+            os.replace(temp_path, self.path)
+
+
+class HTTPCache:
+    """
+    On-disk cache of successful GET responses, shared by every fetcher.
+
+    A response is served from disk for the TTL of its host. After that, it is
+    revalidated with its ETag and Last-Modified validators, so that an unchanged
+    page is not downloaded again. Once the bodies take more than `max_bytes`,
+    the least recently used responses are dropped.
+
+    The cache is safe to share between threads.
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_CACHE_PATH,
+        max_bytes: int = 512 * 1024 * 1024,
+        host_ttls: Dict[str, float] = None,
+        default_ttl: float = DEFAULT_TTL,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.host_ttls = dict(DEFAULT_HOST_TTLS if host_ttls is None else host_ttls)
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_from_cache = 0
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY,
+                headers TEXT NOT NULL,
+                body BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                fetched_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed_at "
+            "ON responses (accessed_at)"
+        )
+        self._connection.commit()
+
+    def ttl(self, url: str) -> float:
+        """The TTL of the url's host, or of its closest parent domain."""
+        host = urllib.parse.urlsplit(url).hostname or ""
+        while host:
+            if host in self.host_ttls:
+                return self.host_ttls[host]
+            host = host.partition(".")[2]
+        return self.default_ttl
+
+    def get(self, url: str) -> Optional[dict]:
+        """The cached entry for the url, whether fresh or not."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT headers, body, fetched_at FROM responses WHERE url = ?",
+                (url,),
+            ).fetchone()
+            if row is None:
+                return None
+            self._connection.execute(
+                "UPDATE responses SET accessed_at = ? WHERE url = ?",
+                (time.time(), url),
+            )
+            self._connection.commit()
+        headers, body, fetched_at = row
+        return {
+            "headers": json.loads(headers),
+            "body": body,
+            "fresh": time.time() - fetched_at < self.ttl(url),
+        }
+
+    def put(self, url: str, headers: Dict[str, str], body: bytes):
+        headers = {
+            key: value
+            for key, value in headers.items()
+            if key.lower() not in _WIRE_HEADERS
+        }
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (url, json.dumps(headers), body, len(body), now, now),
+            )
+            self._connection.commit()
+        self.evict()
+
+    def touch(self, url: str):
+        """Marks the entry as fresh again, after the server confirmed it."""
+        with self._lock:
+            self._connection.execute(
+                "UPDATE responses SET fetched_at = ? WHERE url = ?",
+                (time.time(), url),
+            )
+            self._connection.commit()
+
+    def evict(self):
+        """Drops the least recently used responses above the size limit."""
+        with self._lock:
+            (total_bytes,) = self._connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+            if total_bytes <= self.max_bytes:
+                return
+            rows = self._connection.execute(
+                "SELECT url, size FROM responses ORDER BY accessed_at"
+            ).fetchall()
+            evicted = []
+            for url, size in rows:
+                if total_bytes <= self.max_bytes:
+                    break
+                evicted.append((url,))
+                total_bytes -= size
+            self._connection.executemany(
+                "DELETE FROM responses WHERE url = ?", evicted
+            )
+            self._connection.commit()
+            self.evictions += len(evicted)
+
+    def size(self) -> int:
+        with self._lock:
+            (total_bytes,) = self._connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        return total_bytes
+
+    def report(self) -> str:
+        requests_made = self.hits + self.revalidated + self.misses
+        served = self.hits + self.revalidated
+        served_rate = 100.0 * served / requests_made if requests_made else 0.0
+        return (
+            f"HTTP cache: {self.hits} hits, {self.revalidated} revalidated, "
+            f"{self.misses} misses ({served_rate:.1f}% served from disk, "
+            f"{self.bytes_from_cache / 1e6:.1f} MB), {self.evictions} evictions, "
+            f"{self.size() / 1e6:.1f} MB cached."
+        )
+
+    def close(self):
+        self.evict()
+        with self._lock:
+            self._connection.close()
+
+
+def _response_from_body(
+    url: str, status_code: int, headers: Dict[str, str], body: bytes
+) -> requests.Response:
+    """A response with a decoded body, readable with `content` or `raw`."""
+    response = requests.Response()
+    response.url = url
+    response.status_code = status_code
+    response.reason = "Not Modified" if status_code == 304 else "OK"
+    response.headers = CaseInsensitiveDict(headers)
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    response._content = body
+    response.raw = HTTPResponse(
+        body=io.BytesIO(body),
+        headers=headers,
+        status=status_code,
+        preload_content=False,
+        decode_content=False,
+    )
+    return response
+
+
+def _validators_match(request_headers: CaseInsensitiveDict, headers: dict) -> bool:
+    """Whether the caller's conditional request headers match the cached entry."""
+    headers = CaseInsensitiveDict(headers)
+    if "If-None-Match" in request_headers:
+        return request_headers["If-None-Match"] == headers.get("ETag")
+    if "If-Modified-Since" in request_headers:
+        return request_headers["If-Modified-Since"] == headers.get("Last-Modified")
+    return False
+
+
+class CachingSession(requests.Session):
+    """
+    A session that answers GET requests from an `HTTPCache`.
+
+    Fresh responses are served without touching the network, and stale ones
+    are revalidated with a conditional request. When the caller sends its own
+    `If-None-Match`/`If-Modified-Since` headers and they match the cached
+    response, the answer is a bodiless 304, as the server itself would send.
+    Every response of this session has its body fully read.
+    """
+
+    def __init__(self, cache: HTTPCache):
+        super().__init__()
+        self.cache = cache
+
+    def request(self, method, url, params=None, headers=None, **kwargs):
+        if method.upper() != "GET":
+            return super().request(
+                method, url, params=params, headers=headers, **kwargs
+            )
+
+        url = requests.Request("GET", url, params=params).prepare().url
+        request_headers = CaseInsensitiveDict(headers or {})
+        entry = self.cache.get(url)
+
+        if entry is not None and entry["fresh"]:
+            self.cache.hits += 1
+            return self._cached_response(url, entry, request_headers)
+
+        # Without a cached response, the caller's own validators are sent as is.
+        network_headers = CaseInsensitiveDict(request_headers)
+        if entry is not None:
+            network_headers.pop("If-None-Match", None)
+            network_headers.pop("If-Modified-Since", None)
+            cached_headers = CaseInsensitiveDict(entry["headers"])
+            if cached_headers.get("ETag"):
+                network_headers["If-None-Match"] = cached_headers["ETag"]
+            if cached_headers.get("Last-Modified"):
+                network_headers["If-Modified-Since"] = cached_headers["Last-Modified"]
+
+        response = super().request(method, url, headers=network_headers, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            response.close()
+            self.cache.touch(url)
+            self.cache.revalidated += 1
+            return self._cached_response(url, entry, request_headers)
+
+        self.cache.misses += 1
+        body = response.content
+        if response.status_code == 200 and "no-store" not in response.headers.get(
+            "Cache-Control", ""
+        ):
+            self.cache.put(url, dict(response.headers), body)
+        # The body has been read, so the raw stream is rebuilt over it.
+        cached = _response_from_body(
+            url,
+            response.status_code,
+            {
+                key: value
+                for key, value in response.headers.items()
+                if key.lower() not in _WIRE_HEADERS
+            },
+            body,
+        )
+        cached.reason = response.reason
+        cached.request = response.request
+        if response.status_code == 200 and _validators_match(
+            request_headers, cached.headers
+        ):
+            return _response_from_body(url, 304, dict(cached.headers), b"")
+        return cached
+
+    def _cached_response(
+        self, url: str, entry: dict, request_headers: CaseInsensitiveDict
+    ) -> requests.Response:
+        if _validators_match(request_headers, entry["headers"]):
+            return _response_from_body(url, 304, entry["headers"], b"")
+        self.cache.bytes_from_cache += len(entry["body"])
+        return _response_from_body(url, 200, entry["headers"], entry["body"])
+
+
+def parse_host_ttls(values: List[str]) -> Dict[str, float]:
+    """Parses `host=seconds` pairs on top of the default host TTLs."""
+    host_ttls = dict(DEFAULT_HOST_TTLS)
+    for value in values:
+        host, separator, seconds = value.partition("=")
+        if not separator:
+            raise argparse.ArgumentTypeError(
+                f"Expected a host=seconds pair, got '{value}'."
+            )
+        host_ttls[host.strip()] = float(seconds)
+    return host_ttls
+
+
+def add_cache_arguments(parser: argparse.ArgumentParser):
+    """Adds the HTTP cache options shared by the fetching scripts."""
+    parser.add_argument(
+        "--http_cache_path",
+        type=str,
+        default=DEFAULT_CACHE_PATH,
+        help="Path of the on-disk HTTP response cache. Pass an empty string to "
+        "disable the cache.",
+    )
+    parser.add_argument(
+        "--http_cache_max_mb",
+        type=float,
+        default=512,
+        help="Size of the cached response bodies above which the least recently "
+        "used ones are dropped.",
+    )
+    parser.add_argument(
+        "--http_cache_ttl",
+        type=str,
+        nargs="*",
+        default=[],
+        help="host=seconds pairs overriding how long the responses of a host are "
+        "served without revalidation.",
+    )
+
+
+def cache_from_args(args: argparse.Namespace) -> Optional[HTTPCache]:
+    """The HTTP cache configured by `add_cache_arguments`, if enabled."""
+    if not args.http_cache_path:
+        return None
+    return HTTPCache(
+        args.http_cache_path,
+        max_bytes=int(args.http_cache_max_mb * 1024 * 1024),
+        host_ttls=parse_host_ttls(args.http_cache_ttl),
+    )
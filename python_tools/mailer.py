@@ -0,0 +1,246 @@
+import concurrent.futures
+from dataclasses import dataclass
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+import html
+import os
+import smtplib
+import ssl
+import threading
+import time
+from typing import Iterable, List, Optional, Tuple
+
+GMAIL_SMTP_HOST = "smtp.gmail.com"
+GMAIL_SMTP_PORT = 465
+
+NO_PAPERS_TEXT = "No new papers found in the past day."
+
+
+@dataclass
+class SMTPSettings:
+    """
+    Where and how to send the emails. `security` is "ssl" for an implicit TLS
+    connection, "starttls" to upgrade a plain connection, or "none" for a local
+    server such as `benchmarks/smtp_sink.py`, which also needs no login.
+    """
+
+    sender_email: str
+    sender_password: str = ""
+    host: str = GMAIL_SMTP_HOST
+    port: int = GMAIL_SMTP_PORT
+    security: str = "ssl"
+    timeout: float = 60.0
+
+    @classmethod
+    def from_env(cls) -> "SMTPSettings":
+        """
+        The settings from the SENDER_EMAIL and SENDER_PASSWORD environment
+        variables, on the Gmail SMTP server unless SMTP_HOST, SMTP_PORT and
+        SMTP_SECURITY say otherwise.
+        """
+        return cls(
+            sender_email=os.getenv("SENDER_EMAIL", ""),
+            sender_password=os.getenv("SENDER_PASSWORD", ""),
+            host=os.getenv("SMTP_HOST", GMAIL_SMTP_HOST),
+            port=int(os.getenv("SMTP_PORT", GMAIL_SMTP_PORT)),
+            security=os.getenv("SMTP_SECURITY", "ssl"),
+        )
+
+
+def render_papers_html(
+    papers: Iterable[dict], summary_label: str = "Abstract"
+) -> Tuple[str, int]:
+    """
+    The HTML of a list of papers, each with a "title", "summary" and "link",
+    rendered in a single pass over the papers.
+
+    Returns:
+        Tuple of the HTML and the number of papers.
+    """
+    parts = [
+        f"<p><b>{html.escape(paper['title'])}</b><br>"
+        f"{summary_label}: {html.escape(paper['summary'])}<br>"
+        f"<a href='{html.escape(paper['link'], quote=True)}'>Read more</a></p><hr>"
+        for paper in papers
+    ]
+    return "".join(parts), len(parts)
+
+
+def render_digest_html(header_title: str, papers: Iterable[dict]) -> str:
+    """The HTML body of a digest email listing the papers."""
+    papers_html, num_papers = render_papers_html(papers)
+    return "".join(
+        [
+            f"<h2>{html.escape(header_title)}</h2>",
+            f"<i>{num_papers} papers found.</i>",
+            "<br>",
+            papers_html if num_papers else f"<p>{NO_PAPERS_TEXT}</p>",
+        ]
+    )
+
+
+def build_message(
+    sender_email: str, recipient_email: str, subject: str, html_body: str
+) -> MIMEMultipart:
+    message = MIMEMultipart()
+    message["From"] = sender_email
+    message["To"] = recipient_email
+    message["Subject"] = subject
+    message.attach(MIMEText(html_body, "html"))
+    return message
+
+
+class Mailer:
+    """
+    Sends messages over a single authenticated SMTP connection, which is opened
+    on the first message and reused for the following ones.
+
+    The connection is reopened after `max_messages_per_connection` messages, or
+    when the server drops it. A message that fails with a temporary error is
+    retried up to `max_retries` times with exponential backoff, while one the
+    server rejects for good is reported and skipped.
+    """
+
+    def __init__(
+        self,
+        settings: SMTPSettings,
+        max_retries: int = 3,
+        backoff: float = 2.0,
+        max_messages_per_connection: int = 100,
+    ):
+        self.settings = settings
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_messages_per_connection = max_messages_per_connection
+        self.num_sent = 0
+        self.num_failed = 0
+        self.num_connections = 0
+        self._connection: Optional[smtplib.SMTP] = None
+        self._connection_messages = 0
+
+    def __enter__(self) -> "Mailer":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _connect(self) -> smtplib.SMTP:
+        settings = self.settings
+        if settings.security == "ssl":
+            connection = smtplib.SMTP_SSL(
+                settings.host,
+                settings.port,
+                timeout=settings.timeout,
+                context=ssl.create_default_context(),
+            )
+        else:
+            connection = smtplib.SMTP(
+                settings.host, settings.port, timeout=settings.timeout
+            )
+            if settings.security == "starttls":
+                connection.starttls(context=ssl.create_default_context())
+        if settings.sender_password:
+            connection.login(settings.sender_email, settings.sender_password)
+        self.num_connections += 1
+        self._connection_messages = 0
+        return connection
+
+    def close(self):
+        if self._connection is not None:
+            try:
+                self._connection.quit()
+            except smtplib.SMTPException:
+                pass
+            except OSError:
+                pass
+            self._connection = None
+
+    def send(self, message: MIMEMultipart) -> bool:
+        """Sends the message, returning whether it was accepted."""
+        for attempt in range(self.max_retries + 1):
+            try:
+                if (
+                    self._connection is not None
+                    and self._connection_messages >= self.max_messages_per_connection
+                ):
+                    self.close()
+                if self._connection is None:
+                    self._connection = self._connect()
+                self._connection.send_message(message)
+                self._connection_messages += 1
+                self.num_sent += 1
+                return True
+            except smtplib.SMTPResponseException as e:
+                # 4xx replies are temporary, 5xx ones will not change on retry.
+                if e.smtp_code < 400 or e.smtp_code >= 500:
+                    print(f"Email to {message['To']} rejected: {e.smtp_code} {e.smtp_error}")
+                    break
+                error = e
+                # The server may abort the transaction, so start a clean one.
+                self._reset()
+            except smtplib.SMTPRecipientsRefused as e:
+                print(f"Email to {message['To']} rejected: {e.recipients}")
+                break
+            except (smtplib.SMTPException, OSError) as e:
+                error = e
+                self._connection = None
+
+            if attempt < self.max_retries:
+                delay = self.backoff * 2**attempt
+                print(
+                    f"Sending email to {message['To']} failed ({error}), retrying "
+                    f"in {delay:.0f}s."
+                )
+                time.sleep(delay)
+            else:
+                print(f"Giving up on email to {message['To']}: {error}")
+        self.num_failed += 1
+        return False
+
+    def _reset(self):
+        if self._connection is None:
+            return
+        try:
+            self._connection.rset()
+        except (smtplib.SMTPException, OSError):
+            self._connection = None
+
+
+def send_messages(
+    settings: SMTPSettings,
+    messages: List[MIMEMultipart],
+    num_connections: int = 1,
+    **mailer_kwargs,
+) -> List[MIMEMultipart]:
+    """
+    Sends the messages over `num_connections` connections at once, each one
+    reused for its share of the messages.
+
+    Returns:
+        List[MIMEMultipart]: The messages that could not be sent.
+    """
+    num_connections = max(1, min(num_connections, len(messages)))
+    failed = []
+    failed_lock = threading.Lock()
+
+    def send_share(share: List[MIMEMultipart]) -> Mailer:
+        with Mailer(settings, **mailer_kwargs) as mailer:
+            for message in share:
+                if not mailer.send(message):
+                    with failed_lock:
+                        failed.append(message)
+        return mailer
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_connections) as executor:
+        mailers = list(
+            executor.map(
+                send_share,
+                [messages[index::num_connections] for index in range(num_connections)],
+            )
+        )
+    print(
+        f"Sent {sum(mailer.num_sent for mailer in mailers)} emails over "
+        f"{sum(mailer.num_connections for mailer in mailers)} connections, "
+        f"{len(failed)} failed."
+    )
+    return failed
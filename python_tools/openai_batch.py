@@ -0,0 +1,272 @@
+import concurrent.futures
+import dataclasses
+import json
+import os
+import time
+from typing import Callable, Dict, List, Optional
+
+import openai_utils
+
+# Limits of a single job of the OpenAI Batch API.
+MAX_BATCH_REQUESTS = 50000
+MAX_BATCH_FILE_BYTES = 200 * 1024 * 1024
+
+COMPLETION_WINDOW = "24h"
+FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+def chat_completion_body(request) -> dict:
+    """
+    The body of the chat completion request that `openai_completion` would
+    send for the scoring request.
+    """
+    body = dict(
+        model=request.model_name,
+        messages=openai_utils.chat_messages(request.prompt),
+        **dataclasses.asdict(request.decoding_args),
+        **request.decoding_kwargs,
+    )
+    return {key: value for key, value in body.items() if value is not None}
+
+
+class OpenAIBatchJob:
+    """
+    Collects scoring requests, and runs them all through the OpenAI Batch API
+    instead of one chat completion call each.
+
+    Running a job takes three steps: the requests are written to JSONL request
+    files under `work_dir`, each file is uploaded and submitted as a batch, and
+    once every batch has finished, the response to each request is handed to
+    its `process_response` to resolve the future returned by `add`.
+
+    Requests are anything with `prompt`, `model_name`, `decoding_args`,
+    `decoding_kwargs` and `process_response` attributes, such as a
+    `ScoringRequest` of the digest job.
+    """
+
+    def __init__(
+        self,
+        work_dir: str = "./data/batch",
+        poll_interval: float = 60.0,
+        timeout: float = 26 * 60 * 60,
+    ):
+        self.work_dir = work_dir
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self._requests = []
+        self._futures: List[concurrent.futures.Future] = []
+
+    def add(self, request) -> concurrent.futures.Future:
+        """Queues the request, returning a future for its processed response."""
+        future = concurrent.futures.Future()
+        self._requests.append(request)
+        self._futures.append(future)
+        return future
+
+    def write_request_files(self) -> List[str]:
+        """
+        Writes the queued requests to as many JSONL request files as the batch
+        limits require.
+        """
+        os.makedirs(self.work_dir, exist_ok=True)
+        paths = []
+        lines = []
+        num_bytes = 0
+
+        def write_file():
+            path = os.path.join(self.work_dir, f"requests_{len(paths):03d}.jsonl")
+            with open(path, "w") as f:
+                f.writelines(lines)
+            paths.append(path)
+
+        for index, request in enumerate(self._requests):
+            line = (
+                json.dumps(
+                    {
+                        "custom_id": f"request-{index}",
+                        "method": "POST",
+                        "url": "/v1/chat/completions",
+                        "body": chat_completion_body(request),
+                    }
+                )
+                + "\n"
+            )
+            line_bytes = len(line.encode("utf-8"))
+            if lines and (
+                len(lines) == MAX_BATCH_REQUESTS
+                or num_bytes + line_bytes > MAX_BATCH_FILE_BYTES
+            ):
+                write_file()
+                lines = []
+                num_bytes = 0
+            lines.append(line)
+            num_bytes += line_bytes
+        if lines:
+            write_file()
+        return paths
+
+    def submit(self, path: str) -> str:
+        """Uploads the request file and starts a batch for it, returning its id."""
+        client = openai_utils.get_client()
+        with open(path, "rb") as f:
+            input_file = client.files.create(file=f, purpose="batch")
+        batch = client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window=COMPLETION_WINDOW,
+        )
+        print(f"Submitted batch {batch.id} for '{path}'.")
+        return batch.id
+
+    def wait(self, batch_ids: List[str]) -> list:
+        """Polls the batches until all of them have finished."""
+        client = openai_utils.get_client()
+        deadline = time.time() + self.timeout
+        batches = {}
+        while True:
+            for batch_id in batch_ids:
+                if batch_id not in batches:
+                    batch = client.batches.retrieve(batch_id)
+                    if batch.status in FINAL_STATUSES:
+                        print(f"Batch {batch_id} finished with status '{batch.status}'.")
+                        batches[batch_id] = batch
+            if len(batches) == len(batch_ids):
+                return [batches[batch_id] for batch_id in batch_ids]
+            if time.time() > deadline:
+                raise TimeoutError(
+                    f"Batches {sorted(set(batch_ids) - set(batches))} did not finish in time."
+                )
+            time.sleep(self.poll_interval)
+
+    def read_results(self, batches) -> Dict[str, Optional[object]]:
+        """
+        The first choice of the response to each request, by custom id, with
+        the `usage` of the response.
+        """
+        from openai.types.chat import ChatCompletion
+
+        client = openai_utils.get_client()
+        results = {}
+        for batch in batches:
+            for file_id in (batch.output_file_id, batch.error_file_id):
+                if not file_id:
+                    continue
+                for line in client.files.content(file_id).text.splitlines():
+                    if not line.strip():
+                        continue
+                    result = json.loads(line)
+                    response = result.get("response") or {}
+                    if result.get("error") or response.get("status_code") != 200:
+                        print(
+                            f"Request {result['custom_id']} failed: "
+                            f"{result.get('error') or response.get('body')}"
+                        )
+                        results[result["custom_id"]] = None
+                        continue
+                    completion = ChatCompletion.model_validate(response["body"])
+                    completion.choices[0].usage = completion.usage
+                    results[result["custom_id"]] = completion.choices[0]
+        return results
+
+    def run(self):
+        """Runs every queued request through the Batch API, resolving the futures."""
+        if not self._requests:
+            return
+
+        paths = self.write_request_files()
+        print(f"Wrote {len(self._requests)} requests to {len(paths)} batch request files.")
+        batch_ids = [self.submit(path) for path in paths]
+        results = self.read_results(self.wait(batch_ids))
+
+        num_failed = 0
+        for index, (request, future) in enumerate(zip(self._requests, self._futures)):
+            response = results.get(f"request-{index}")
+            if response is None:
+                num_failed += 1
+            try:
+                future.set_result(request.process_response(response))
+            except Exception as e:
+                future.set_exception(e)
+        print(
+            f"Batch scoring finished: {len(self._requests) - num_failed} requests "
+            f"answered, {num_failed} failed."
+        )
+        self._requests = []
+        self._futures = []
+
+
+class AsyncCompletionJob:
+    """
+    Collects scoring requests, and sends them all concurrently with
+    `openai_utils.async_openai_completion`, within a requests and tokens per
+    minute budget.
+
+    Requests are queued with `add` and sent by `run`, the same way as with
+    `OpenAIBatchJob`, but the responses come back within minutes rather than
+    hours.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float = 3500,
+        tokens_per_minute: float = 90000,
+        max_concurrency: int = 16,
+        on_retry: Optional[Callable[[Exception], None]] = None,
+    ):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrency = max_concurrency
+        self.on_retry = on_retry
+        self._requests = []
+        self._futures: List[concurrent.futures.Future] = []
+
+    def add(self, request) -> concurrent.futures.Future:
+        """Queues the request, returning a future for its processed response."""
+        future = concurrent.futures.Future()
+        self._requests.append(request)
+        self._futures.append(future)
+        return future
+
+    def run(self):
+        """Sends every queued request, resolving the futures in input order."""
+        import asyncio
+
+        # Requests can only share a call when they use the same model and
+        # decoding keyword arguments.
+        groups: Dict[str, List[int]] = {}
+        for index, request in enumerate(self._requests):
+            key = json.dumps(
+                [request.model_name, request.decoding_kwargs], sort_keys=True
+            )
+            groups.setdefault(key, []).append(index)
+
+        num_failed = 0
+        for indices in groups.values():
+            first = self._requests[indices[0]]
+            responses = asyncio.run(
+                openai_utils.async_openai_completion(
+                    [self._requests[index].prompt for index in indices],
+                    [self._requests[index].decoding_args for index in indices],
+                    model_name=first.model_name,
+                    requests_per_minute=self.requests_per_minute,
+                    tokens_per_minute=self.tokens_per_minute,
+                    max_concurrency=self.max_concurrency,
+                    on_retry=self.on_retry,
+                    **first.decoding_kwargs,
+                )
+            )
+            for index, response in zip(indices, responses):
+                if response is None:
+                    num_failed += 1
+                try:
+                    self._futures[index].set_result(
+                        self._requests[index].process_response(response)
+                    )
+                except Exception as e:
+                    self._futures[index].set_exception(e)
+        print(
+            f"Async scoring finished: {len(self._requests) - num_failed} requests "
+            f"answered, {num_failed} failed."
+        )
+        self._requests = []
+        self._futures = []
@@ -1,18 +1,16 @@
 import dataclasses
+import email.utils
 import logging
 import math
 import os
 import io
+import random
 import sys
+import threading
 import time
 import json
-from typing import Optional, Sequence, Union
+from typing import Callable, List, Optional, Sequence, Union
 
-import openai
-from openai import OpenAI
-
-client = OpenAI()
-import tqdm
 import copy
 
 StrOrOpenAIObject = Union[str, object]
@@ -24,6 +22,32 @@ if openai_org is not None:
     # openai.organization = openai_org
     logging.warning(f"Switching to organization: {openai_org} for OAI API key.")
 
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    The OpenAI client shared by the whole process.
+
+    The client is created on first use, so that importing this module neither
+    loads the `openai` package nor needs an API key.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            from openai import OpenAI
+
+            _client = OpenAI()
+        return _client
+
+
+def __getattr__(name):
+    # `openai_utils.client` still reads as the shared client.
+    if name == "client":
+        return get_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 @dataclasses.dataclass
 class OpenAIDecodingArguments(object):
@@ -38,6 +62,112 @@ class OpenAIDecodingArguments(object):
     # logprobs: Optional[int] = None
 
 
+_token_encodings = {}
+
+
+def _token_encoding(model_name: Optional[str]):
+    if model_name not in _token_encodings:
+        try:
+            import tiktoken
+
+            _token_encodings[model_name] = tiktoken.encoding_for_model(
+                model_name or "gpt-3.5-turbo"
+            )
+        except Exception:
+            # tiktoken is not installed, does not know the model, or cannot
+            # download its vocabulary.
+            _token_encodings[model_name] = None
+    return _token_encodings[model_name]
+
+
+def estimate_num_tokens(text: str, model_name: Optional[str] = None) -> int:
+    """
+    Token count of the text for the model. Uses the model's tokenizer when
+    tiktoken is installed, and otherwise about four characters per token.
+    """
+    encoding = _token_encoding(model_name)
+    if encoding is None:
+        return int(math.ceil(len(text) / 4))
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def is_chat_model(model_name: str) -> bool:
+    return "gpt-3.5" in model_name or "gpt-4" in model_name
+
+
+def chat_messages(prompt: str):
+    """The messages of a chat completion request for the prompt."""
+    return [
+        {
+            "role": "system",
+            "content": "You are a helpful assistant.",
+        },
+        {"role": "user", "content": prompt},
+    ]
+
+
+@dataclasses.dataclass
+class StreamedMessage:
+    content: str
+    role: str = "assistant"
+
+
+@dataclasses.dataclass
+class StreamedChoice:
+    """A chat completion choice put back together from a streamed response."""
+
+    message: StreamedMessage
+    finish_reason: Optional[str] = None
+    index: int = 0
+    # The token usage of the request, when the stream reported it.
+    usage: Optional[object] = None
+
+
+def consume_chat_stream(
+    stream, line_callback: Optional[Callable[[str, bool], None]] = None
+) -> StreamedChoice:
+    """
+    Reads a streamed chat completion, calling `line_callback` with each line of
+    the response as soon as it is complete.
+
+    The last line is passed once the stream ends, flagged as truncated when the
+    response was cut off by `max_tokens`, in which case it may be incomplete.
+    """
+    chunks = []
+    pending = ""
+    finish_reason = None
+    usage = None
+    for chunk in stream:
+        if getattr(chunk, "usage", None) is not None:
+            usage = chunk.usage
+        if not chunk.choices:
+            continue
+        choice = chunk.choices[0]
+        if choice.delta is not None and choice.delta.content:
+            chunks.append(choice.delta.content)
+            pending += choice.delta.content
+            while "\n" in pending:
+                line, pending = pending.split("\n", 1)
+                if line_callback is not None:
+                    line_callback(line, False)
+        if choice.finish_reason:
+            finish_reason = choice.finish_reason
+    if line_callback is not None and pending:
+        line_callback(pending, finish_reason == "length")
+    return StreamedChoice(
+        message=StreamedMessage(content="".join(chunks)),
+        finish_reason=finish_reason,
+        usage=usage,
+    )
+
+
+def _with_usage(choices, usage):
+    """The choices, each carrying the token usage of the request it came from."""
+    for choice in choices:
+        choice.usage = usage
+    return choices
+
+
 def openai_completion(
     prompts,  #: Union[str, Sequence[str], Sequence[dict[str, str]], dict[str, str]],
     decoding_args: OpenAIDecodingArguments,
@@ -47,6 +177,8 @@ def openai_completion(
     max_instances=sys.maxsize,
     max_batches=sys.maxsize,
     return_text=False,
+    stream_callback: Optional[Callable[[Optional[str], bool], None]] = None,
+    on_retry: Optional[Callable[[Exception], None]] = None,
     **decoding_kwargs,
 ) -> Union[
     Union[StrOrOpenAIObject],
@@ -67,16 +199,26 @@ def openai_completion(
         max_instances: Maximum number of prompts to decode.
         max_batches: Maximum number of batches to decode. This argument will be deprecated in the future.
         return_text: If True, return text instead of full completion object (which contains things like logprob).
+        stream_callback: For chat models with `decoding_args.stream`, called with each line of the response as soon as
+            it has been generated, and whether it is a final line truncated by `max_tokens`. It is called with None
+            when a request is retried, to discard the lines of the failed attempt. The returned completions hold the
+            whole response either way.
+        on_retry: Called with the error whenever a failed request is about to be retried.
         decoding_kwargs: Additional decoding arguments. Pass in `best_of` and `logit_bias` if you need them.
 
     Returns:
-        A completion or a list of completions.
+        A completion or a list of completions. Completion objects carry the `usage` of the request they came
+        from, which is shared by the `n` completions and the prompts of a batch.
         Depending on return_text, return_openai_object, and decoding_args.n, the completion type can be one of
             - a string (if return_text is True)
             - an openai_object.OpenAIObject object (if return_text is False)
             - a list of objects of the above types (if decoding_args.n > 1)
     """
-    is_chat_model = "gpt-3.5" in model_name or "gpt-4" in model_name
+    import openai
+    import tqdm
+
+    client = get_client()
+    is_chat = is_chat_model(model_name)
     is_single_prompt = isinstance(prompts, (str, dict))
     if is_single_prompt:
         prompts = [prompts]
@@ -90,6 +232,10 @@ def openai_completion(
 
     prompts = prompts[:max_instances]
     num_prompts = len(prompts)
+    if is_chat:
+        # The chat API takes a single conversation per request, so every prompt
+        # is sent on its own rather than only the first prompt of each batch.
+        batch_size = 1
     prompt_batches = [
         prompts[batch_id * batch_size : (batch_id + 1) * batch_size]
         for batch_id in range(int(math.ceil(num_prompts / batch_size)))
@@ -104,23 +250,29 @@ def openai_completion(
         batch_decoding_args = copy.deepcopy(decoding_args)  # cloning the decoding_args
 
         backoff = 3
+        attempt = 0
 
         while True:
             try:
+                if attempt and stream_callback is not None:
+                    stream_callback(None, False)
+                attempt += 1
                 shared_kwargs = dict(
                     model=model_name,
                     **batch_decoding_args.__dict__,
                     **decoding_kwargs,
                 )
-                if is_chat_model:
+                if is_chat and batch_decoding_args.stream:
+                    stream = client.chat.completions.create(
+                        messages=chat_messages(prompt_batch[0]),
+                        stream_options={"include_usage": True},
+                        **shared_kwargs,
+                    )
+                    completions.append(consume_chat_stream(stream, stream_callback))
+                    break
+                elif is_chat:
                     completion_batch = client.chat.completions.create(
-                        messages=[
-                            {
-                                "role": "system",
-                                "content": "You are a helpful assistant.",
-                            },
-                            {"role": "user", "content": prompt_batch[0]},
-                        ],
+                        messages=chat_messages(prompt_batch[0]),
                         **shared_kwargs,
                     )
                 else:
@@ -128,14 +280,13 @@ def openai_completion(
                         prompt=prompt_batch, **shared_kwargs
                     )
 
-                choices = completion_batch.choices
-
-                # for choice in choices:
-                #     choice["total_tokens"] = completion_batch.usage.total_tokens
+                choices = _with_usage(completion_batch.choices, completion_batch.usage)
                 completions.extend(choices)
                 break
             except openai.OpenAIError as e:
                 logging.warning(f"OpenAIError: {e}.")
+                if on_retry is not None and (backoff or "Please reduce your prompt" in str(e)):
+                    on_retry(e)
                 if "Please reduce your prompt" in str(e):
                     batch_decoding_args.max_tokens = int(
                         batch_decoding_args.max_tokens * 0.8
@@ -165,6 +316,226 @@ def openai_completion(
     return completions
 
 
+class RateLimiter:
+    """
+    Spaces out requests to stay within a requests-per-minute and a
+    tokens-per-minute budget, like the rate limits of the OpenAI API.
+
+    Both budgets are token buckets that refill continuously, so a burst of up
+    to a minute's worth of requests is allowed, after which requests go out at
+    the sustained rate. A request counts the tokens of its prompt plus the
+    `max_tokens` it may generate, which is how the API counts them too.
+    """
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = requests_per_minute
+        self._tokens = tokens_per_minute
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = None
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed_minutes = (now - self._updated_at) / 60
+        self._updated_at = now
+        self._requests = min(
+            self.requests_per_minute,
+            self._requests + elapsed_minutes * self.requests_per_minute,
+        )
+        self._tokens = min(
+            self.tokens_per_minute,
+            self._tokens + elapsed_minutes * self.tokens_per_minute,
+        )
+
+    def pause(self, seconds: float):
+        """Holds back every request for `seconds`, e.g. after a rate limit error."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self, num_tokens: int):
+        """Waits until a request of `num_tokens` tokens fits in the budget."""
+        import asyncio
+
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # A request larger than the whole budget is let through once the
+        # bucket is full, rather than never.
+        num_tokens = min(num_tokens, self.tokens_per_minute)
+        async with self._lock:
+            while True:
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                    continue
+                self._refill()
+                if self._requests >= 1 and self._tokens >= num_tokens:
+                    self._requests -= 1
+                    self._tokens -= num_tokens
+                    return
+                wait_minutes = max(
+                    (1 - self._requests) / self.requests_per_minute,
+                    (num_tokens - self._tokens) / self.tokens_per_minute,
+                )
+                await asyncio.sleep(max(wait_minutes * 60, 0.01))
+
+
+def _retry_after_seconds(error: Exception) -> Optional[float]:
+    """
+    The delay the API asked for in the Retry-After headers of the error, or
+    None when there are none, or they are neither seconds nor an HTTP date.
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        delay = float(headers["retry-after-ms"]) / 1000
+    except (KeyError, TypeError, ValueError):
+        delay = None
+    if delay is None and headers.get("retry-after"):
+        retry_after = headers["retry-after"]
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                retry_at = email.utils.parsedate_to_datetime(retry_after)
+                delay = retry_at.timestamp() - time.time()
+            except (TypeError, ValueError, IndexError, OverflowError):
+                return None
+    if delay is None or not math.isfinite(delay):
+        return None
+    return max(0.0, delay)
+
+
+async def async_openai_completion(
+    prompts: Sequence[str],
+    decoding_args: Union[OpenAIDecodingArguments, Sequence[OpenAIDecodingArguments]],
+    model_name="gpt-3.5-turbo-16k",
+    requests_per_minute: float = 3500,
+    tokens_per_minute: float = 90000,
+    max_concurrency: int = 16,
+    max_retries: int = 6,
+    max_backoff: float = 60.0,
+    on_retry: Optional[Callable[[Exception], None]] = None,
+    **decoding_kwargs,
+) -> List:
+    """Decode many prompts concurrently with the async OpenAI API.
+
+    Every prompt is sent as its own request, with at most `max_concurrency`
+    requests in flight and within the requests and tokens per minute budgets.
+    Rate limited and failed requests are retried with exponential backoff and
+    full jitter, waiting at least as long as the Retry-After header asks.
+
+    Args:
+        prompts: The prompts to complete.
+        decoding_args: Decoding arguments, shared by all of the prompts or one
+            for each prompt.
+        model_name: Model name.
+        requests_per_minute: Requests per minute budget.
+        tokens_per_minute: Tokens per minute budget, counting the prompt and
+            `max_tokens` of each request.
+        max_concurrency: Maximum number of requests in flight.
+        max_retries: Retries of a request before giving up on it.
+        max_backoff: Longest backoff between retries, in seconds.
+        on_retry: Called with the error whenever a failed request is about to
+            be retried.
+        decoding_kwargs: Additional decoding arguments, e.g. `logit_bias`.
+
+    Returns:
+        The completions in the same order as the prompts: the first choice of
+        each, or a list of choices if decoding_args.n > 1, carrying the `usage`
+        of their request. Prompts that still failed after all of the retries
+        have None.
+    """
+    import asyncio
+
+    import openai
+    import tqdm
+
+    if isinstance(decoding_args, OpenAIDecodingArguments):
+        decoding_args = [decoding_args] * len(prompts)
+    # The client's connections belong to the running event loop, so each call
+    # has its own client. The retrying is done here, not by the client.
+    client = openai.AsyncOpenAI(max_retries=0)
+    is_chat = is_chat_model(model_name)
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    progress = tqdm.tqdm(total=len(prompts), desc="prompts")
+
+    async def complete(prompt, prompt_decoding_args):
+        prompt_decoding_args = copy.deepcopy(prompt_decoding_args)
+        num_tokens = estimate_num_tokens(prompt, model_name)
+        for attempt in range(max_retries + 1):
+            await limiter.acquire(
+                num_tokens + prompt_decoding_args.max_tokens * prompt_decoding_args.n
+            )
+            try:
+                async with semaphore:
+                    shared_kwargs = dict(
+                        model=model_name,
+                        **prompt_decoding_args.__dict__,
+                        **decoding_kwargs,
+                    )
+                    if is_chat:
+                        completion = await client.chat.completions.create(
+                            messages=chat_messages(prompt), **shared_kwargs
+                        )
+                    else:
+                        completion = await client.completions.create(
+                            prompt=prompt, **shared_kwargs
+                        )
+                progress.update(1)
+                choices = _with_usage(completion.choices, completion.usage)
+                if prompt_decoding_args.n > 1:
+                    return choices
+                return choices[0]
+            except openai.OpenAIError as e:
+                if "Please reduce your prompt" in str(e):
+                    prompt_decoding_args.max_tokens = int(
+                        prompt_decoding_args.max_tokens * 0.8
+                    )
+                    logging.warning(
+                        f"Reducing target length to {prompt_decoding_args.max_tokens}, Retrying..."
+                    )
+                    if on_retry is not None:
+                        on_retry(e)
+                    continue
+                retryable = isinstance(
+                    e,
+                    (
+                        openai.RateLimitError,
+                        openai.APIConnectionError,
+                        openai.InternalServerError,
+                    ),
+                )
+                if not retryable or attempt == max_retries:
+                    logging.error(f"Giving up on prompt after {attempt + 1} attempts: {e}")
+                    progress.update(1)
+                    return None
+
+                delay = random.uniform(0, min(max_backoff, 2**attempt))
+                retry_after = _retry_after_seconds(e)
+                if retry_after is not None:
+                    delay = max(delay, retry_after)
+                if isinstance(e, openai.RateLimitError):
+                    limiter.pause(delay)
+                if on_retry is not None:
+                    on_retry(e)
+                logging.warning(f"OpenAIError: {e}. Retrying in {delay:.1f}s...")
+                await asyncio.sleep(delay)
+        progress.update(1)
+        return None
+
+    try:
+        return await asyncio.gather(
+            *(complete(prompt, args) for prompt, args in zip(prompts, decoding_args))
+        )
+    finally:
+        progress.close()
+        await client.close()
+
+
 def write_ans_to_file(ans_data, file_prefix, output_dir="./output"):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
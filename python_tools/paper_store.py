@@ -0,0 +1,285 @@
+import argparse
+import datetime
+import json
+import os
+import re
+import sqlite3
+import threading
+import urllib.parse
+from typing import List, Optional
+
+from day_corpus import subject_codes
+
+PAPER_FIELDS = ("main_page", "pdf", "title", "authors", "subjects", "abstract")
+
+# e.g. "cs_Wed, 10 May 23.jsonl", as written by `_download_new_papers`.
+JSONL_FILE_PATTERN = re.compile(r"^(?P<category>[^_]+)_(?P<date>.+)\.jsonl$")
+
+
+def _arxiv_id(paper: dict) -> str:
+    return paper["main_page"].strip().split("/")[-1]
+
+
+class PaperStore:
+    """
+    SQLite store of the downloaded arXiv papers.
+
+    Every paper is stored once, keyed by arXiv id, however many category
+    listings it appears in. The `listings` table records which papers were in
+    the listing of each category on each day, in listing order, and the
+    `paper_subjects` table indexes the papers by subject code (e.g. cs.CV).
+    The `downloaded_listings` table records every listing that was stored,
+    including the empty ones, which have no `listings` rows.
+
+    The store can be shared by the download threads. A `read_only` store only
+    reads the file, e.g. a store on a shared directory that the shards of a
+    run on other machines read at the same time.
+    """
+
+    def __init__(self, path: str, read_only: bool = False):
+        self.path = path
+        self.read_only = read_only
+        self._lock = threading.Lock()
+        if read_only:
+            self._connection = sqlite3.connect(
+                f"file:{urllib.parse.quote(os.path.abspath(path))}?mode=ro",
+                uri=True,
+                check_same_thread=False,
+            )
+            return
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        has_downloaded_listings = self._connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'downloaded_listings'"
+        ).fetchone()
+        self._connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS papers (
+                arxiv_id TEXT PRIMARY KEY,
+                main_page TEXT NOT NULL,
+                pdf TEXT NOT NULL,
+                title TEXT NOT NULL,
+                authors TEXT NOT NULL,
+                subjects TEXT NOT NULL,
+                abstract TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS listings (
+                category TEXT NOT NULL,
+                listing_date TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                arxiv_id TEXT NOT NULL,
+                PRIMARY KEY (category, listing_date, position)
+            );
+            CREATE INDEX IF NOT EXISTS listings_date ON listings (listing_date);
+            CREATE TABLE IF NOT EXISTS paper_subjects (
+                subject TEXT NOT NULL,
+                arxiv_id TEXT NOT NULL,
+                PRIMARY KEY (subject, arxiv_id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS downloaded_listings (
+                category TEXT NOT NULL,
+                listing_date TEXT NOT NULL,
+                PRIMARY KEY (category, listing_date)
+            ) WITHOUT ROWID;
+            """
+        )
+        if not has_downloaded_listings:
+            # Stores written before the table existed only know the listings
+            # that had papers.
+            self._connection.execute(
+                "INSERT OR IGNORE INTO downloaded_listings "
+                "SELECT DISTINCT category, listing_date FROM listings"
+            )
+        self._connection.commit()
+
+    def upsert_listing(self, category: str, date: datetime.date, papers: List[dict]):
+        """Stores the papers of the category listing for the day, replacing it."""
+        listing_date = date.isoformat()
+        rows = [
+            (_arxiv_id(paper),) + tuple(paper[field] for field in PAPER_FIELDS)
+            for paper in papers
+        ]
+        with self._lock, self._connection:
+            self._connection.executemany(
+                """
+                INSERT INTO papers VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (arxiv_id) DO UPDATE SET
+                    main_page = excluded.main_page,
+                    pdf = excluded.pdf,
+                    title = excluded.title,
+                    authors = excluded.authors,
+                    subjects = excluded.subjects,
+                    abstract = excluded.abstract
+                """,
+                rows,
+            )
+            self._connection.executemany(
+                "DELETE FROM paper_subjects WHERE arxiv_id = ?",
+                [(row[0],) for row in rows],
+            )
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO paper_subjects VALUES (?, ?)",
+                [
+                    (code, _arxiv_id(paper))
+                    for paper in papers
+                    for code in subject_codes(paper["subjects"])
+                ],
+            )
+            self._connection.execute(
+                "DELETE FROM listings WHERE category = ? AND listing_date = ?",
+                (category, listing_date),
+            )
+            self._connection.executemany(
+                "INSERT INTO listings VALUES (?, ?, ?, ?)",
+                [
+                    (category, listing_date, position, row[0])
+                    for position, row in enumerate(rows)
+                ],
+            )
+            self._connection.execute(
+                "INSERT OR IGNORE INTO downloaded_listings VALUES (?, ?)",
+                (category, listing_date),
+            )
+
+    def copy_listing(
+        self, category: str, from_date: datetime.date, to_date: datetime.date
+    ):
+        """Reuses the listing of another day, for a listing that did not change."""
+        with self._lock, self._connection:
+            self._connection.execute(
+                "DELETE FROM listings WHERE category = ? AND listing_date = ?",
+                (category, to_date.isoformat()),
+            )
+            self._connection.execute(
+                "INSERT INTO listings SELECT category, ?, position, arxiv_id "
+                "FROM listings WHERE category = ? AND listing_date = ?",
+                (to_date.isoformat(), category, from_date.isoformat()),
+            )
+            self._connection.execute(
+                "INSERT OR IGNORE INTO downloaded_listings VALUES (?, ?)",
+                (category, to_date.isoformat()),
+            )
+
+    def has_listing(self, category: str, date: datetime.date) -> bool:
+        """Whether the category listing for the day was stored, even if empty."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT 1 FROM downloaded_listings "
+                "WHERE category = ? AND listing_date = ?",
+                (category, date.isoformat()),
+            ).fetchone()
+        return row is not None
+
+    def listing(
+        self, category: str, date: datetime.date, limit: Optional[int] = None
+    ) -> List[dict]:
+        """The papers of the category listing for the day, in listing order."""
+        query = (
+            "SELECT p.main_page, p.pdf, p.title, p.authors, p.subjects, p.abstract "
+            "FROM listings l JOIN papers p ON p.arxiv_id = l.arxiv_id "
+            "WHERE l.category = ? AND l.listing_date = ? ORDER BY l.position"
+        )
+        parameters = (category, date.isoformat())
+        if limit:
+            query += " LIMIT ?"
+            parameters += (limit,)
+        with self._lock:
+            rows = self._connection.execute(query, parameters).fetchall()
+        return [dict(zip(PAPER_FIELDS, row)) for row in rows]
+
+    def papers_for_subjects(
+        self, date: datetime.date, subjects: List[str], category: Optional[str] = None
+    ) -> List[dict]:
+        """
+        The papers listed on the day that are under any of the subjects, once
+        each. With a category, only the papers of its listing are returned, in
+        listing order, and otherwise those of every listing, by arXiv id.
+        """
+        if not subjects:
+            return []
+        placeholders = ", ".join("?" for _ in subjects)
+        subject_filter = (
+            "SELECT s.arxiv_id FROM paper_subjects s "
+            f"WHERE s.subject IN ({placeholders})"
+        )
+        if category is None:
+            query = (
+                "SELECT p.main_page, p.pdf, p.title, p.authors, p.subjects, p.abstract "
+                f"FROM papers p WHERE p.arxiv_id IN ({subject_filter}) "
+                "AND p.arxiv_id IN ("
+                "  SELECT l.arxiv_id FROM listings l WHERE l.listing_date = ?"
+                ") ORDER BY p.arxiv_id"
+            )
+            parameters = tuple(subjects) + (date.isoformat(),)
+        else:
+            query = (
+                "SELECT p.main_page, p.pdf, p.title, p.authors, p.subjects, p.abstract "
+                "FROM listings l JOIN papers p ON p.arxiv_id = l.arxiv_id "
+                "WHERE l.category = ? AND l.listing_date = ? "
+                f"AND l.arxiv_id IN ({subject_filter}) ORDER BY l.position"
+            )
+            parameters = (category, date.isoformat()) + tuple(subjects)
+        with self._lock:
+            rows = self._connection.execute(query, parameters).fetchall()
+        return [dict(zip(PAPER_FIELDS, row)) for row in rows]
+
+    def close(self):
+        with self._lock:
+            if not self.read_only:
+                # Leave a self-contained file behind, which read-only stores
+                # can open without the write-ahead log's shared memory file.
+                try:
+                    self._connection.execute("PRAGMA journal_mode=DELETE")
+                except sqlite3.OperationalError:
+                    # Another connection still has the store open.
+                    pass
+            self._connection.close()
+
+
+def import_jsonl_files(store: PaperStore, data_dir: str) -> int:
+    """
+    Imports the per-category JSONL files written before the paper store
+    existed, e.g. `data/cs_Wed, 10 May 23.jsonl`.
+
+    Returns:
+        int: The number of listings imported.
+    """
+    num_listings = 0
+    for name in sorted(os.listdir(data_dir)):
+        match = JSONL_FILE_PATTERN.match(name)
+        if match is None:
+            continue
+        try:
+            date = datetime.datetime.strptime(
+                match.group("date"), "%a, %d %b %y"
+            ).date()
+        except ValueError:
+            print(f"Skipping '{name}', which is not a daily listing file.")
+            continue
+
+        with open(os.path.join(data_dir, name), "r") as f:
+            papers = [json.loads(line) for line in f if line.strip()]
+        store.upsert_listing(match.group("category"), date, papers)
+        num_listings += 1
+        print(f"Imported {len(papers)} papers from '{name}'.")
+    return num_listings
+
+
+def main(args_override=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", type=str, default="data")
+    parser.add_argument("--paper_store_path", type=str, default="./data/papers.sqlite3")
+    args = parser.parse_args(args_override)
+
+    store = PaperStore(args.paper_store_path)
+    num_listings = import_jsonl_files(store, args.data_dir)
+    store.close()
+    print(f"Imported {num_listings} listings into '{args.paper_store_path}'.")
+
+
+if __name__ == "__main__":
+    main()
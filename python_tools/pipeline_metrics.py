@@ -0,0 +1,355 @@
+import contextlib
+import json
+import os
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, Iterable, List, Tuple
+
+if TYPE_CHECKING:
+    import http.server
+
+# The stages of the digest job, in pipeline order. Other stage names can be
+# recorded too, and are reported after these.
+STAGES = ("download", "parse", "filter", "prompt", "llm", "post_process", "firestore")
+
+# Upper bounds of the latency histogram buckets, in seconds, from a parsed
+# listing up to a Batch API job.
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900, 3600
+)
+
+METRIC_PREFIX = "research_buddy_digest"
+
+
+class LatencyHistogram:
+    """Cumulative latency histogram of a stage, in the Prometheus layout."""
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        # When the stage first started and last finished, to tell how much of
+        # the run it spans when its calls overlap.
+        self.first_start = None
+        self.last_end = None
+
+    def observe(self, seconds: float, end: float):
+        for index, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.bucket_counts[index] += 1
+                break
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+        start = end - seconds
+        self.first_start = start if self.first_start is None else min(self.first_start, start)
+        self.last_end = end if self.last_end is None else max(self.last_end, end)
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimate of the q-quantile, interpolated within its bucket the way
+        Prometheus' `histogram_quantile` does.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for bound, bucket_count in zip(self.buckets, self.bucket_counts):
+            if bucket_count and seen + bucket_count >= rank:
+                return min(
+                    self.max, lower + (bound - lower) * (rank - seen) / bucket_count
+                )
+            seen += bucket_count
+            lower = bound
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "busy_seconds": round(self.sum, 3),
+            "span_seconds": round(self.last_end - self.first_start, 3)
+            if self.count
+            else 0.0,
+            "mean_seconds": round(self.sum / self.count, 4) if self.count else 0.0,
+            "p50_seconds": round(self.quantile(0.5), 4),
+            "p95_seconds": round(self.quantile(0.95), 4),
+            "max_seconds": round(self.max, 4),
+        }
+
+
+def _split_evenly(total: int, num_parts: int) -> List[int]:
+    """`total` split into `num_parts` integers that add up to it."""
+    share, remainder = divmod(total, num_parts)
+    return [share + (index < remainder) for index in range(num_parts)]
+
+
+def _label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels) -> str:
+    return ",".join(f'{name}="{_label_value(str(value))}"' for name, value in labels.items())
+
+
+class PipelineMetrics:
+    """
+    Counters, latency histograms and LLM token accounting of a run of the
+    digest job, broken down by pipeline stage.
+
+    Each stage records the latency of every call (`timer`/`observe`) and any
+    number of named event counters (`count`). The prompt and completion tokens
+    of every scoring request are recorded per model, and split between the
+    digests the request scored. The metrics are exported as a JSON summary
+    (`write_json`) and in the Prometheus text format (`prometheus_text`, or
+    over HTTP with `serve`).
+
+    The metrics are safe to record from any thread.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._histograms: Dict[str, LatencyHistogram] = {}
+        self._counters: Dict[Tuple[str, str], int] = {}
+        # model -> [requests, prompt tokens, completion tokens]
+        self._model_tokens: Dict[str, List[int]] = {}
+        # (digest, model) -> [requests, prompt tokens, completion tokens]
+        self._digest_tokens: Dict[Tuple[str, str], List[int]] = {}
+
+    def observe(self, stage: str, seconds: float):
+        """Records a call of the stage that took `seconds` and just finished."""
+        end = time.time()
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = LatencyHistogram(self.buckets)
+            histogram.observe(seconds, end)
+
+    @contextlib.contextmanager
+    def timer(self, stage: str):
+        """Records the time spent in the `with` block as a call of the stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def count(self, stage: str, event: str, value: int = 1):
+        with self._lock:
+            key = (stage, event)
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def counter(self, stage: str, event: str) -> int:
+        with self._lock:
+            return self._counters.get((stage, event), 0)
+
+    def record_tokens(
+        self,
+        model_name: str,
+        prompt_tokens: int,
+        completion_tokens: int,
+        digest_keys: Iterable[str] = (),
+    ):
+        """
+        Records the tokens of a scoring request. A request scoring several
+        digests at once has its tokens split evenly between them.
+        """
+        digest_keys = list(digest_keys)
+        with self._lock:
+            totals = self._model_tokens.setdefault(model_name, [0, 0, 0])
+            totals[0] += 1
+            totals[1] += prompt_tokens
+            totals[2] += completion_tokens
+            if not digest_keys:
+                return
+            for digest_key, prompt_share, completion_share in zip(
+                digest_keys,
+                _split_evenly(prompt_tokens, len(digest_keys)),
+                _split_evenly(completion_tokens, len(digest_keys)),
+            ):
+                totals = self._digest_tokens.setdefault((digest_key, model_name), [0, 0, 0])
+                totals[0] += 1
+                totals[1] += prompt_share
+                totals[2] += completion_share
+
+    def _stage_names(self) -> List[str]:
+        names = {stage for stage, _ in self._counters} | set(self._histograms)
+        return [stage for stage in STAGES if stage in names] + sorted(
+            names - set(STAGES)
+        )
+
+    def summary(self) -> dict:
+        """The metrics recorded so far, as a JSON-serializable dict."""
+        with self._lock:
+            stages = {}
+            for stage in self._stage_names():
+                histogram = self._histograms.get(stage)
+                stages[stage] = histogram.summary() if histogram else {}
+                stages[stage]["counters"] = {
+                    event: value
+                    for (counter_stage, event), value in sorted(self._counters.items())
+                    if counter_stage == stage
+                }
+            models = {
+                model_name: {
+                    "requests": requests,
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                }
+                for model_name, (requests, prompt_tokens, completion_tokens) in sorted(
+                    self._model_tokens.items()
+                )
+            }
+            digests = {}
+            for (digest_key, model_name), (
+                requests,
+                prompt_tokens,
+                completion_tokens,
+            ) in sorted(self._digest_tokens.items()):
+                digests.setdefault(digest_key, {})[model_name] = {
+                    "requests": requests,
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                }
+        return {
+            "started_at": self.started_at,
+            "elapsed_seconds": round(time.time() - self.started_at, 3),
+            "stages": stages,
+            "tokens": {"models": models, "digests": digests},
+        }
+
+    def write_json(self, path: str):
+        """Writes the summary to `path`, replacing it atomically."""
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+        os.replace(temp_path, path)
+
+    def prometheus_text(self) -> str:
+        """The metrics in the Prometheus text exposition format."""
+        prefix = METRIC_PREFIX
+        lines = []
+        with self._lock:
+            stages = self._stage_names()
+
+            lines.append(f"# HELP {prefix}_stage_seconds Latency of the calls of each stage.")
+            lines.append(f"# TYPE {prefix}_stage_seconds histogram")
+            for stage in stages:
+                histogram = self._histograms.get(stage)
+                if histogram is None:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(histogram.buckets, histogram.bucket_counts):
+                    cumulative += bucket_count
+                    lines.append(
+                        f"{prefix}_stage_seconds_bucket{{{_labels(stage=stage, le=bound)}}} "
+                        f"{cumulative}"
+                    )
+                lines.append(
+                    f'{prefix}_stage_seconds_bucket{{{_labels(stage=stage, le="+Inf")}}} '
+                    f"{histogram.count}"
+                )
+                lines.append(
+                    f"{prefix}_stage_seconds_sum{{{_labels(stage=stage)}}} {histogram.sum}"
+                )
+                lines.append(
+                    f"{prefix}_stage_seconds_count{{{_labels(stage=stage)}}} {histogram.count}"
+                )
+
+            lines.append(f"# HELP {prefix}_stage_events_total Events counted in each stage.")
+            lines.append(f"# TYPE {prefix}_stage_events_total counter")
+            for (stage, event), value in sorted(self._counters.items()):
+                lines.append(
+                    f"{prefix}_stage_events_total{{{_labels(stage=stage, event=event)}}} "
+                    f"{value}"
+                )
+
+            lines.append(f"# HELP {prefix}_llm_tokens_total LLM tokens used by each model.")
+            lines.append(f"# TYPE {prefix}_llm_tokens_total counter")
+            for model_name, (_, prompt_tokens, completion_tokens) in sorted(
+                self._model_tokens.items()
+            ):
+                for kind, value in (("prompt", prompt_tokens), ("completion", completion_tokens)):
+                    lines.append(
+                        f"{prefix}_llm_tokens_total{{{_labels(model=model_name, kind=kind)}}} "
+                        f"{value}"
+                    )
+
+            lines.append(
+                f"# HELP {prefix}_digest_tokens_total LLM tokens used to score each digest."
+            )
+            lines.append(f"# TYPE {prefix}_digest_tokens_total counter")
+            for (digest_key, model_name), (_, prompt_tokens, completion_tokens) in sorted(
+                self._digest_tokens.items()
+            ):
+                for kind, value in (("prompt", prompt_tokens), ("completion", completion_tokens)):
+                    labels = _labels(digest=digest_key, model=model_name, kind=kind)
+                    lines.append(f"{prefix}_digest_tokens_total{{{labels}}} {value}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = "") -> "http.server.ThreadingHTTPServer":
+        """
+        Serves the metrics in the Prometheus text format at /metrics, and the
+        JSON summary at /metrics.json, on a background thread. Call `shutdown`
+        on the returned server to stop it.
+        """
+        import http.server
+
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body = metrics.prometheus_text().encode("utf-8")
+                    content_type = "text/plain; version=0.0.4; charset=utf-8"
+                elif self.path == "/metrics.json":
+                    body = json.dumps(metrics.summary()).encode("utf-8")
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def report(self) -> str:
+        """A short report of where the time and tokens of the run went."""
+        summary = self.summary()
+        lines = [f"Pipeline metrics after {summary['elapsed_seconds']:.1f}s:"]
+        for stage, stats in summary["stages"].items():
+            line = f"  {stage}:"
+            if stats.get("count"):
+                line += (
+                    f" {stats['count']} calls, {stats['busy_seconds']:.2f}s busy over "
+                    f"{stats['span_seconds']:.2f}s, p50 {stats['p50_seconds']:.3f}s, "
+                    f"p95 {stats['p95_seconds']:.3f}s."
+                )
+            if stats["counters"]:
+                line += " " + ", ".join(
+                    f"{event}={value}" for event, value in stats["counters"].items()
+                )
+            lines.append(line)
+        for model_name, tokens in summary["tokens"]["models"].items():
+            lines.append(
+                f"  {model_name}: {tokens['requests']} requests, "
+                f"{tokens['prompt_tokens']} prompt and {tokens['completion_tokens']} "
+                f"completion tokens."
+            )
+        return "\n".join(lines)
@@ -0,0 +1,146 @@
+import numpy as np
+import re
+from scipy import sparse
+from typing import Dict, List
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+STOP_WORDS = frozenset(
+    """
+    a about above after again against all also am an and any are as at be because
+    been before being below between both but by can could did do does doing down
+    during each few for from further had has have having he her here hers him his
+    how i if in into is it its itself just me more most my no nor not now of off
+    on once only or other our ours out over own same she should so some such than
+    that the their theirs them then there these they this those through to too
+    under until up very was we were what when where which while who whom why will
+    with would you your yours paper papers propose proposed show shows using use
+    based approach method methods new results including like e g etc
+    """.split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    return [
+        token
+        for token in TOKEN_PATTERN.findall(text.lower())
+        if len(token) > 1 and token not in STOP_WORDS
+    ]
+
+
+def paper_text(paper: dict) -> str:
+    return paper["title"] + " " + paper["abstract"]
+
+
+def _paper_key(paper: dict) -> str:
+    return paper["main_page"].strip().split("/")[-1]
+
+
+class TfidfIndex:
+    """
+    TF-IDF vectors of the title and abstract of a set of papers.
+
+    Each paper is a row of a sparse, L2 normalized matrix, so the cosine
+    similarity of every paper to a query is a single sparse matrix-vector
+    product. Papers are identified by their arXiv id, and indexed once even if
+    they are listed under several categories.
+    """
+
+    def __init__(self, papers: List[dict]):
+        self._rows: Dict[str, int] = {}
+        self._vocabulary: Dict[str, int] = {}
+
+        indptr = [0]
+        indices = []
+        counts = []
+        for paper in papers:
+            key = _paper_key(paper)
+            if key in self._rows:
+                continue
+            self._rows[key] = len(self._rows)
+
+            term_counts: Dict[int, int] = {}
+            for token in tokenize(paper_text(paper)):
+                column = self._vocabulary.setdefault(token, len(self._vocabulary))
+                term_counts[column] = term_counts.get(column, 0) + 1
+            indices.extend(term_counts.keys())
+            counts.extend(term_counts.values())
+            indptr.append(len(indices))
+
+        term_frequencies = sparse.csr_matrix(
+            (
+                np.asarray(counts, dtype=np.float32),
+                np.asarray(indices, dtype=np.int32),
+                np.asarray(indptr, dtype=np.int64),
+            ),
+            shape=(len(self._rows), len(self._vocabulary)),
+        )
+
+        # Smoothed inverse document frequency, and sublinear term frequency.
+        document_frequencies = np.bincount(
+            term_frequencies.indices, minlength=len(self._vocabulary)
+        )
+        self._idf = (
+            np.log((1.0 + len(self._rows)) / (1.0 + document_frequencies)) + 1.0
+        ).astype(np.float32)
+        term_frequencies.data = 1.0 + np.log(term_frequencies.data)
+
+        weights = term_frequencies @ sparse.diags(self._idf)
+        norms = np.sqrt(np.asarray(weights.multiply(weights).sum(axis=1))).ravel()
+        norms[norms == 0] = 1.0
+        self._matrix = sparse.csr_matrix(sparse.diags(1.0 / norms) @ weights)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def query_vector(self, text: str) -> np.ndarray:
+        vector = np.zeros(len(self._vocabulary), dtype=np.float32)
+        for token in tokenize(text):
+            column = self._vocabulary.get(token)
+            if column is not None:
+                vector[column] += 1.0
+        nonzero = vector > 0
+        vector[nonzero] = (1.0 + np.log(vector[nonzero])) * self._idf[nonzero]
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector
+
+    def similarities(self, text: str, papers: List[dict]) -> np.ndarray:
+        """
+        Cosine similarity of each of the papers to the text, in paper order.
+
+        Papers that are not in the index have a similarity of 0.
+        """
+        all_similarities = self._matrix @ self.query_vector(text)
+        rows = np.asarray([self._rows.get(_paper_key(p), -1) for p in papers])
+        similarities = np.zeros(len(papers), dtype=np.float32)
+        if len(papers):
+            known = rows >= 0
+            similarities[known] = all_similarities[rows[known]]
+        return similarities
+
+
+class LexicalPrefilter:
+    """
+    Local pre-ranking of the candidate papers of a digest against its interests.
+
+    Only the `top_k` most similar papers (all of them when `top_k` is 0) with a
+    similarity of at least `min_similarity` are kept for LLM scoring.
+    """
+
+    def __init__(self, papers: List[dict], top_k: int = 0, min_similarity: float = 0.0):
+        self.index = TfidfIndex(papers)
+        self.top_k = top_k
+        self.min_similarity = min_similarity
+
+    def filter(self, interests: str, papers: List[dict]) -> List[dict]:
+        """The papers to forward to the LLM, in their original order."""
+        similarities = self.index.similarities(interests, papers)
+        keep = similarities >= self.min_similarity
+        if self.top_k and np.count_nonzero(keep) > self.top_k:
+            candidates = np.flatnonzero(keep)
+            best = np.argsort(-similarities[candidates], kind="stable")[: self.top_k]
+            keep = np.zeros(len(papers), dtype=bool)
+            keep[candidates[best]] = True
+        return [paper for paper, kept in zip(papers, keep) if kept]
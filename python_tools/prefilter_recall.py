@@ -0,0 +1,111 @@
+import argparse
+import datetime
+import json
+
+from day_corpus import DayCorpus
+import daily_digest_for_all_users as digests
+import numpy as np
+from paper_store import PaperStore
+from prefilter import TfidfIndex
+from score_cache import ScoreCache
+
+
+def main(args_override=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--date", type=str, required=True, help="YYYY-MM-DD")
+    parser.add_argument("--digests_json", type=str, required=True)
+    parser.add_argument(
+        "--paper_store_path", type=str, default=digests.PAPER_STORE_PATH
+    )
+    parser.add_argument(
+        "--score_cache_path", type=str, default="./data/score_cache.sqlite3"
+    )
+    parser.add_argument(
+        "--model_name", type=str, default=digests.ScoringContext.model_name
+    )
+    parser.add_argument(
+        "--threshold_score", type=int, default=digests.ScoringContext.threshold_score
+    )
+    parser.add_argument("--top_k", type=str, default="25,50,100,200")
+    args = parser.parse_args(args_override)
+
+    date = datetime.datetime.strptime(args.date, "%Y-%m-%d").date()
+    top_ks = [int(k) for k in args.top_k.split(",")]
+    with open(args.digests_json, "r") as f:
+        all_digests = [
+            digests.Digest(
+                name=d.get("name", ""),
+                topics=digests.parse_topics(d.get("topics", "")),
+                interests=d.get("description", ""),
+            )
+            for d in json.load(f)
+        ]
+
+    corpus = DayCorpus(date, store=PaperStore(args.paper_store_path))
+    for category in digests.extract_categories_from_users(
+        [digests.User(id="", digests=all_digests)]
+    ):
+        corpus.papers(category)
+    index = TfidfIndex(corpus.all_papers())
+    score_cache = ScoreCache(args.score_cache_path)
+    context = digests.ScoringContext(corpus=corpus)
+
+    total_relevant = 0
+    total_found = np.zeros(len(top_ks), dtype=np.int64)
+    rows = []
+    for digest in all_digests:
+        papers = digests.collect_digest_papers(digest, corpus, context)
+        cached_items = score_cache.get_many(
+            [digests.arxiv_id_for_paper(paper) for paper in papers],
+            digest.interests,
+            args.model_name,
+            digests.RELEVANCY_PROMPT_VERSION,
+        )
+        if len(cached_items) < len(papers):
+            print(
+                f"Warning: only {len(cached_items)} of {len(papers)} candidates of "
+                f"digest '{digest.name}' have a recorded LLM score."
+            )
+
+        relevant = np.asarray(
+            [
+                digests.arxiv_id_for_paper(paper) in cached_items
+                and digests.relevancy_score_value(
+                    cached_items[digests.arxiv_id_for_paper(paper)]
+                )
+                >= args.threshold_score
+                for paper in papers
+            ],
+            dtype=bool,
+        )
+        ranking = np.argsort(
+            -index.similarities(digest.interests, papers), kind="stable"
+        )
+        found = np.asarray(
+            [np.count_nonzero(relevant[ranking[:k]]) for k in top_ks], dtype=np.int64
+        )
+        total_relevant += np.count_nonzero(relevant)
+        total_found += found
+        rows.append((digest.name, len(papers), np.count_nonzero(relevant), found))
+
+    score_cache.close()
+
+    header = f"{'digest':<30} {'papers':>7} {'relevant':>9}" + "".join(
+        f" {'R@' + str(k):>7}" for k in top_ks
+    )
+    print(header)
+    for name, num_papers, num_relevant, found in rows:
+        recalls = found / num_relevant if num_relevant else np.ones(len(top_ks))
+        print(
+            f"{name[:30]:<30} {num_papers:>7} {num_relevant:>9}"
+            + "".join(f" {recall:>7.2f}" for recall in recalls)
+        )
+    if total_relevant:
+        print(
+            f"{'all digests':<30} {'':>7} {total_relevant:>9}"
+            + "".join(f" {recall:>7.2f}" for recall in total_found / total_relevant)
+        )
+
+
+if __name__ == "__main__":
+    main()
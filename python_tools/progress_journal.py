@@ -0,0 +1,141 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Tuple
+
+
+class ProgressJournal:
+    """
+    Durable record of the work done by a run of the digest job, so that a run
+    that crashed can be resumed without paying for the same work again.
+
+    The journal holds, for the run, the parsed output of every finished scoring
+    request, keyed by a fingerprint of the request, and the (user, digest)
+    pairs whose results have been committed to Firestore. Without `resume`,
+    the entries of a previous attempt at the same run are dropped.
+
+    The journal is safe to share between the scoring worker threads.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        run_id: str,
+        resume: bool = False,
+        max_age_days: float = 7,
+    ):
+        self.path = path
+        self.run_id = run_id
+        self.resume = resume
+        self.reused_requests = 0
+        self.reused_tokens = 0
+        self.recorded_requests = 0
+        self.skipped_digests = 0
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS requests (
+                run_id TEXT NOT NULL,
+                request_key TEXT NOT NULL,
+                output TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (run_id, request_key)
+            )
+            """
+        )
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS digests (
+                run_id TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                digest_name TEXT NOT NULL,
+                scores TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (run_id, user_id, digest_name)
+            )
+            """
+        )
+
+        oldest = time.time() - max_age_days * 24 * 60 * 60
+        for table in ("requests", "digests"):
+            self._connection.execute(
+                f"DELETE FROM {table} WHERE created_at < ?", (oldest,)
+            )
+            if not resume:
+                self._connection.execute(
+                    f"DELETE FROM {table} WHERE run_id = ?", (run_id,)
+                )
+        self._connection.commit()
+
+    def request_output(self, request_key: str, num_tokens: int = 0):
+        """The recorded output of the scoring request, if it already finished."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT output FROM requests WHERE run_id = ? AND request_key = ?",
+                (self.run_id, request_key),
+            ).fetchone()
+            if row is None:
+                return None
+            self.reused_requests += 1
+            self.reused_tokens += num_tokens
+        return json.loads(row[0])
+
+    def record_request(self, request_key: str, output):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO requests VALUES (?, ?, ?, ?)",
+                (self.run_id, request_key, json.dumps(output), time.time()),
+            )
+            self._connection.commit()
+            self.recorded_requests += 1
+
+    def written_digests(self) -> Dict[Tuple[str, str], List[dict]]:
+        """The scores written for each (user id, digest name) pair committed."""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT user_id, digest_name, scores FROM digests WHERE run_id = ?",
+                (self.run_id,),
+            ).fetchall()
+        return {
+            (user_id, digest_name): json.loads(scores)
+            for user_id, digest_name, scores in rows
+        }
+
+    def record_digests(self, digests: Iterable[Tuple[str, str, List[dict]]]):
+        """Records the (user id, digest name, scores) of committed digests."""
+        now = time.time()
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?)",
+                [
+                    (self.run_id, user_id, digest_name, json.dumps(scores), now)
+                    for user_id, digest_name, scores in digests
+                ],
+            )
+            self._connection.commit()
+
+    def report(self) -> str:
+        if not self.resume:
+            return (
+                f"Progress journal: recorded {self.recorded_requests} scoring "
+                f"requests for run {self.run_id}."
+            )
+        return (
+            f"Resumed run {self.run_id}: skipped {self.skipped_digests} digests "
+            f"already written, and reused {self.reused_requests} finished scoring "
+            f"requests (~{self.reused_tokens} prompt tokens). Recorded "
+            f"{self.recorded_requests} new scoring requests."
+        )
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,93 @@
+from dataclasses import dataclass
+from typing import List, Tuple
+
+# Context window, in tokens, of the models the digests are scored with.
+MODEL_CONTEXT_TOKENS = {
+    "gpt-3.5-turbo": 16385,
+    "gpt-3.5-turbo-16k": 16385,
+    "gpt-4": 8192,
+    "gpt-4-turbo": 128000,
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+}
+DEFAULT_CONTEXT_TOKENS = 4096
+
+# Tokens the chat format adds around the messages of a request.
+CHAT_FORMAT_TOKENS = 16
+
+
+@dataclass
+class TokenBudget:
+    """
+    How much of the model a single relevance scoring request may use.
+
+    A request is filled with papers until the estimated prompt reaches
+    `max_input_tokens`, or until the response for its papers, at
+    `output_tokens_per_paper` each, would exceed `max_output_tokens`.
+    """
+
+    max_input_tokens: int
+    max_output_tokens: int
+    output_tokens_per_paper: int = 128
+
+    @property
+    def max_papers(self) -> int:
+        return max(1, self.max_output_tokens // self.output_tokens_per_paper)
+
+
+def budget_for_model(
+    model_name: str,
+    max_input_tokens: int = 0,
+    max_output_tokens: int = 2048,
+    output_tokens_per_paper: int = 128,
+) -> TokenBudget:
+    """
+    The token budget for requests to the model. Without an explicit input
+    budget, the prompt may use whatever the response leaves of the context.
+    """
+    context_tokens = MODEL_CONTEXT_TOKENS.get(model_name, DEFAULT_CONTEXT_TOKENS)
+    available_input_tokens = context_tokens - max_output_tokens - CHAT_FORMAT_TOKENS
+    if max_input_tokens:
+        max_input_tokens = min(max_input_tokens, available_input_tokens)
+    else:
+        max_input_tokens = available_input_tokens
+    return TokenBudget(
+        max_input_tokens=max_input_tokens,
+        max_output_tokens=max_output_tokens,
+        output_tokens_per_paper=output_tokens_per_paper,
+    )
+
+
+def pack_batches(
+    paper_tokens: List[int], overhead_tokens: int, budget: TokenBudget
+) -> List[Tuple[int, int]]:
+    """
+    Splits consecutive papers into as few requests as the budget allows.
+
+    Args:
+        paper_tokens: The estimated prompt tokens of each paper, in order.
+        overhead_tokens: The estimated prompt tokens shared by every request,
+            i.e. the instructions and the interests.
+        budget: The token budget of a single request.
+
+    Returns:
+        List[Tuple[int, int]]: The [start, end) paper range of each request.
+            A paper that does not fit in the budget on its own still gets a
+            request of its own.
+    """
+    batches = []
+    start = 0
+    input_tokens = overhead_tokens + CHAT_FORMAT_TOKENS
+    for index, tokens in enumerate(paper_tokens):
+        num_papers = index - start
+        if num_papers and (
+            input_tokens + tokens > budget.max_input_tokens
+            or num_papers + 1 > budget.max_papers
+        ):
+            batches.append((start, index))
+            start = index
+            input_tokens = overhead_tokens + CHAT_FORMAT_TOKENS
+        input_tokens += tokens
+    if start < len(paper_tokens):
+        batches.append((start, len(paper_tokens)))
+    return batches
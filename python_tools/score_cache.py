@@ -0,0 +1,160 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List
+
+
+def interests_fingerprint(interests: str) -> str:
+    """
+    Fingerprint of a digest interests description.
+
+    Whitespace differences do not change the meaning of the prompt, so they
+    are normalized away before hashing.
+    """
+    normalized = " ".join(interests.split())
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+class ScoreCache:
+    """
+    On-disk cache of relevance scores.
+
+    Entries are keyed by (arxiv id, interests fingerprint, model, prompt version)
+    and hold the parsed score item returned by the model, e.g.
+    {"Relevancy score": 8, "Reasons for match": "..."}. Entries older than
+    `max_age_days` are dropped, and the oldest entries are dropped once the
+    cache holds more than `max_entries`.
+
+    The cache is safe to share between the scoring worker threads.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_entries: int = 500000,
+        max_age_days: float = 30,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS scores (
+                arxiv_id TEXT NOT NULL,
+                interests TEXT NOT NULL,
+                model TEXT NOT NULL,
+                prompt_version INTEGER NOT NULL,
+                item TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (arxiv_id, interests, model, prompt_version)
+            )
+            """
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS scores_created_at ON scores (created_at)"
+        )
+        self._connection.commit()
+        self.evict()
+
+    def get_many(
+        self,
+        arxiv_ids: List[str],
+        interests: str,
+        model_name: str,
+        prompt_version: int,
+    ) -> Dict[str, dict]:
+        """
+        Looks up the cached score items for the given papers.
+
+        Returns:
+            Dict[str, dict]: Score items by arxiv id, for the papers with a hit.
+        """
+        fingerprint = interests_fingerprint(interests)
+        oldest = time.time() - self.max_age_days * 24 * 60 * 60
+
+        found = {}
+        with self._lock:
+            for arxiv_id in arxiv_ids:
+                row = self._connection.execute(
+                    "SELECT item FROM scores WHERE arxiv_id = ? AND interests = ? "
+                    "AND model = ? AND prompt_version = ? AND created_at >= ?",
+                    (arxiv_id, fingerprint, model_name, prompt_version, oldest),
+                ).fetchone()
+                if row is not None:
+                    found[arxiv_id] = json.loads(row[0])
+            self.hits += len(found)
+            self.misses += len(arxiv_ids) - len(found)
+        return found
+
+    def put_many(
+        self,
+        items: Dict[str, dict],
+        interests: str,
+        model_name: str,
+        prompt_version: int,
+    ):
+        """Stores the score items, keyed by arxiv id."""
+        if not items:
+            return
+
+        fingerprint = interests_fingerprint(interests)
+        now = time.time()
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        arxiv_id,
+                        fingerprint,
+                        model_name,
+                        prompt_version,
+                        json.dumps(item),
+                        now,
+                    )
+                    for arxiv_id, item in items.items()
+                ],
+            )
+            self._connection.commit()
+
+    def evict(self):
+        """Drops the expired entries, then the oldest ones above the size limit."""
+        oldest = time.time() - self.max_age_days * 24 * 60 * 60
+        with self._lock:
+            self._connection.execute(
+                "DELETE FROM scores WHERE created_at < ?", (oldest,)
+            )
+            (num_entries,) = self._connection.execute(
+                "SELECT COUNT(*) FROM scores"
+            ).fetchone()
+            if num_entries > self.max_entries:
+                self._connection.execute(
+                    "DELETE FROM scores WHERE rowid IN "
+                    "(SELECT rowid FROM scores ORDER BY created_at LIMIT ?)",
+                    (num_entries - self.max_entries,),
+                )
+            self._connection.commit()
+
+    def report(self) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = 100.0 * self.hits / lookups if lookups else 0.0
+        return (
+            f"Score cache: {self.hits} hits, {self.misses} misses "
+            f"({hit_rate:.1f}% hit rate)."
+        )
+
+    def close(self):
+        self.evict()
+        with self._lock:
+            self._connection.close()
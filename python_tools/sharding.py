@@ -0,0 +1,127 @@
+import datetime
+import hashlib
+import json
+import os
+import time
+from typing import List, Optional
+
+
+def shard_for_user(user_id: str, num_shards: int) -> int:
+    """
+    The shard a user belongs to. The partition only depends on the user id, so
+    it is the same on every machine and in every run, unlike `hash`.
+    """
+    digest = hashlib.sha256(user_id.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % num_shards
+
+
+def progress_path(progress_dir: str, shard: int, num_shards: int) -> str:
+    return os.path.join(progress_dir, f"shard_{shard}_of_{num_shards}.json")
+
+
+class ShardProgress:
+    """
+    The progress of one shard of a run, kept in a JSON file of the shared data
+    directory so that the report step can read the progress of every shard.
+
+    The file is rewritten at most every `write_interval` seconds while digests
+    are written, and when the shard finishes.
+    """
+
+    def __init__(
+        self,
+        progress_dir: str,
+        shard: int,
+        num_shards: int,
+        write_interval: float = 5.0,
+    ):
+        self.path = progress_path(progress_dir, shard, num_shards)
+        self.write_interval = write_interval
+        self.state = {
+            "shard": shard,
+            "num_shards": num_shards,
+            "host": os.uname().nodename,
+            "status": "running",
+            "num_users": 0,
+            "num_digests": 0,
+            "digests_done": 0,
+            "started_at": time.time(),
+            "updated_at": time.time(),
+            "finished_at": None,
+        }
+        self._last_write = 0.0
+
+    def start(self, num_users: int, num_digests: int):
+        self.state["num_users"] = num_users
+        self.state["num_digests"] = num_digests
+        self._write()
+
+    def digest_done(self):
+        self.state["digests_done"] += 1
+        if time.time() - self._last_write >= self.write_interval:
+            self._write()
+
+    def finish(self, status: str = "done"):
+        self.state["status"] = status
+        self.state["finished_at"] = time.time()
+        self._write()
+
+    def _write(self):
+        self.state["updated_at"] = time.time()
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.state, f)
+        os.replace(temp_path, self.path)
+        self._last_write = time.time()
+
+
+def read_shard_progress(progress_dir: str, num_shards: int) -> List[Optional[dict]]:
+    """The progress of each shard, or None for the shards that never started."""
+    shards = []
+    for shard in range(num_shards):
+        path = progress_path(progress_dir, shard, num_shards)
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                shards.append(json.load(f))
+        else:
+            shards.append(None)
+    return shards
+
+
+def report_shard_progress(
+    progress_dir: str, num_shards: int, stale_after: float = 15 * 60
+) -> str:
+    """
+    A report of the progress of every shard of a run. A running shard that has
+    not written any progress for `stale_after` seconds is reported as stalled.
+    """
+    lines = []
+    total_digests = 0
+    done_digests = 0
+    num_finished = 0
+    for shard, state in enumerate(read_shard_progress(progress_dir, num_shards)):
+        if state is None:
+            lines.append(f"Shard {shard}/{num_shards}: not started.")
+            continue
+
+        status = state["status"]
+        if status == "running" and time.time() - state["updated_at"] > stale_after:
+            status = "stalled"
+        end = state["finished_at"] or state["updated_at"]
+        elapsed = datetime.timedelta(seconds=int(end - state["started_at"]))
+        lines.append(
+            f"Shard {shard}/{num_shards} on {state['host']}: {status}, "
+            f"{state['digests_done']}/{state['num_digests']} digests of "
+            f"{state['num_users']} users in {elapsed}."
+        )
+        total_digests += state["num_digests"]
+        done_digests += state["digests_done"]
+        num_finished += state["status"] == "done"
+    lines.append(
+        f"{num_finished}/{num_shards} shards finished, {done_digests}/{total_digests} "
+        f"digests written."
+    )
+    return "\n".join(lines)
@@ -0,0 +1,71 @@
+import os
+import sys
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import arxiv_digest
+import http_utils
+
+ATOM_FEED = b"""<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <entry>
+    <id>http://arxiv.org/abs/2610.00001v1</id>
+    <published>2026-10-17T12:00:00Z</published>
+    <title>A Paper</title>
+    <summary>About language models.</summary>
+  </entry>
+</feed>
+"""
+
+
+def start_api_server(requests_seen):
+    """A stand-in for the arXiv API answering every query with one paper."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_seen.append(self.path)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/atom+xml")
+            self.send_header("Content-Length", str(len(ATOM_FEED)))
+            self.end_headers()
+            self.wfile.write(ATOM_FEED)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def test_reruns_minutes_apart_are_served_from_the_cache(tmp_path, monkeypatch):
+    requests_seen = []
+    server = start_api_server(requests_seen)
+    monkeypatch.setattr(
+        arxiv_digest,
+        "ARXIV_API_URL",
+        f"http://127.0.0.1:{server.server_address[1]}/api/query",
+    )
+    cache = http_utils.HTTPCache(str(tmp_path / "http_cache.sqlite3"))
+    try:
+        runs = []
+        for now in (
+            datetime(2026, 10, 18, 10, 0, tzinfo=timezone.utc),
+            datetime(2026, 10, 18, 10, 7, tzinfo=timezone.utc),
+        ):
+            session = http_utils.create_session(pool_size=1, cache=cache)
+            runs.append(
+                list(arxiv_digest.get_yesterday_papers("cat:cs.CL", session, now=now))
+            )
+    finally:
+        server.shutdown()
+        cache.close()
+
+    assert len(requests_seen) == 1
+    assert "202610170000+TO+202610180000" in requests_seen[0]
+    assert cache.hits == 1
+    assert runs[0] == runs[1]
+    assert [paper["title"] for paper in runs[0]] == ["A Paper"]
@@ -28,7 +28,12 @@ export async function DELETE(
   try {
     const { id } = await params;
 
-    await db.collection('digests').doc(id).delete();
+    // Record the deletion so that the nightly digest job can drop the digest
+    // from its snapshot without re-reading the whole collection.
+    const batch = db.batch();
+    batch.delete(db.collection('digests').doc(id));
+    batch.set(db.collection('digestDeletions').doc(id), { deletedAt: Date.now() });
+    await batch.commit();
     return NextResponse.json({ success: true });
   } catch (error) {
     console.error('❌ Error deleting digest:', error);
@@ -54,6 +59,7 @@ export async function PUT(
       name: name.trim(),
       topics,
       description,
+      updatedAt: Date.now(),
     });
 
     return NextResponse.json({ success: true });
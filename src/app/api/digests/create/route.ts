@@ -25,13 +25,15 @@ export async function POST(request: Request) {
   try {
     const data: CreateDigestRequest = await request.json();
     const { userId, name, topics, description } = data;
+    const now = Date.now();
 
     const digestData = {
       userId,
       name: name.trim(),
       topics,
       description,
-      createdAt: Date.now()
+      createdAt: now,
+      updatedAt: now
     };
 
     const docRef = await db.collection('digests').add(digestData);
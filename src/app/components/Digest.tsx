@@ -14,6 +14,7 @@ interface SavedDigest {
   topics: string;
   description: string;
   createdAt: number;
+  updatedAt?: number;
 }
 
 interface DigestProps {